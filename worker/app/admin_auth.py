@@ -0,0 +1,11 @@
+from __future__ import annotations
+
+from fastapi import Request, HTTPException
+from app.settings import settings
+
+
+def require_admin_key(request: Request) -> None:
+    """Chequeo del header x-admin-key compartido por las rutas admin (delta/cache/inbox)."""
+    key = request.headers.get("x-admin-key") or request.headers.get("X-Admin-Key")
+    if not key or key != settings.ADMIN_API_KEY:
+        raise HTTPException(status_code=401, detail="Invalid admin key")
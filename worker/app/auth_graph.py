@@ -2,6 +2,8 @@ from __future__ import annotations
 
 import asyncio
 import logging
+import os
+import time
 from pathlib import Path
 from typing import Optional
 
@@ -18,10 +20,29 @@ class GraphAuth:
 
     - DEV: client_secret
     - PROD: certificate (private key PEM + thumbprint)
+
+    Token en memoria: get_token() devuelve el cacheado sin salto a thread.
+    GRAPH_TOKEN_REFRESH_MARGIN_SECONDS antes de expirar se renueva en background,
+    con UNA sola adquisición en vuelo (los demás siguen usando el token vigente
+    o esperan esa misma adquisición si ya expiró).
+    Si una renovación falla (AAD caído), las de background esperan un backoff
+    creciente; solo el token ya expirado reintenta de inmediato.
+    Opcional: GRAPH_TOKEN_CACHE_PATH persiste el cache MSAL entre reinicios.
     """
 
+    SCOPES = ["https://graph.microsoft.com/.default"]
+    REFRESH_BACKOFF_MIN_SECONDS = 30.0
+    REFRESH_BACKOFF_MAX_SECONDS = 300.0
+
     def __init__(self) -> None:
         self._app: Optional[msal.ConfidentialClientApplication] = None
+        self._cache: Optional[msal.SerializableTokenCache] = None
+        self._token: Optional[str] = None
+        self._expires_at = 0.0  # time.monotonic()
+        self._lifetime = 0
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._refresh_failed_at = 0.0  # time.monotonic() del último fallo
+        self._refresh_backoff = 0.0
 
     def _build_msal_app(self) -> msal.ConfidentialClientApplication:
         if not settings.GRAPH_TENANT_ID or not settings.GRAPH_CLIENT_ID:
@@ -52,30 +73,137 @@ class GraphAuth:
             client_id=settings.GRAPH_CLIENT_ID,
             authority=authority,
             client_credential=client_credential,
+            token_cache=self._load_cache(),
         )
 
+    # ============================
+    # Cache MSAL persistente (opcional)
+    # ============================
+
+    def _cache_path(self) -> Optional[Path]:
+        raw = (settings.GRAPH_TOKEN_CACHE_PATH or "").strip()
+        return Path(raw).expanduser() if raw else None
+
+    def _load_cache(self) -> Optional[msal.SerializableTokenCache]:
+        path = self._cache_path()
+        if path is None:
+            return None
+        cache = msal.SerializableTokenCache()
+        if path.exists():
+            try:
+                cache.deserialize(path.read_text(encoding="utf-8"))
+                logger.info("GraphAuth token cache loaded from %s", path)
+            except Exception as e:
+                logger.warning("GraphAuth token cache unreadable (ignored) path=%s err=%s", path, e)
+        self._cache = cache
+        return cache
+
+    def _save_cache(self) -> None:
+        cache = self._cache
+        path = self._cache_path()
+        if cache is None or path is None or not cache.has_state_changed:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(path.suffix + ".tmp")
+            tmp.write_text(cache.serialize(), encoding="utf-8")
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, path)
+            cache.has_state_changed = False
+        except Exception as e:
+            logger.warning("GraphAuth token cache not saved path=%s err=%s", path, e)
+
     def _ensure_app(self) -> msal.ConfidentialClientApplication:
         if self._app is None:
             self._app = self._build_msal_app()
         return self._app
 
+    # ============================
+    # Token holder
+    # ============================
+
+    def _margin(self) -> int:
+        # acotado a media vida del token (evita renovar en bucle tokens cortos)
+        return min(max(0, int(settings.GRAPH_TOKEN_REFRESH_MARGIN_SECONDS)), self._lifetime // 2)
+
     async def get_token(self) -> str:
+        now = time.monotonic()
+        margin = self._margin()
+
+        if self._token and now < self._expires_at:
+            if now >= self._expires_at - margin and now >= self._refresh_failed_at + self._refresh_backoff:
+                # vigente pero por vencer: renovar en background, devolver el actual
+                self._start_refresh(force=True)
+            return self._token
+
+        # sin token o expirado: todos esperan la MISMA adquisición
+        return await asyncio.shield(self._start_refresh(force=False))
+
+    def _start_refresh(self, *, force: bool) -> asyncio.Task:
+        task = self._refresh_task
+        if task is None or task.done():
+            task = asyncio.create_task(self._refresh(force=force), name="graph_token_refresh")
+            task.add_done_callback(self._on_refresh_done)
+            self._refresh_task = task
+        return task
+
+    def _on_refresh_done(self, task: asyncio.Task) -> None:
+        # el error lo reciben quienes esperan; en background queda en el log con el backoff
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.warning(
+            "Graph token refresh failed | next background attempt in %.0fs | token valid for %.0fs",
+            self._refresh_backoff, max(0.0, self._expires_at - time.monotonic()),
+        )
+
+    def _note_refresh_failure(self) -> None:
+        self._refresh_failed_at = time.monotonic()
+        self._refresh_backoff = min(
+            self.REFRESH_BACKOFF_MAX_SECONDS,
+            max(self.REFRESH_BACKOFF_MIN_SECONDS, self._refresh_backoff * 2),
+        )
+
+    async def _refresh(self, *, force: bool) -> str:
         app = self._ensure_app()
-        scopes = ["https://graph.microsoft.com/.default"]
+        margin = self._margin()
 
         def _acquire() -> dict:
-            result = app.acquire_token_silent(scopes=scopes, account=None)
+            result = app.acquire_token_silent(scopes=self.SCOPES, account=None)
+            if result and force and int(result.get("expires_in") or 0) <= margin:
+                # renovación anticipada: el cache MSAL devolvería el mismo token por vencer
+                app.remove_tokens_for_client()
+                result = None
             if not result:
-                result = app.acquire_token_for_client(scopes=scopes)
+                result = app.acquire_token_for_client(scopes=self.SCOPES)
+            self._save_cache()
             return result or {}
 
-        result = await asyncio.to_thread(_acquire)
+        try:
+            result = await asyncio.to_thread(_acquire)
+        except Exception as e:
+            logger.error("Token acquisition failed: %s", e)
+            self._note_refresh_failure()
+            raise
 
         if "access_token" not in result:
-            logger.error("Token acquisition failed: %s", result)
+            logger.error(
+                "Token acquisition failed: %s",
+                {k: result.get(k) for k in ("error", "error_description", "correlation_id")},
+            )
+            self._note_refresh_failure()
             raise RuntimeError("Graph token request failed")
 
-        return str(result["access_token"])
+        self._refresh_backoff = 0.0
+
+        expires_in = int(result.get("expires_in") or 0)
+        self._token = str(result["access_token"])
+        self._expires_at = time.monotonic() + expires_in
+        if result.get("token_source") != "cache":
+            self._lifetime = expires_in
+        elif not self._lifetime:
+            self._lifetime = max(expires_in, 3600)
+        logger.info("Graph token acquired | source=%s | expires_in=%ss", result.get("token_source", "?"), expires_in)
+        return self._token
 
 
 graph_auth = GraphAuth()
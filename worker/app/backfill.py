@@ -0,0 +1,90 @@
+"""
+Backfill histórico del buzón (fuera del servicio web).
+
+    python -m app.backfill --since 2024-01-01 [--until 2024-06-30] [--folder INBOX ...] [--window-days 7]
+    python -m app.backfill --resume    # retoma ventanas pendientes
+    python -m app.backfill --status
+    (--mailbox buzon@dominio para uno distinto de MAILBOX_EMAIL)
+
+Corre en el carril de baja prioridad: puede convivir con el worker en vivo.
+Ctrl+C devuelve la ventana en curso a PENDING con su cursor.
+"""
+from __future__ import annotations
+from app.tls_bootstrap import bootstrap_tls_from_os_truststore
+
+bootstrap_tls_from_os_truststore()
+
+import argparse
+import asyncio
+import json
+import logging
+from datetime import datetime
+
+from app.logging_conf import setup_logging
+from app.graph_client import graph_client
+from app.backfill_service import plan_backfill, run_backfill, backfill_status
+from app.sync_service import ensure_ingest_schema
+
+logger = logging.getLogger("app.backfill")
+
+
+def _date(value: str) -> datetime:
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date {value!r} (expected YYYY-MM-DD)")
+
+
+def _parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(prog="python -m app.backfill", description="Backfill histórico por receivedDateTime")
+    p.add_argument("--mailbox", help="buzón (por defecto MAILBOX_EMAIL / el único activo)")
+    p.add_argument("--since", type=_date, help="inicio (UTC, inclusive)")
+    p.add_argument("--until", type=_date, help="fin (UTC, exclusivo; por defecto ahora)")
+    p.add_argument("--folder", action="append", help="código de carpeta Graph (repetible; por defecto INBOX)")
+    p.add_argument("--window-days", type=int, help="días por ventana (BACKFILL_WINDOW_DAYS)")
+    p.add_argument("--resume", action="store_true", help="solo retoma ventanas pendientes")
+    p.add_argument("--status", action="store_true", help="muestra el estado y sale")
+    args = p.parse_args(argv)
+    if not (args.since or args.resume or args.status):
+        p.error("one of --since, --resume or --status is required")
+    return args
+
+
+async def _main(args: argparse.Namespace) -> int:
+    if args.status:
+        print(json.dumps(await backfill_status(mailbox_email=args.mailbox), indent=2, default=str))
+        return 0
+
+    await graph_client.open()
+    try:
+        await ensure_ingest_schema()
+        if args.since:
+            planned = await plan_backfill(
+                mailbox_email=args.mailbox,
+                since=args.since,
+                until=args.until,
+                folders=args.folder,
+                window_days=args.window_days,
+            )
+            if not planned.get("ok"):
+                print(json.dumps(planned, indent=2, default=str))
+                return 1
+        res = await run_backfill(mailbox_email=args.mailbox)
+        print(json.dumps(res, indent=2, default=str))
+        return 0 if res.get("ok") and not res["run"]["errors"] else 1
+    finally:
+        await graph_client.close()
+
+
+def main(argv: list[str] | None = None) -> int:
+    setup_logging()
+    args = _parse_args(argv)
+    try:
+        return asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        logger.warning("Backfill interrupted")
+        return 130
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
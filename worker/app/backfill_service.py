@@ -0,0 +1,292 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from app.settings import settings
+from app.db import run_db
+from app.graph_client import graph_client
+from app.concurrency import low_priority
+from app import repos, ref_cache, sync_service
+
+logger = logging.getLogger("app.backfill_service")
+
+_table_ready = False
+
+
+async def _ensure_table() -> None:
+    global _table_ready
+    if not _table_ready:
+        await run_db(repos.ensure_backfill_jobs_table)
+        _table_ready = True
+
+
+async def _resolve_mailbox(mailbox_email: str | None) -> tuple[int, str]:
+    if mailbox_email:
+        return await ref_cache.mailbox_id_for(mailbox_email), mailbox_email
+    mailbox_id = await ref_cache.default_mailbox_id()
+    return mailbox_id, await ref_cache.mailbox_email_for(mailbox_id)
+
+
+def _utc_naive(dt: datetime) -> datetime:
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _iso_z(dt: datetime) -> str:
+    return _utc_naive(dt).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def split_windows(since: datetime, until: datetime, window_days: int) -> list[tuple[datetime, datetime]]:
+    """
+    [since, until) en ventanas de window_days, alineadas hacia atrás desde until
+    (la más reciente primero).
+    """
+    since, until = _utc_naive(since), _utc_naive(until)
+    step = timedelta(days=max(1, int(window_days)))
+    out: list[tuple[datetime, datetime]] = []
+    end = until
+    while end > since:
+        start = max(since, end - step)
+        out.append((start, end))
+        end = start
+    return out
+
+
+async def plan_backfill(
+    *,
+    mailbox_email: str | None = None,
+    since: datetime,
+    until: datetime | None = None,
+    folders: list[str] | None = None,
+    window_days: int | None = None,
+) -> dict[str, Any]:
+    """
+    Registra las ventanas del backfill (idempotente: re-planificar no duplica ni resetea cursores).
+    """
+    await _ensure_table()
+    mailbox_id, mb = await _resolve_mailbox(mailbox_email)
+
+    until = until or datetime.now(timezone.utc)
+    windows = split_windows(since, until, window_days or int(settings.BACKFILL_WINDOW_DAYS))
+    folder_codes = [f.strip().upper() for f in (folders or ["INBOX"]) if f.strip()]
+
+    added = 0
+    for code in folder_codes:
+        added += await run_db(repos.plan_backfill_windows, mailbox_id=mailbox_id, folder_code=code, windows=windows)
+
+    logger.warning(
+        "Backfill planned | mailbox=%s | folders=%s | since=%s | until=%s | windows=%s | new_windows=%s",
+        mb, folder_codes, _iso_z(since), _iso_z(until), len(windows) * len(folder_codes), added,
+    )
+    return {"ok": True, "mailbox": mb, "folders": folder_codes, "windows": len(windows) * len(folder_codes), "new_windows": added}
+
+
+async def run_backfill(
+    *,
+    mailbox_email: str | None = None,
+    stop_event: asyncio.Event | None = None,
+) -> dict[str, Any]:
+    """
+    Procesa ventanas pendientes hasta agotarlas (o stop_event), BACKFILL_WINDOW_CONCURRENCY a la vez.
+    Todo corre en el carril de baja prioridad (ingest_slots + graph_throttle) para
+    no quitarle capacidad a la ingesta en vivo del webhook.
+    Reanudable: cada página deja el cursor (nextLink) en backfill_jobs.
+    """
+    await _ensure_table()
+    mailbox_id, mb = await _resolve_mailbox(mailbox_email)
+
+    token = low_priority.set(True)
+    totals = {"windows": 0, "pages": 0, "messages": 0, "new_messages": 0, "errors": 0}
+    owner = f"{settings.WORKER_INSTANCE_ID}:{os.getpid()}"
+
+    async def _worker(idx: int) -> None:
+        while stop_event is None or not stop_event.is_set():
+            claimed = await run_db(
+                repos.claim_backfill_window,
+                mailbox_id=mailbox_id,
+                claim_token=f"{owner}:bf{idx}:{uuid.uuid4().hex[:8]}",
+                lease_seconds=int(settings.BACKFILL_LEASE_SECONDS),
+            )
+            if claimed is None:
+                # Quedan ventanas en backoff (error reciente): esperar a que venzan
+                wait = await run_db(repos.backfill_next_available_seconds, mailbox_id=mailbox_id)
+                if wait is None:
+                    return
+                await _sleep(min(60.0, max(1.0, wait)), stop_event)
+                continue
+            job_id, folder_code, ws, we, next_link, attempts = claimed
+            try:
+                r = await _run_window(
+                    mailbox_email=mb,
+                    mailbox_id=mailbox_id,
+                    job_id=job_id,
+                    folder_code=folder_code,
+                    window_start=ws,
+                    window_end=we,
+                    next_link=next_link,
+                    stop_event=stop_event,
+                )
+                totals["windows"] += int(r["finished"])
+                for k in ("pages", "messages", "new_messages"):
+                    totals[k] += r[k]
+            except asyncio.CancelledError:
+                await run_db(repos.release_backfill_window, job_id=job_id, error="cancelled", count_attempt=False)
+                raise
+            except Exception as e:
+                totals["errors"] += 1
+                logger.exception("Backfill window failed id=%s folder=%s %s..%s err=%s", job_id, folder_code, ws, we, e)
+                failed = attempts >= int(settings.BACKFILL_MAX_ATTEMPTS)
+                await run_db(
+                    repos.release_backfill_window,
+                    job_id=job_id,
+                    error=str(e),
+                    failed=failed,
+                    retry_in_seconds=min(300, 2 ** attempts * 5),
+                )
+
+    try:
+        n = max(1, int(settings.BACKFILL_WINDOW_CONCURRENCY))
+        await asyncio.gather(*[_worker(i) for i in range(n)])
+    finally:
+        low_priority.reset(token)
+
+    stats = await run_db(repos.backfill_stats, mailbox_id=mailbox_id)
+    logger.warning("Backfill run finished | %s | remaining=%s", totals, stats)
+    return {"ok": True, "mailbox": mb, "run": totals, "jobs": stats}
+
+
+async def _sleep(seconds: float, stop_event: asyncio.Event | None) -> None:
+    if stop_event is None:
+        await asyncio.sleep(seconds)
+        return
+    try:
+        await asyncio.wait_for(stop_event.wait(), timeout=seconds)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def _run_window(
+    *,
+    mailbox_email: str,
+    mailbox_id: int,
+    job_id: int,
+    folder_code: str,
+    window_start: datetime,
+    window_end: datetime,
+    next_link: str | None,
+    stop_event: asyncio.Event | None,
+) -> dict[str, Any]:
+    page_size = max(1, min(1000, int(settings.BACKFILL_PAGE_SIZE)))
+    out = {"pages": 0, "messages": 0, "new_messages": 0, "finished": False}
+    url = next_link
+
+    while stop_event is None or not stop_event.is_set():
+        status, data = await graph_client.list_messages_window(
+            mailbox_email=mailbox_email,
+            folder_code=folder_code,
+            received_from_iso=_iso_z(window_start),
+            received_to_iso=_iso_z(window_end),
+            url=url,
+            page_size=page_size,
+        )
+        if status != 200:
+            raise RuntimeError(f"Backfill page failed status={status} body={str(data)[:300]}")
+
+        items = [it for it in (data.get("value") or []) if isinstance(it, dict) and it.get("id")]
+        prefetched = {str(it["id"]): it for it in items if sync_service.is_full_message(it)}
+        stats: dict[str, int] = {"new": 0, "duplicates": 0, "failed": 0}
+        if items:
+            await sync_service.process_message_ids_async(
+                [str(it["id"]) for it in items],
+                mailbox_id=mailbox_id,
+                prefetched=prefetched,
+                max_parallel=int(settings.BACKFILL_CONCURRENCY),
+                stats=stats,
+            )
+        if stats["failed"]:
+            # El cursor NO avanza: la ventana se reintenta desde esta página (con backoff);
+            # lo que sí quedó OK se salta por dedupe
+            raise RuntimeError(f"{stats['failed']} of {len(items)} messages failed in page")
+
+        new_next = data.get("@odata.nextLink")
+        url = str(new_next) if new_next else None
+        await run_db(
+            repos.save_backfill_cursor,
+            job_id=job_id,
+            next_link=url,
+            pages=1,
+            messages=len(items),
+            new_messages=stats["new"],
+        )
+        out["pages"] += 1
+        out["messages"] += len(items)
+        out["new_messages"] += stats["new"]
+
+        if not url:
+            out["finished"] = True
+            logger.info(
+                "Backfill window done id=%s folder=%s %s..%s pages=%s messages=%s new=%s",
+                job_id, folder_code, window_start, window_end, out["pages"], out["messages"], out["new_messages"],
+            )
+            return out
+
+    # stop pedido: la ventana vuelve a PENDING con su cursor
+    await run_db(repos.release_backfill_window, job_id=job_id, error="stopped", count_attempt=False)
+    return out
+
+
+async def backfill_status(*, mailbox_email: str | None = None) -> dict[str, Any]:
+    await _ensure_table()
+    mailbox_id, mb = await _resolve_mailbox(mailbox_email)
+    return {"ok": True, "mailbox": mb, "jobs": await run_db(repos.backfill_stats, mailbox_id=mailbox_id)}
+
+
+class BackfillRunner:
+    """
+    Una corrida de backfill en background por proceso y buzón (la dispara la ruta admin).
+    """
+
+    def __init__(self) -> None:
+        self._tasks: dict[str, asyncio.Task] = {}  # email (lower) -> corrida
+        self._stop = asyncio.Event()
+        self.last_results: dict[str, dict[str, Any]] = {}
+
+    def running(self, mailbox_email: str) -> bool:
+        t = self._tasks.get(mailbox_email.strip().lower())
+        return t is not None and not t.done()
+
+    def start(self, mailbox_email: str) -> bool:
+        if self.running(mailbox_email):
+            return False
+        self._stop.clear()
+        key = mailbox_email.strip().lower()
+        self._tasks[key] = asyncio.create_task(self._run(mailbox_email), name=f"backfill:{key}")
+        return True
+
+    async def _run(self, mailbox_email: str) -> None:
+        key = mailbox_email.strip().lower()
+        try:
+            self.last_results[key] = await run_backfill(mailbox_email=mailbox_email, stop_event=self._stop)
+        except Exception as e:
+            logger.exception("Backfill run failed mailbox=%s: %s", mailbox_email, e)
+            self.last_results[key] = {"ok": False, "error": str(e)}
+
+    async def stop(self) -> None:
+        tasks = [t for t in self._tasks.values() if not t.done()]
+        if not tasks:
+            return
+        self._stop.set()
+        _, pending = await asyncio.wait(tasks, timeout=int(settings.INBOX_DRAIN_TIMEOUT_SECONDS))
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+
+backfill_runner = BackfillRunner()
@@ -2,12 +2,17 @@ from __future__ import annotations
 
 import asyncio
 import logging
+import os
 import random
 from typing import Any
 
 from app.settings import settings
-from app.delta_service import run_delta_backstop
-from app.subscriptions_service import ensure_subscription
+from app.db import AdvisoryLock
+from app.delta_scheduler import delta_scheduler
+from app.delta_checkpoint import delta_checkpoints
+from app.subscriptions_service import ensure_subscriptions
+from app.ingest_queue import webhook_inbox
+from app.work_leases import work_leases
 
 logger = logging.getLogger("app.background")
 
@@ -37,6 +42,9 @@ def _cfg_int(name: str, default: int) -> int:
 async def start_background_jobs() -> None:
     """
     Arranca loops en background. Se llama en FastAPI startup.
+    Con uvicorn --workers N cada proceso corre sus consumidores del webhook inbox
+    (la ingesta se reparte entre cores por claim), pero los jobs programados
+    (suscripciones, delta, latido de leases) solo en el proceso líder del nodo.
     """
     global _stop_event, _tasks
 
@@ -48,13 +56,18 @@ async def start_background_jobs() -> None:
     _stop_event = asyncio.Event()
     _tasks = []
 
-    if _cfg_bool("SUB_LOOP_ENABLED", True):
-        _tasks.append(asyncio.create_task(_subscription_loop(_stop_event), name="subscription_loop"))
+    # Consumidores de la cola durable del webhook (todos los procesos)
+    try:
+        await webhook_inbox.start()
+    except Exception as e:
+        logger.exception("Webhook inbox failed to start: %s", e)
 
-    if _cfg_bool("DELTA_LOOP_ENABLED", True):
-        _tasks.append(asyncio.create_task(_delta_loop(_stop_event), name="delta_loop"))
+    if _cfg_bool("LEADER_ELECTION_ENABLED", True):
+        _tasks.append(asyncio.create_task(_leader_loop(_stop_event), name="leader_loop"))
+    else:
+        await _start_scheduled_jobs()
 
-    logger.warning("Background jobs started | tasks=%s", [t.get_name() for t in _tasks])
+    logger.warning("Background jobs started | tasks=%s", [t.get_name() for t in _tasks + _scheduled_tasks])
 
 
 async def stop_background_jobs() -> None:
@@ -73,15 +86,110 @@ async def stop_background_jobs() -> None:
 
     await asyncio.gather(*_tasks, return_exceptions=True)
 
+    await _stop_scheduled_jobs()
+    await _leader_lock.release()
+
+    # Drena la cola: termina lo que está en vuelo, lo demás queda PENDING
+    await webhook_inbox.stop()
+
     logger.warning("Background jobs stopped")
     _tasks = []
     _stop_event = None
 
 
+# ============================
+# Jobs programados (solo el líder)
+# ============================
+
+# Un líder por nodo (WORKER_INSTANCE_ID): entre nodos el trabajo se reparte con work_leases
+_leader_lock = AdvisoryLock(f"{settings.APP_NAME}:scheduler:{settings.WORKER_INSTANCE_ID}")
+_scheduled_stop: asyncio.Event | None = None
+_scheduled_tasks: list[asyncio.Task] = []
+
+
+def scheduled_jobs_running() -> bool:
+    """
+    True si este proceso es el que corre los jobs programados (líder, o sin elección).
+    """
+    return _scheduled_stop is not None
+
+
+async def _start_scheduled_jobs() -> None:
+    global _scheduled_stop, _scheduled_tasks
+
+    if _scheduled_stop is not None:
+        return
+    _scheduled_stop = asyncio.Event()
+    _scheduled_tasks = []
+
+    # Latido de la instancia: renueva los leases de delta / roles (multi-instancia)
+    if work_leases.enabled:
+        try:
+            await work_leases.heartbeat()
+        except Exception as e:
+            logger.exception("Work leases first heartbeat failed: %s", e)
+        _scheduled_tasks.append(asyncio.create_task(work_leases.run(_scheduled_stop), name="work_leases"))
+
+    if _cfg_bool("SUB_LOOP_ENABLED", True):
+        _scheduled_tasks.append(asyncio.create_task(_subscription_loop(_scheduled_stop), name="subscription_loop"))
+
+    if _cfg_bool("DELTA_LOOP_ENABLED", True):
+        _scheduled_tasks.append(asyncio.create_task(_delta_loop(_scheduled_stop), name="delta_loop"))
+
+
+async def _stop_scheduled_jobs() -> None:
+    global _scheduled_stop, _scheduled_tasks
+
+    if _scheduled_stop is None:
+        return
+    _scheduled_stop.set()
+
+    for t in _scheduled_tasks:
+        t.cancel()
+
+    await asyncio.gather(*_scheduled_tasks, return_exceptions=True)
+    # Corridas delta por buzón (tareas propias del scheduler)
+    await delta_scheduler.stop()
+
+    # Checkpoints delta que no alcanzaron a escribirse en la cancelación
+    await delta_checkpoints.flush_all()
+
+    # Con el estado ya escrito, otra instancia puede tomar carpetas y roles sin esperar al TTL
+    await work_leases.release_all()
+
+    _scheduled_tasks = []
+    _scheduled_stop = None
+
+
+async def _leader_loop(stop_event: asyncio.Event) -> None:
+    """
+    Elección de líder por GET_LOCK (conexión dedicada). Los seguidores reintentan
+    cada LEADER_CHECK_SECONDS; si el líder muere, MySQL suelta el lock y otro lo toma.
+    """
+    interval = max(1, _cfg_int("LEADER_CHECK_SECONDS", 10))
+
+    while not stop_event.is_set():
+        try:
+            if _leader_lock.held:
+                if not await _leader_lock.check():
+                    logger.warning("Leader lock lost | lock=%s -> stopping scheduled jobs", _leader_lock.name)
+                    await _stop_scheduled_jobs()
+            elif await _leader_lock.acquire():
+                logger.warning("Leader elected | lock=%s | pid=%s -> starting scheduled jobs", _leader_lock.name, os.getpid())
+                await _start_scheduled_jobs()
+        except Exception as e:
+            logger.exception("Leader loop failed: %s", e)
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
 async def _subscription_loop(stop_event: asyncio.Event) -> None:
     """
-    Llama ensure_subscription periódicamente.
-    Tu ensure_subscription ya decide: created / renewed / ok (según expires_at + threshold).
+    Llama ensure_subscriptions periódicamente (una suscripción por buzón activo).
+    ensure_subscription ya decide: created / renewed / ok (según expires_at + threshold).
     """
     interval = _cfg_int("SUB_LOOP_INTERVAL_SECONDS", 120)  # cada 2 min
     jitter = _cfg_int("SUB_LOOP_JITTER_SECONDS", 15)
@@ -91,13 +199,17 @@ async def _subscription_loop(stop_event: asyncio.Event) -> None:
 
     while not stop_event.is_set():
         try:
-            res: dict[str, Any] = await ensure_subscription(dry_run=False)
-            logger.info(
-                "Sub loop | action=%s | subscription_id=%s | expiration=%s",
-                res.get("action"),
-                res.get("subscription_id"),
-                res.get("expiration"),
-            )
+            # Multi-instancia: solo la instancia con el rol crea/renueva la suscripción
+            if await work_leases.acquire("role:subscriptions"):
+                res: dict[str, Any] = await ensure_subscriptions(dry_run=False)
+                for r in res.get("mailboxes") or []:
+                    logger.info(
+                        "Sub loop | mailbox=%s | action=%s | subscription_id=%s | expiration=%s",
+                        r.get("mailbox"),
+                        r.get("action"),
+                        r.get("subscription_id"),
+                        r.get("expiration"),
+                    )
         except Exception as e:
             logger.exception("Sub loop failed: %s", e)
 
@@ -110,37 +222,19 @@ async def _subscription_loop(stop_event: asyncio.Event) -> None:
 
 async def _delta_loop(stop_event: asyncio.Event) -> None:
     """
-    Corre delta backstop periódicamente (para no depender solo del webhook).
+    Delta backstop (para no depender solo del webhook) con agenda adaptativa:
+    delta_scheduler decide qué carpetas vencen y cuándo despertar.
     """
-    interval = _cfg_int("DELTA_LOOP_INTERVAL_SECONDS", 300)  # cada 5 min
-    jitter = _cfg_int("DELTA_LOOP_JITTER_SECONDS", 20)
-
     await asyncio.sleep(2)
 
     while not stop_event.is_set():
         try:
-            res: dict[str, Any] = await run_delta_backstop()
-            # resumen corto para logs
-            folders = res.get("folders") or []
-            processed = 0
-            ok_folders = 0
-            for f in folders:
-                if isinstance(f, dict) and f.get("ok"):
-                    ok_folders += 1
-                    processed += int(f.get("processed_messages") or 0)
-
-            logger.info(
-                "Delta loop | ok=%s | folders_ok=%s/%s | processed_messages=%s",
-                res.get("ok"),
-                ok_folders,
-                len(folders),
-                processed,
-            )
+            # Solo lanza las corridas vencidas (tareas por buzón); el resumen lo loguea cada corrida
+            res: dict[str, Any] | None = await delta_scheduler.run_due()
+            if res is not None:
+                logger.info("Delta loop | started=%s | running_mailboxes=%s", res.get("started"), res.get("running"))
         except Exception as e:
             logger.exception("Delta loop failed: %s", e)
+            await delta_scheduler.wait(30)
 
-        sleep_s = max(30, interval + random.randint(0, jitter))
-        try:
-            await asyncio.wait_for(stop_event.wait(), timeout=sleep_s)
-        except asyncio.TimeoutError:
-            pass
+        await delta_scheduler.wait(delta_scheduler.seconds_until_next())
@@ -0,0 +1,13 @@
+from __future__ import annotations
+
+from fastapi import APIRouter, Request
+from app.admin_auth import require_admin_key
+from app import ref_cache
+
+router = APIRouter()
+
+@router.post("/admin/ref-cache/invalidate")
+async def invalidate_ref_cache(request: Request) -> dict:
+    require_admin_key(request)
+    ref_cache.invalidate_all()
+    return {"ok": True}
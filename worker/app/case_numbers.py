@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import datetime
+
+from app.settings import settings
+from app.db import run_db
+from app import repos
+
+logger = logging.getLogger("app.case_numbers")
+
+
+class CaseNumberAllocator:
+    """
+    Números de caso por bloques: cada worker (WORKER_INSTANCE_ID) reserva
+    CASE_NUMBER_BLOCK_SIZE números de case_sequences en una transacción corta
+    y los reparte desde memoria. Así la fila del año deja de serializar cada
+    create_case entre workers/tareas.
+
+    - Se piden desde código async ANTES de la transacción de persistencia
+      (take -> run_db(_persist_*, case_numbers=...) -> give_back): la reserva del
+      bloque nunca abre una sesión anidada dentro de un thread del pool de DB.
+    - Cambio de año: se descarta el bloque del año anterior y se reserva uno nuevo.
+    - Números no usados de un bloque (reinicio del proceso) quedan como huecos.
+    """
+
+    def __init__(self, *, block_size: int, worker_id: str) -> None:
+        self._block_size = max(1, int(block_size))
+        self._worker_id = worker_id
+        self._lock: asyncio.Lock | None = None
+        self._year: int | None = None
+        self._free: list[int] = []  # reservados y sin usar, ascendentes
+        self._table_ready = False
+
+    def _reserve_block(self, db, *, year: int, size: int) -> tuple[int, int]:
+        if not self._table_ready:
+            repos.ensure_case_sequence_blocks_table(db)
+        return repos.reserve_case_number_block(db, year=year, size=size, worker_id=self._worker_id)
+
+    @staticmethod
+    def _format(year: int, value: int) -> str:
+        return f"ICBF-{year}-{value:06d}"
+
+    async def take(self, n: int) -> list[str]:
+        """
+        n números para una persistencia (a lo sumo un caso nuevo por correo).
+        Reserva un bloque (transacción propia en el pool de DB) si no alcanzan.
+        """
+        if n <= 0:
+            return []
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        year = datetime.utcnow().year
+        async with self._lock:
+            if self._year != year:
+                self._year, self._free = year, []
+            if len(self._free) < n:
+                size = max(self._block_size, n - len(self._free))
+                first_value, last_value = await run_db(self._reserve_block, year=year, size=size)
+                self._table_ready = True
+                if self._year == year:
+                    self._free.extend(range(first_value, last_value + 1))
+                logger.info(
+                    "Case number block reserved | worker=%s | year=%s | range=%s-%s",
+                    self._worker_id, year, first_value, last_value,
+                )
+            values, self._free = self._free[:n], self._free[n:]
+        return [self._format(year, v) for v in values]
+
+    def give_back(self, numbers: list[str]) -> None:
+        """
+        Lo que la persistencia no usó (duplicados / hilos existentes) vuelve al pool.
+        Solo tras terminar el run_db: si se canceló, el thread aún puede usarlos.
+        """
+        values: list[int] = []
+        for number in numbers:
+            _, year, value = number.rsplit("-", 2)
+            if int(year) == self._year:
+                values.append(int(value))
+        if values:
+            self._free = sorted(values + self._free)
+
+
+case_number_allocator = CaseNumberAllocator(
+    block_size=settings.CASE_NUMBER_BLOCK_SIZE,
+    worker_id=settings.WORKER_INSTANCE_ID,
+)
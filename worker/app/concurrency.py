@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Generic, Hashable, Iterable, TypeVar
+
+from app.settings import settings
+
+
+class ByteBudget:
+    """
+    Tope por proceso de bytes "en vuelo" (p.ej. adjuntos descargándose/decodificándose).
+    reserve(n) espera hasta que haya cupo; n se recorta a la capacidad para que
+    un adjunto enorme no bloquee para siempre (pasa solo, sin compañía).
+    """
+
+    def __init__(self, capacity_bytes: int) -> None:
+        self._capacity = max(1, int(capacity_bytes))
+        self._used = 0
+        self._cond = asyncio.Condition()
+
+    @property
+    def used(self) -> int:
+        return self._used
+
+    @asynccontextmanager
+    async def reserve(self, n: int) -> AsyncIterator[None]:
+        n = max(0, min(int(n), self._capacity))
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._used + n <= self._capacity)
+            self._used += n
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._used -= n
+                self._cond.notify_all()
+
+
+# Carril de baja prioridad (backfill): se hereda a las tareas hijas (gather/create_task copian el contexto)
+low_priority: ContextVar[bool] = ContextVar("low_priority", default=False)
+
+
+class PrioritySlots:
+    """
+    Semáforo con dos carriles y reparto justo por clave (buzón):
+      - normal (webhook, delta): toma cualquier slot libre y pasa antes que cualquier baja en espera
+      - baja (low_priority=True, backfill): solo si no hay normales esperando y como
+        máximo low_max slots a la vez (siempre queda al menos uno para el tráfico en vivo)
+      - dentro de cada carril, con varias claves esperando, el slot libre va a la
+        clave que menos slots tiene en uso: un buzón ruidoso no acapara la ingesta
+    """
+
+    def __init__(self, capacity: int, *, low_max: int) -> None:
+        self._capacity = max(1, int(capacity))
+        self._low_max = max(0, min(int(low_max), self._capacity - 1)) if self._capacity > 1 else 1
+        self._used = 0
+        self._low_used = 0
+        self._in_use: dict[Hashable, int] = {}
+        self._waiting: tuple[dict[Hashable, int], dict[Hashable, int]] = ({}, {})  # (normal, baja)
+        self._cond = asyncio.Condition()
+
+    def _fair(self, key: Hashable, waiting: dict[Hashable, int]) -> bool:
+        mine = self._in_use.get(key, 0)
+        return all(mine <= self._in_use.get(k, 0) for k in waiting)
+
+    def _can_take(self, key: Hashable, low: bool) -> bool:
+        if self._used >= self._capacity:
+            return False
+        if low and (self._waiting[0] or self._low_used >= self._low_max):
+            return False
+        return self._fair(key, self._waiting[int(low)])
+
+    @asynccontextmanager
+    async def slot(self, key: Hashable = None) -> AsyncIterator[None]:
+        low = low_priority.get()
+        waiting = self._waiting[int(low)]
+        async with self._cond:
+            waiting[key] = waiting.get(key, 0) + 1
+            try:
+                await self._cond.wait_for(lambda: self._can_take(key, low))
+            finally:
+                waiting[key] -= 1
+                if not waiting[key]:
+                    del waiting[key]
+                # el conjunto de espera cambió: otros pueden haber quedado habilitados
+                self._cond.notify_all()
+            self._used += 1
+            self._low_used += int(low)
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._used -= 1
+                self._low_used -= int(low)
+                self._in_use[key] -= 1
+                if not self._in_use[key]:
+                    del self._in_use[key]
+                self._cond.notify_all()
+
+
+K = TypeVar("K", bound=Hashable)
+
+
+class SingleFlight(Generic[K]):
+    """
+    Registro de trabajos en vuelo por clave (single-flight), dentro del event loop.
+    claim(keys) separa las claves en:
+      - owned: nadie las está procesando; el llamador DEBE llamar release() al terminar
+      - joined: ya en vuelo; se espera el futuro del dueño (True = OK)
+    Sin locks: todo corre en el mismo loop y claim/release no hacen await.
+    """
+
+    def __init__(self) -> None:
+        self._inflight: dict[K, asyncio.Future[bool]] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    def claim(self, keys: Iterable[K]) -> tuple[list[K], dict[K, asyncio.Future[bool]]]:
+        loop = asyncio.get_running_loop()
+        owned: list[K] = []
+        joined: dict[K, asyncio.Future[bool]] = {}
+        for key in keys:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                joined[key] = fut
+                continue
+            self._inflight[key] = loop.create_future()
+            owned.append(key)
+        return owned, joined
+
+    def release(self, key: K, ok: bool) -> None:
+        fut = self._inflight.pop(key, None)
+        if fut is not None and not fut.done():
+            fut.set_result(bool(ok))
+
+
+# Adjuntos: descargas concurrentes + bytes en vuelo (por proceso)
+attachment_slots = asyncio.Semaphore(max(1, int(settings.ATTACHMENT_CONCURRENCY)))
+attachment_bytes = ByteBudget(int(settings.ATTACHMENT_MAX_INFLIGHT_MB) * 1024 * 1024)
+
+# Ingesta: presupuesto global Graph/DB compartido por webhook, delta y (en carril bajo) backfill
+ingest_slots = PrioritySlots(int(settings.INGEST_CONCURRENCY), low_max=int(settings.BACKFILL_INGEST_SLOTS))
+
+# Mensajes en vuelo por (mailbox_id, message_id): webhook y delta comparten fetch + persistencia
+message_flights: SingleFlight[tuple[int, str]] = SingleFlight()
@@ -1,9 +1,14 @@
 from __future__ import annotations
 
-from contextlib import contextmanager
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+from typing import Any, AsyncIterator, Callable, TypeVar
 from urllib.parse import quote_plus
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import Connection, create_engine, text
 from sqlalchemy.orm import Session, sessionmaker
 
 from app.settings import settings
@@ -32,6 +37,15 @@ engine = create_engine(
 
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
 
+T = TypeVar("T")
+
+# Pool acotado por el que pasa TODO acceso a DB desde código async.
+# Tamaño <= conexiones del engine, así nunca hay threads esperando conexión.
+_db_executor = ThreadPoolExecutor(
+    max_workers=max(1, int(settings.DB_EXECUTOR_THREADS or settings.DB_POOL_SIZE)),
+    thread_name_prefix="db",
+)
+
 
 @contextmanager
 def get_db_session() -> Session:
@@ -46,6 +60,141 @@ def get_db_session() -> Session:
         db.close()
 
 
+async def _in_db_thread(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, partial(fn, *args, **kwargs))
+
+
+async def run_db(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Ejecuta fn(db, *args, **kwargs) dentro de get_db_session() en el pool de DB.
+    Es la forma preferida desde código async: una transacción corta, completa,
+    sin bloquear el event loop.
+
+        mailbox_id = await run_db(repos.get_or_create_mailbox, email)
+    """
+
+    def _call() -> T:
+        with get_db_session() as db:
+            return fn(db, *args, **kwargs)
+
+    return await _in_db_thread(_call)
+
+
+class AsyncDbSession:
+    """
+    Envoltura async de una Session: cada run() se ejecuta en el pool de DB.
+    Las llamadas son secuenciales (nunca dos threads a la vez sobre la misma Session).
+    """
+
+    def __init__(self, db: Session) -> None:
+        self.sync_session = db
+
+    async def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        return await _in_db_thread(fn, self.sync_session, *args, **kwargs)
+
+
+@asynccontextmanager
+async def get_async_db_session() -> AsyncIterator[AsyncDbSession]:
+    """
+    Equivalente async de get_db_session(): commit al salir, rollback si hay error.
+
+        async with get_async_db_session() as adb:
+            st = await adb.run(repos.get_delta_state, mailbox_id=1, folder_id=2)
+    """
+    db: Session = await _in_db_thread(SessionLocal)
+    try:
+        yield AsyncDbSession(db)
+        await _in_db_thread(db.commit)
+    except BaseException:
+        await _in_db_thread(db.rollback)
+        raise
+    finally:
+        await _in_db_thread(db.close)
+
+
 def ping_db() -> None:
     with engine.connect() as conn:
         conn.execute(text("SELECT 1"))
+
+
+class AdvisoryLock:
+    """
+    Lock con nombre de MySQL (GET_LOCK) sobre una conexión dedicada: se tiene
+    mientras esa conexión viva. Si la conexión se cae, MySQL lo suelta solo
+    (otro proceso puede tomarlo) y check() lo detecta.
+    La conexión nunca vuelve al pool con el lock tomado: se libera o se invalida.
+    """
+
+    def __init__(self, name: str) -> None:
+        # GET_LOCK admite hasta 64 caracteres
+        self.name = name if len(name) <= 64 else name[:48] + ":" + hashlib.sha1(name.encode()).hexdigest()[:15]
+        self._conn: Connection | None = None
+
+    @property
+    def held(self) -> bool:
+        return self._conn is not None
+
+    def _drop(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.invalidate()  # cierra la conexión física: MySQL suelta el lock
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _acquire(self) -> bool:
+        if self._conn is not None:
+            return True
+        conn = engine.connect()
+        try:
+            got = conn.execute(text("SELECT GET_LOCK(:n, 0)"), {"n": self.name}).scalar()
+            conn.rollback()  # sin transacción abierta; el lock es de sesión
+        except Exception:
+            conn.invalidate()
+            conn.close()
+            raise
+        if got == 1:
+            self._conn = conn
+            return True
+        conn.close()
+        return False
+
+    def _check(self) -> bool:
+        if self._conn is None:
+            return False
+        try:
+            mine = self._conn.execute(text("SELECT IS_USED_LOCK(:n) = CONNECTION_ID()"), {"n": self.name}).scalar()
+            self._conn.rollback()
+        except Exception:
+            mine = 0
+        if not mine:
+            self._drop()
+        return bool(mine)
+
+    def _release(self) -> None:
+        if self._conn is None:
+            return
+        try:
+            self._conn.execute(text("SELECT RELEASE_LOCK(:n)"), {"n": self.name})
+            self._conn.rollback()
+            self._conn.close()
+            self._conn = None
+        except Exception:
+            self._drop()
+
+    async def acquire(self) -> bool:
+        """
+        Intenta tomar el lock sin esperar. True si quedó tomado por este proceso.
+        """
+        return await _in_db_thread(self._acquire)
+
+    async def check(self) -> bool:
+        """
+        True si el lock sigue siendo de este proceso (la conexión sigue viva).
+        """
+        return await _in_db_thread(self._check)
+
+    async def release(self) -> None:
+        await _in_db_thread(self._release)
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import logging
+import time
+
+from app.settings import settings
+from app.db import run_db
+from app import repos
+from app.work_leases import delta_lease, work_leases
+
+logger = logging.getLogger("app.delta_checkpoint")
+
+
+class DeltaCheckpoint:
+    """
+    Estado delta de UNA carpeta en memoria, con escritura diferida a graph_delta_state:
+      - flush cada DELTA_CHECKPOINT_EVERY_PAGES páginas o DELTA_CHECKPOINT_EVERY_SECONDS segundos
+      - flush inmediato en error / fin de corrida / shutdown (delta_checkpoints.flush_all)
+    Progreso dentro de la página: page_offset = ítems ya procesados (prefijo contiguo)
+    de la página en curso; al reanudar se pide la misma página y se saltan esos ítems.
+    Solo para páginas nextLink (cursor del servidor, se re-sirven iguales): re-pedir el
+    deltaLink o la consulta inicial trae otro conjunto/orden, ahí page_offset es siempre 0
+    (lo ya procesado que se repita lo absorbe el dedupe).
+    Si el proceso muere se pierde a lo sumo lo no flusheado: el dedupe lo absorbe.
+    Multi-instancia: si la carpeta tenía lease de esta instancia al abrir y ya no lo tiene
+    (venció / lo tomó otro nodo), no se escribe más: el estado es del nuevo dueño.
+    """
+
+    def __init__(
+        self,
+        *,
+        mailbox_id: int,
+        folder_id: int,
+        delta_link: str | None,
+        next_link: str | None,
+        page_offset: int = 0,
+    ) -> None:
+        self.mailbox_id = mailbox_id
+        self.folder_id = folder_id
+        self.delta_link = delta_link
+        self.next_link = next_link
+        self.page_offset = max(0, int(page_offset or 0)) if next_link else 0
+
+        self._dirty = False
+        self._pages_since_flush = 0
+        self._flushed_at = time.monotonic()
+        self._discarded = False
+        lease = delta_lease(mailbox_id, folder_id)
+        self._lease = lease if work_leases.holds(lease) else None
+
+    @property
+    def lease_lost(self) -> bool:
+        return self._lease is not None and not work_leases.holds(self._lease)
+
+    # URL de la página por la que se reanuda (None = delta inicial)
+    @property
+    def resume_url(self) -> str | None:
+        return self.next_link or self.delta_link
+
+    def start_page(self, page_url: str | None, *, offset: int = 0) -> None:
+        """
+        Página en curso: se reanuda por su URL (la que se pidió) saltando `offset` ítems.
+        """
+        if page_url and page_url != self.delta_link:
+            self.next_link = page_url
+        self.page_offset = max(0, int(offset)) if self.next_link else 0
+        self._dirty = True
+
+    def progress(self, offset: int) -> None:
+        if not self.next_link:
+            return  # página deltaLink / inicial: no se puede reanudar por posición
+        if offset > self.page_offset:
+            self.page_offset = offset
+            self._dirty = True
+
+    def end_page(self, *, delta_link: str | None, next_link: str | None) -> None:
+        if delta_link:
+            self.delta_link = delta_link
+        self.next_link = next_link
+        self.page_offset = 0
+        self._pages_since_flush += 1
+        self._dirty = True
+
+    def discard(self) -> None:
+        """
+        El estado ya no vale (p.ej. 410 + reset en DB): no volver a escribirlo.
+        """
+        self._discarded = True
+        self._dirty = False
+
+    async def maybe_flush(self) -> None:
+        every_pages = max(1, int(settings.DELTA_CHECKPOINT_EVERY_PAGES))
+        every_seconds = max(1, int(settings.DELTA_CHECKPOINT_EVERY_SECONDS))
+        if not self._dirty:
+            return
+        if self._pages_since_flush >= every_pages or time.monotonic() - self._flushed_at >= every_seconds:
+            await self.flush()
+
+    async def flush(self, *, status_code: int | None = 200, error: str | None = None) -> None:
+        if self._discarded or (not self._dirty and status_code == 200 and error is None):
+            return
+        if self.lease_lost:
+            logger.warning(
+                "Delta lease lost, checkpoint not written | mailbox_id=%s | folder_id=%s",
+                self.mailbox_id, self.folder_id,
+            )
+            self.discard()
+            return
+        await run_db(
+            repos.upsert_delta_state,
+            mailbox_id=self.mailbox_id,
+            folder_id=self.folder_id,
+            delta_link=self.delta_link,
+            next_link=self.next_link,
+            last_sync_at=repos.utcnow(),
+            last_status_code=status_code,
+            last_error=error,
+            page_offset=self.page_offset,
+        )
+        self._dirty = False
+        self._pages_since_flush = 0
+        self._flushed_at = time.monotonic()
+
+
+class DeltaCheckpoints:
+    """
+    Checkpoints abiertos (corridas en curso), para el flush de shutdown.
+    """
+
+    def __init__(self) -> None:
+        self._open: dict[tuple[int, int], DeltaCheckpoint] = {}
+
+    def open(self, cp: DeltaCheckpoint) -> DeltaCheckpoint:
+        self._open[(cp.mailbox_id, cp.folder_id)] = cp
+        return cp
+
+    def close(self, cp: DeltaCheckpoint) -> None:
+        if self._open.get((cp.mailbox_id, cp.folder_id)) is cp:
+            del self._open[(cp.mailbox_id, cp.folder_id)]
+
+    async def flush_all(self) -> None:
+        for cp in list(self._open.values()):
+            try:
+                await cp.flush()
+            except Exception as e:
+                logger.warning("Delta checkpoint flush failed folder_id=%s err=%s", cp.folder_id, e)
+
+
+delta_checkpoints = DeltaCheckpoints()
@@ -1,17 +1,80 @@
 from __future__ import annotations
 
-from fastapi import APIRouter, Request, HTTPException
-from app.settings import settings
-from app.delta_service import run_delta_backstop
+import os
+from datetime import datetime
 
-router = APIRouter()
+from fastapi import APIRouter, Request, HTTPException, Query
+from app.admin_auth import require_admin_key
+from app.delta_service import run_delta_backstop, run_delta_all_mailboxes
+from app.delta_scheduler import delta_scheduler
+from app.background_jobs import scheduled_jobs_running
+from app.backfill_service import plan_backfill, backfill_status, backfill_runner
+from app import ref_cache
 
-def _require_admin_key(request: Request) -> None:
-    key = request.headers.get("x-admin-key") or request.headers.get("X-Admin-Key")
-    if not key or key != settings.ADMIN_API_KEY:
-        raise HTTPException(status_code=401, detail="Invalid admin key")
+router = APIRouter()
 
 @router.post("/graph/delta/run")
-async def run_delta(request: Request) -> dict:
-    _require_admin_key(request)
-    return await run_delta_backstop()
+async def run_delta(request: Request, mailbox: str | None = None) -> dict:
+    require_admin_key(request)
+    if mailbox:
+        return await run_delta_backstop(mailbox_email=mailbox)
+    return await run_delta_all_mailboxes()
+
+
+@router.get("/graph/delta/schedule")
+async def delta_schedule(request: Request) -> dict:
+    require_admin_key(request)
+    # Con uvicorn --workers N solo el líder agenda; en los demás la agenda está vacía
+    return {**delta_scheduler.snapshot(), "leader": scheduled_jobs_running(), "pid": os.getpid()}
+
+
+def _parse_date(value: str | None, name: str) -> datetime | None:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name} (expected YYYY-MM-DD)")
+
+
+@router.post("/graph/backfill/run")
+async def run_backfill_route(
+    request: Request,
+    mailbox: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    folder: list[str] | None = Query(default=None),
+    window_days: int | None = None,
+) -> dict:
+    """
+    Planifica (si viene since) y arranca el backfill en background.
+    Sin since retoma las ventanas pendientes.
+    """
+    require_admin_key(request)
+    if not mailbox:
+        mailbox = await ref_cache.mailbox_email_for(await ref_cache.default_mailbox_id())
+    planned = None
+    since_dt = _parse_date(since, "since")
+    if since_dt is not None:
+        planned = await plan_backfill(
+            mailbox_email=mailbox,
+            since=since_dt,
+            until=_parse_date(until, "until"),
+            folders=folder,
+            window_days=window_days,
+        )
+        if not planned.get("ok"):
+            return planned
+    started = backfill_runner.start(mailbox)
+    return {"ok": True, "mailbox": mailbox, "started": started, "already_running": not started, "planned": planned}
+
+
+@router.get("/graph/backfill/status")
+async def backfill_status_route(request: Request, mailbox: str | None = None) -> dict:
+    require_admin_key(request)
+    st = await backfill_status(mailbox_email=mailbox)
+    return {
+        **st,
+        "running": backfill_runner.running(st["mailbox"]),
+        "last_result": backfill_runner.last_results.get(st["mailbox"].strip().lower()),
+    }
@@ -0,0 +1,353 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any
+
+from app.settings import settings
+from app.db import run_db
+from app import repos, ref_cache
+from app.delta_service import run_delta_backstop
+from app.work_leases import delta_lease, work_leases
+
+logger = logging.getLogger("app.delta_scheduler")
+
+
+@dataclass
+class FolderSchedule:
+    mailbox_id: int
+    folder_id: int
+    folder_code: str
+    interval: float
+    next_run_at: float = 0.0  # time.monotonic(); 0 = ya
+    last_run_at: float = 0.0
+    change_rate: float = 0.0  # cambios/minuto vistos por delta (EWMA)
+    last_new: int = 0
+    last_duplicates: int = 0
+    resets_in_a_row: int = 0
+
+
+class DeltaScheduler:
+    """
+    Agenda adaptativa del delta backstop, por carpeta:
+      - delta encontró correos que el webhook no trajo -> intervalo / 2
+      - solo duplicados / sin cambios (webhook sano)   -> intervalo * DELTA_BACKOFF_FACTOR
+      - corrida cortada por límites                    -> mínimo (quedó paginación pendiente)
+      - 410 (deltaLink expirado, estado reseteado)      -> re-corre de inmediato
+      - webhook del buzón en silencio más de DELTA_WEBHOOK_SILENCE_SECONDS cuando
+        por el ritmo de cambios de la carpeta ya debería haber llegado algo -> mínimo
+        (por buzón: el tráfico de otro buzón no tapa una suscripción caída)
+      - pedido en graph_delta_state.run_requested_at (lifecycle 'missed' /
+        suscripción recreada, desde cualquier proceso)  -> de inmediato
+    Intervalos acotados a [DELTA_MIN_INTERVAL_SECONDS, DELTA_MAX_INTERVAL_SECONDS].
+    Todas las carpetas de todos los buzones activos (con lease de esta instancia).
+    Cada buzón corre como tarea propia (hasta DELTA_MAILBOX_CONCURRENCY a la vez) y la
+    agenda sigue planificando mientras corren: un buzón que pagina mucho no frena a los demás.
+    """
+
+    def __init__(self) -> None:
+        self._folders: dict[int, FolderSchedule] = {}
+        self._last_webhook: dict[int, float] = {}  # mailbox_id -> monotonic
+        self._started_at = time.monotonic()
+        self._wakeup: asyncio.Event | None = None
+        self._requests_seen: dict[int, datetime] = {}  # folder_id -> run_requested_at ya atendido
+        self._running: dict[int, asyncio.Task] = {}  # mailbox_id -> corrida delta en curso
+
+    # ============================
+    # Config
+    # ============================
+
+    @property
+    def base_interval(self) -> float:
+        return float(settings.DELTA_LOOP_INTERVAL_SECONDS)
+
+    @property
+    def min_interval(self) -> float:
+        return float(max(10, int(settings.DELTA_MIN_INTERVAL_SECONDS)))
+
+    @property
+    def max_interval(self) -> float:
+        return float(max(self.min_interval, int(settings.DELTA_MAX_INTERVAL_SECONDS)))
+
+    @property
+    def mailbox_concurrency(self) -> int:
+        return max(1, int(settings.DELTA_MAILBOX_CONCURRENCY))
+
+    def _clamp(self, interval: float) -> float:
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def _get_wakeup(self) -> asyncio.Event:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    # ============================
+    # Señales externas
+    # ============================
+
+    def _mark_webhook(self, mailbox_id: int, seen: float) -> None:
+        if seen > self._last_webhook.get(mailbox_id, 0.0):
+            self._last_webhook[mailbox_id] = seen
+
+    async def record_webhook(self, subscription_ids: list[str]) -> None:
+        """
+        Lo llama el webhook al encolar notificaciones válidas.
+        """
+        now = time.monotonic()
+        for sid in subscription_ids:
+            if not sid:
+                continue
+            try:
+                mailbox_id = await ref_cache.mailbox_for_subscription(sid)
+            except Exception as e:
+                logger.debug("Webhook activity: subscription lookup failed sid=%s err=%s", sid, e)
+                continue
+            if mailbox_id is not None:
+                self._mark_webhook(mailbox_id, now)
+
+    async def sync_webhook_activity(self) -> None:
+        """
+        Con varios procesos (uvicorn --workers N) el webhook lo recibe cualquiera:
+        la última llegada por suscripción se toma de webhook_inbox, no solo de este proceso.
+        """
+        try:
+            by_sub = await run_db(repos.webhook_inbox_last_received_by_subscription)
+        except Exception as e:
+            logger.debug("Webhook activity lookup failed: %s", e)
+            return
+        now = time.monotonic()
+        for sid, ago in by_sub.items():
+            mailbox_id = await ref_cache.mailbox_for_subscription(sid)
+            if mailbox_id is not None:
+                self._mark_webhook(mailbox_id, now - ago)
+
+    def webhook_silence_seconds(self, mailbox_id: int | None = None) -> float:
+        """
+        Silencio del webhook de un buzón (None: del buzón con actividad más reciente).
+        """
+        if mailbox_id is None:
+            last = max(self._last_webhook.values(), default=self._started_at)
+        else:
+            last = self._last_webhook.get(mailbox_id, self._started_at)
+        return time.monotonic() - last
+
+    def request_run(self, folder_id: int | None = None, *, reason: str = "") -> None:
+        """
+        Fuerza corrida inmediata (de una carpeta o de todas) y despierta el loop.
+        """
+        targets = [self._folders[folder_id]] if folder_id in self._folders else list(self._folders.values())
+        for fs in targets:
+            fs.next_run_at = 0.0
+        logger.info("Delta run requested | folder_id=%s | reason=%s", folder_id, reason or "-")
+        self._get_wakeup().set()
+
+    async def sync_run_requests(self) -> None:
+        """
+        Pedidos de corrida inmediata registrados en DB (los registra quien procesa
+        la lifecycle notification, que puede no ser este proceso ni esta instancia).
+        """
+        try:
+            pending = await run_db(repos.list_pending_delta_runs)
+        except Exception as e:
+            logger.debug("Delta run requests lookup failed: %s", e)
+            return
+        for _, fid, requested_at in pending:
+            fs = self._folders.get(fid)
+            if fs is None or self._requests_seen.get(fid) == requested_at:
+                continue
+            self._requests_seen[fid] = requested_at
+            fs.next_run_at = 0.0
+            logger.warning("Delta run requested | folder=%s | requested_at=%s", fs.folder_code, requested_at)
+
+    # ============================
+    # Agenda
+    # ============================
+
+    def _webhook_suspect(self, fs: FolderSchedule) -> bool:
+        silence = self.webhook_silence_seconds(fs.mailbox_id)
+        if silence < int(settings.DELTA_WEBHOOK_SILENCE_SECONDS):
+            return False
+        # Sin tráfico esperado (p.ej. de noche) el silencio no es sospechoso
+        return fs.change_rate * (silence / 60.0) >= 1.0
+
+    def _due_at(self, fs: FolderSchedule) -> float:
+        if self._webhook_suspect(fs):
+            return min(fs.next_run_at, fs.last_run_at + self.min_interval)
+        return fs.next_run_at
+
+    def _sync_folders(self, folders: list[tuple[int, int, str]]) -> None:
+        current = {fid for _, fid, _ in folders}
+        for mailbox_id, fid, code in folders:
+            if fid not in self._folders:
+                self._folders[fid] = FolderSchedule(
+                    mailbox_id=mailbox_id, folder_id=fid, folder_code=code, interval=self._clamp(self.base_interval)
+                )
+        for fid in list(self._folders):
+            if fid not in current:
+                del self._folders[fid]
+
+    def seconds_until_next(self) -> float:
+        tick = float(max(1, int(settings.DELTA_SCHEDULER_TICK_SECONDS)))
+        # Cupo lleno o todo en curso: despierta al terminar una corrida (wakeup) o al tick
+        waiting = [fs for fs in self._folders.values() if fs.mailbox_id not in self._running]
+        if not waiting or len(self._running) >= self.mailbox_concurrency:
+            return tick
+        now = time.monotonic()
+        nearest = min(self._due_at(fs) for fs in waiting)
+        # tope = tick: el silencio del webhook se re-evalúa aunque no venza nada
+        return max(0.0, min(tick, nearest - now))
+
+    async def wait(self, timeout: float) -> None:
+        wakeup = self._get_wakeup()
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+
+    def _after_run(self, fs: FolderSchedule, res: dict[str, Any]) -> None:
+        now = time.monotonic()
+        elapsed_min = max(60.0, now - fs.last_run_at) / 60.0
+        first_or_resync = not fs.last_run_at or fs.resets_in_a_row > 0
+        fs.last_run_at = now
+        fs.last_new = int(res.get("new_messages") or 0)
+        fs.last_duplicates = int(res.get("duplicates") or 0)
+
+        # La sincronización inicial (primera corrida / tras 410) trae todo el buzón: no es ritmo
+        if not first_or_resync and res.get("action") != "reset":
+            changes = int(res.get("total_items") or 0)
+            fs.change_rate = 0.7 * fs.change_rate + 0.3 * (changes / elapsed_min)
+
+        if res.get("action") == "reset":
+            fs.resets_in_a_row += 1
+            # re-corre ya; si el 410 se repite, no entrar en bucle
+            fs.next_run_at = now if fs.resets_in_a_row < 3 else now + self.min_interval
+            logger.warning("Delta reset folder=%s -> immediate re-run (resets_in_a_row=%s)", fs.folder_code, fs.resets_in_a_row)
+            return
+        fs.resets_in_a_row = 0
+
+        if not res.get("ok"):
+            fs.interval = self._clamp(min(fs.interval, self.base_interval))
+        elif not res.get("finished"):
+            fs.interval = self.min_interval
+        elif fs.last_new > 0:
+            fs.interval = self._clamp(fs.interval / 2)
+        else:
+            fs.interval = self._clamp(fs.interval * float(settings.DELTA_BACKOFF_FACTOR))
+
+        jitter = int(settings.DELTA_LOOP_JITTER_SECONDS)
+        fs.next_run_at = now + fs.interval + random.uniform(0, max(0, jitter))
+        logger.info(
+            "Delta schedule folder=%s | new=%s | duplicates=%s | rate=%.2f/min | next_in=%ss",
+            fs.folder_code, fs.last_new, fs.last_duplicates, fs.change_rate, int(fs.interval),
+        )
+
+    async def run_due(self) -> dict[str, Any] | None:
+        """
+        Lanza delta para las carpetas vencidas, una tarea por buzón; no espera a que terminen
+        (cada tarea aplica su resultado a la agenda). None si no se lanzó ninguna.
+        """
+        await self.sync_webhook_activity()
+
+        folders: list[tuple[int, int, str]] = []  # (mailbox_id, folder_id, folder_code)
+        for mailbox_id, _ in await ref_cache.active_mailboxes_for():
+            for fid, code, _ in await ref_cache.monitored_folders_for(mailbox_id):
+                folders.append((mailbox_id, fid, code))
+
+        # Multi-instancia: solo las carpetas con lease de esta instancia (las demás las agenda su dueño).
+        # Las carpetas de buzones con corrida en curso no se sueltan hasta que termine.
+        busy = {delta_lease(fs.mailbox_id, fid) for fid, fs in self._folders.items() if fs.mailbox_id in self._running}
+        owned = await work_leases.balance(
+            [delta_lease(mid, fid) for mid, fid, _ in folders], prefix="delta:", busy=busy
+        )
+        self._sync_folders([f for f in folders if delta_lease(f[0], f[1]) in owned])
+        await self.sync_run_requests()
+
+        now = time.monotonic()
+        due: dict[int, set[int]] = {}
+        due_since: dict[int, float] = {}
+        for fid, fs in self._folders.items():
+            if fs.mailbox_id in self._running:
+                continue  # su corrida sigue; lo que venza entra en la próxima
+            at = self._due_at(fs)
+            if at <= now:
+                due.setdefault(fs.mailbox_id, set()).add(fid)
+                due_since[fs.mailbox_id] = min(at, due_since.get(fs.mailbox_id, at))
+
+        free = self.mailbox_concurrency - len(self._running)
+        if not due or free <= 0:
+            return None
+
+        # Lo vencido hace más tiempo primero: con el cupo lleno ningún buzón queda siempre atrás
+        started = sorted(due, key=lambda mid: due_since[mid])[:free]
+        for mid in started:
+            self._running[mid] = asyncio.create_task(self._run_mailbox(mid, due[mid]), name=f"delta_mailbox_{mid}")
+        return {"started": {mid: sorted(due[mid]) for mid in started}, "running": sorted(self._running)}
+
+    async def _run_mailbox(self, mailbox_id: int, folder_ids: set[int]) -> None:
+        try:
+            email = await ref_cache.mailbox_email_for(mailbox_id)
+            res = await run_delta_backstop(mailbox_email=email, folder_ids=folder_ids)
+            results = res.get("folders") or []
+            for r in results:
+                fs = self._folders.get(int(r.get("folder_id") or 0))
+                if fs is not None:
+                    self._after_run(fs, r)
+            logger.info(
+                "Delta run | mailbox=%s | folders_ok=%s/%s | processed_messages=%s | new_messages=%s",
+                email,
+                sum(1 for r in results if r.get("ok")),
+                len(results),
+                sum(int(r.get("processed_messages") or 0) for r in results),
+                sum(int(r.get("new_messages") or 0) for r in results),
+            )
+        except Exception as e:
+            logger.exception("Delta run failed mailbox_id=%s err=%s", mailbox_id, e)
+            for fid in folder_ids:
+                fs = self._folders.get(fid)
+                if fs is not None:
+                    self._after_run(fs, {"ok": False})
+        finally:
+            self._running.pop(mailbox_id, None)
+            self._get_wakeup().set()
+
+    async def stop(self) -> None:
+        """
+        Shutdown / pérdida del liderazgo: cancela las corridas en curso
+        (cada carpeta flushea su checkpoint al cancelarse).
+        """
+        tasks = list(self._running.values())
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._running.clear()
+
+    def snapshot(self) -> dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "webhook_silence_seconds": int(self.webhook_silence_seconds()),
+            "leases": work_leases.snapshot(),
+            "running_mailboxes": sorted(self._running),
+            "folders": [
+                {
+                    "mailbox_id": fs.mailbox_id,
+                    "folder_id": fs.folder_id,
+                    "folder_code": fs.folder_code,
+                    "interval_seconds": int(fs.interval),
+                    "due_in_seconds": int(max(0.0, self._due_at(fs) - now)),
+                    "change_rate_per_min": round(fs.change_rate, 3),
+                    "webhook_silence_seconds": int(self.webhook_silence_seconds(fs.mailbox_id)),
+                    "webhook_suspect": self._webhook_suspect(fs),
+                    "last_new": fs.last_new,
+                    "last_duplicates": fs.last_duplicates,
+                }
+                for fs in self._folders.values()
+            ],
+        }
+
+
+delta_scheduler = DeltaScheduler()
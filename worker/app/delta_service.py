@@ -2,21 +2,17 @@ from __future__ import annotations
 
 import asyncio
 import logging
-from datetime import datetime, timezone
-from typing import Any, Iterable
+from typing import Any, Callable, Iterable
 
 from app.settings import settings
-from app.db import get_db_session
+from app.db import run_db
 from app.graph_client import graph_client
-from app import repos, sync_service
+from app import repos, ref_cache, sync_service
+from app.delta_checkpoint import DeltaCheckpoint, delta_checkpoints
 
 logger = logging.getLogger("app.delta_service")
 
 
-def utcnow() -> datetime:
-    return datetime.now(timezone.utc).replace(tzinfo=None)
-
-
 def _is_removed(item: dict[str, Any]) -> bool:
     # Delta puede traer "deleted" con @removed
     return isinstance(item, dict) and ("@removed" in item)
@@ -29,6 +25,18 @@ def _safe_json(resp) -> dict[str, Any]:
         return {"raw": getattr(resp, "text", "")}
 
 
+_delta_table_ready = False
+
+
+async def _ensure_delta_table() -> None:
+    global _delta_table_ready
+    if _delta_table_ready:
+        return
+    if hasattr(repos, "ensure_graph_delta_state_table"):
+        await run_db(repos.ensure_graph_delta_state_table)
+    _delta_table_ready = True
+
+
 def _unpack_delta_state(st: Any) -> tuple[str | None, str | None]:
     """
     Tu repos.get_delta_state puede devolver:
@@ -59,6 +67,42 @@ def _unpack_delta_state(st: Any) -> tuple[str | None, str | None]:
         return None, None
 
 
+def _unpack_page_offset(st: Any) -> int:
+    """
+    page_offset viene al final de get_delta_state (tablas viejas sin la columna: 0).
+    """
+    try:
+        return max(0, int(st[5] or 0)) if st and len(st) > 5 else 0
+    except Exception:
+        return 0
+
+
+class _PageProgress:
+    """
+    Prefijo contiguo de ítems ya procesados de una página delta
+    (los mensajes terminan en desorden porque los chunks corren en paralelo).
+    item_ids: id por posición; None = ítem sin mensaje (removed / inválido), cuenta como hecho.
+    """
+
+    def __init__(self, item_ids: list[str | None], *, start: int = 0) -> None:
+        self._ids = item_ids
+        self._done: set[str] = set()
+        self.offset = start
+        self._advance()
+
+    def mark(self, message_ids: list[str]) -> int:
+        self._done.update(message_ids)
+        self._advance()
+        return self.offset
+
+    def _advance(self) -> None:
+        while self.offset < len(self._ids):
+            mid = self._ids[self.offset]
+            if mid is not None and mid not in self._done:
+                break
+            self.offset += 1
+
+
 def _iter_folders(folders: Any) -> Iterable[tuple[int, str, str | None]]:
     """
     Soporta:
@@ -86,46 +130,111 @@ def _iter_folders(folders: Any) -> Iterable[tuple[int, str, str | None]]:
     return out
 
 
-async def run_delta_backstop(*, mailbox_email: str | None = None) -> dict[str, Any]:
+async def run_delta_backstop(
+    *,
+    mailbox_email: str | None = None,
+    folder_ids: set[int] | None = None,
+) -> dict[str, Any]:
     """
-    Ejecuta delta para todas las carpetas monitoreadas del mailbox.
+    Ejecuta delta para las carpetas monitoreadas del mailbox
+    (todas, o solo folder_ids si viene: lo usa delta_scheduler).
     Guarda deltaLink/nextLink en DB.
     """
-    mb = mailbox_email or settings.MAILBOX_EMAIL
-    if not mb:
-        return {"ok": False, "error": "MAILBOX_EMAIL is required"}
-
-    results: list[dict[str, Any]] = []
-
-    with get_db_session() as db:
-        mailbox_id = repos.get_or_create_mailbox(db, mb)
-        # safe-guard (si ya la creaste manual, no hace daño)
-        if hasattr(repos, "ensure_graph_delta_state_table"):
-            repos.ensure_graph_delta_state_table(db)
-        folders_raw = repos.list_monitored_folders(db, mailbox_id=mailbox_id)
+    if mailbox_email:
+        mb = mailbox_email
+        mailbox_id = await ref_cache.mailbox_id_for(mb)
+    else:
+        try:
+            mailbox_id = await ref_cache.default_mailbox_id()
+        except RuntimeError as e:
+            return {"ok": False, "error": str(e)}
+        mb = await ref_cache.mailbox_email_for(mailbox_id)
+    # safe-guard (si ya la creaste manual, no hace daño) - una vez por proceso
+    await _ensure_delta_table()
+    folders_raw = await ref_cache.monitored_folders_for(mailbox_id)
 
     folders = list(_iter_folders(folders_raw))
+    if folder_ids is not None:
+        folders = [f for f in folders if f[0] in folder_ids]
 
     if not folders:
         return {"ok": True, "mailbox": mb, "note": "No monitored folders in mailbox_folders", "folders": []}
 
-    for folder_id, folder_code, graph_folder_id in folders:
-        try:
-            r = await _run_delta_for_folder(
-                mailbox_email=mb,
-                mailbox_id=mailbox_id,
-                folder_id=folder_id,
-                folder_code=folder_code,
-                graph_folder_id=graph_folder_id,
-            )
-            results.append(r)
-        except Exception as e:
-            logger.exception("Delta failed folder_id=%s code=%s err=%s", folder_id, folder_code, e)
-            results.append({"folder_id": folder_id, "folder_code": folder_code, "ok": False, "error": str(e)})
+    # Carpetas en paralelo (acotado); Graph/DB siguen bajo graph_throttle + ingest_slots
+    folder_slots = asyncio.Semaphore(max(1, int(getattr(settings, "DELTA_FOLDER_CONCURRENCY", 3))))
+
+    async def _one(folder_id: int, folder_code: str, graph_folder_id: str | None) -> dict[str, Any]:
+        async with folder_slots:
+            try:
+                return await _run_delta_for_folder(
+                    mailbox_email=mb,
+                    mailbox_id=mailbox_id,
+                    folder_id=folder_id,
+                    folder_code=folder_code,
+                    graph_folder_id=graph_folder_id,
+                )
+            except Exception as e:
+                logger.exception("Delta failed folder_id=%s code=%s err=%s", folder_id, folder_code, e)
+                return {"folder_id": folder_id, "folder_code": folder_code, "ok": False, "error": str(e)}
+
+    results = list(await asyncio.gather(*[_one(*f) for f in folders]))
 
     return {"ok": True, "mailbox": mb, "folders": results}
 
 
+async def run_delta_all_mailboxes(
+    *,
+    folder_ids: dict[int, set[int]] | None = None,
+) -> dict[str, Any]:
+    """
+    Delta de todos los buzones activos, DELTA_MAILBOX_CONCURRENCY a la vez.
+    folder_ids: {mailbox_id: carpetas} para correr solo esas (delta_scheduler);
+    los buzones que no aparecen no se corren.
+    """
+    active = await ref_cache.active_mailboxes_for()
+    if folder_ids is not None:
+        active = [(mid, email) for mid, email in active if folder_ids.get(mid)]
+    mailbox_slots = asyncio.Semaphore(max(1, int(settings.DELTA_MAILBOX_CONCURRENCY)))
+
+    async def _one(mailbox_id: int, email: str) -> dict[str, Any]:
+        async with mailbox_slots:
+            try:
+                return await run_delta_backstop(
+                    mailbox_email=email,
+                    folder_ids=(folder_ids[mailbox_id] if folder_ids is not None else None),
+                )
+            except Exception as e:
+                logger.exception("Delta failed mailbox=%s err=%s", email, e)
+                return {"ok": False, "mailbox": email, "error": str(e), "folders": []}
+
+    results = list(await asyncio.gather(*[_one(mid, email) for mid, email in active]))
+    return {"ok": all(r.get("ok") for r in results), "mailboxes": results}
+
+
+async def _fetch_delta_page(
+    *,
+    url: str | None,
+    mailbox_email: str,
+    folder_code: str,
+    graph_folder_id: str | None,
+    page_size: int,
+) -> tuple[int, dict[str, Any]]:
+    if url:
+        # Necesitamos el status para manejar 410 (delta expirado)
+        resp = await graph_client._request("GET", url)  # usa auth+retries del cliente
+        return resp.status_code, _safe_json(resp)
+
+    # Primera vez: construye delta “inicial” con el helper del graph_client
+    return await graph_client.messages_delta_page(
+        mailbox_email=mailbox_email,
+        folder_code=folder_code,
+        graph_folder_id=graph_folder_id,
+        url=None,
+        page_size=page_size,
+        full=bool(int(getattr(settings, "DELTA_FULL_PAYLOAD", 1))),
+    )
+
+
 async def _run_delta_for_folder(
     *,
     mailbox_email: str,
@@ -138,144 +247,188 @@ async def _run_delta_for_folder(
     page_size = int(getattr(settings, "DELTA_PAGE_SIZE", 50))
     max_pages = int(getattr(settings, "DELTA_MAX_PAGES_PER_RUN", getattr(settings, "DELTA_MAX_PAGES", 50)))
     max_messages = int(getattr(settings, "DELTA_MAX_MESSAGES", 500))
+    prefetch = max(1, int(getattr(settings, "DELTA_PREFETCH_PAGES", 1)))
+    checkpoint_seconds = max(1, int(settings.DELTA_CHECKPOINT_EVERY_SECONDS))
 
-    # 1) Load state (delta_link / next_link)
-    with get_db_session() as db:
-        st = repos.get_delta_state(db, mailbox_id=mailbox_id, folder_id=folder_id)
+    # 1) Load state (delta_link / next_link / page_offset) -> checkpoint en memoria (write-behind)
+    st = await run_db(repos.get_delta_state, mailbox_id=mailbox_id, folder_id=folder_id)
 
     delta_link, next_link = _unpack_delta_state(st)
+    # Offset solo si se reanuda una página nextLink (ver DeltaCheckpoint)
+    resume_offset = _unpack_page_offset(st) if next_link else 0
+    cp = delta_checkpoints.open(
+        DeltaCheckpoint(
+            mailbox_id=mailbox_id,
+            folder_id=folder_id,
+            delta_link=delta_link,
+            next_link=next_link,
+            page_offset=resume_offset,
+        )
+    )
 
     # 2) Decide URL inicial:
     #    resume paging (next_link) > delta_link > initial delta query
-    url = next_link or delta_link  # si quedó a mitad de paginación, next_link manda
+    url = cp.resume_url  # si quedó a mitad de paginación, next_link manda
+
+    # 3) Productor: pide la página siguiente (nextLink) mientras el consumidor procesa la actual.
+    #    La cola acotada limita cuántas páginas quedan en memoria por adelantado.
+    #    Items: (status, data, url_pedida) | (None, excepción, url_pedida) | None = fin
+    queue: asyncio.Queue = asyncio.Queue(maxsize=prefetch)
+
+    async def _produce() -> None:
+        page_url = url
+        try:
+            for _ in range(max_pages):
+                status, data = await _fetch_delta_page(
+                    url=page_url,
+                    mailbox_email=mailbox_email,
+                    folder_code=folder_code,
+                    graph_folder_id=graph_folder_id,
+                    page_size=page_size,
+                )
+                await queue.put((status, data, page_url))
+                new_next = data.get("@odata.nextLink") if status == 200 else None
+                if not new_next:
+                    break
+                page_url = str(new_next)
+        except Exception as e:
+            await queue.put((None, e, page_url))
+        await queue.put(None)
+
+    producer = asyncio.create_task(_produce(), name=f"delta_prefetch_{folder_id}")
 
     pages = 0
     total_items = 0
     processed_messages = 0
     finished = False
+    ingest_stats: dict[str, int] = {"new": 0, "duplicates": 0}
 
-    while True:
-        if pages >= max_pages:
-            break
-        if processed_messages >= max_messages:
-            break
-
-        pages += 1
-
-        # 3) GET delta page
-        status: int
-        data: dict[str, Any]
-
-        if url:
-            # Necesitamos el status para manejar 410 (delta expirado)
-            resp = await graph_client._request("GET", url)  # usa auth+retries del cliente
-            status = resp.status_code
-            data = _safe_json(resp)
-        else:
-            # Primera vez: construye delta “inicial” con el helper del graph_client
-            status, data = await graph_client.messages_delta_page(
-                mailbox_email=mailbox_email,
-                folder_code=folder_code,
-                graph_folder_id=graph_folder_id,
-                url=None,
-                page_size=page_size,
-            )
-
-        # 4) Manejo delta expirado (410)
-        if status == 410:
-            with get_db_session() as db:
-                repos.reset_delta_state(
-                    db,
+    try:
+        while True:
+            page = await queue.get()
+            if page is None:
+                break  # max_pages alcanzado
+            status, data, page_url = page
+            if status is None:
+                raise data
+
+            pages += 1
+
+            # 4) Manejo delta expirado (410)
+            if status == 410:
+                cp.discard()
+                await run_db(
+                    repos.reset_delta_state,
                     mailbox_id=mailbox_id,
                     folder_id=folder_id,
                     note="deltaLink expired (410) reset",
                 )
-            return {
-                "folder_id": folder_id,
-                "folder_code": folder_code,
-                "ok": True,
-                "action": "reset",
-                "status": 410,
-                "note": "deltaLink expired; reset done; run again.",
-            }
-
-        # 5) Otros errores
-        if status != 200:
-            err = str(data)[:500]
-            with get_db_session() as db:
-                repos.upsert_delta_state(
-                    db,
-                    mailbox_id=mailbox_id,
-                    folder_id=folder_id,
-                    delta_link=delta_link,
-                    next_link=url,  # dejamos dónde iba para reintentar
-                    last_sync_at=utcnow(),
-                    last_status_code=status,
-                    last_error=err,
-                )
-            return {
-                "folder_id": folder_id,
-                "folder_code": folder_code,
-                "ok": False,
-                "status": status,
-                "error": err,
-                "pages": pages,
-                "total_items": total_items,
-                "processed_messages": processed_messages,
-                "finished": False,
-            }
-
-        items = data.get("value") or []
-        if not isinstance(items, list):
-            items = []
-
-        total_items += len(items)
-
-        # 6) Extraer message ids (skip removed)
-        msg_ids: list[str] = []
-        for it in items:
-            if not isinstance(it, dict):
-                continue
-            if _is_removed(it):
-                continue
-            mid = it.get("id")
-            if mid:
+                return {
+                    "folder_id": folder_id,
+                    "folder_code": folder_code,
+                    "ok": True,
+                    "action": "reset",
+                    "status": 410,
+                    "note": "deltaLink expired; reset done; run again.",
+                }
+
+            # 5) Otros errores
+            if status != 200:
+                err = str(data)[:500]
+                # el checkpoint ya apunta a esta página (dónde iba) para reintentar
+                await cp.flush(status_code=status, error=err)
+                return {
+                    "folder_id": folder_id,
+                    "folder_code": folder_code,
+                    "ok": False,
+                    "status": status,
+                    "error": err,
+                    "pages": pages,
+                    "total_items": total_items,
+                    "processed_messages": processed_messages,
+                    "new_messages": ingest_stats["new"],
+                    "duplicates": ingest_stats["duplicates"],
+                    "finished": False,
+                }
+
+            items = data.get("value") or []
+            if not isinstance(items, list):
+                items = []
+
+            total_items += len(items)
+
+            # Reanudación a mitad de página: los primeros `skip` ítems ya se procesaron
+            skip = min(resume_offset, len(items)) if pages == 1 else 0
+            cp.start_page(page_url, offset=skip)
+
+            # 6) Extraer message ids (skip removed)
+            #    Si el delta trae el payload completo, lo guardamos para no repetir el GET
+            item_ids: list[str | None] = []
+            msg_ids: list[str] = []
+            full_items: dict[str, dict[str, Any]] = {}
+            for pos, it in enumerate(items):
+                mid = it.get("id") if isinstance(it, dict) and not _is_removed(it) else None
+                item_ids.append(str(mid) if mid else None)
+                if not mid or pos < skip:
+                    continue
                 msg_ids.append(str(mid))
-
-        # 7) Procesar ids (reusa pipeline real: dedupe + cases + attachments)
-        if msg_ids:
-            processed_ok = await _process_message_ids(msg_ids)
-            processed_messages += processed_ok
-
-        # 8) Links
-        new_next = data.get("@odata.nextLink")
-        new_delta = data.get("@odata.deltaLink")
-
-        if new_delta:
-            delta_link = str(new_delta)
-
-        next_link = str(new_next) if new_next else None
-
-        # 9) Persist state after every page
-        with get_db_session() as db:
-            repos.upsert_delta_state(
-                db,
-                mailbox_id=mailbox_id,
-                folder_id=folder_id,
-                delta_link=(delta_link if delta_link else None),
-                next_link=(next_link if next_link else None),
-                last_sync_at=utcnow(),
-                last_status_code=200,
-                last_error=None,
-            )
-
-        # 10) Continuar o terminar
-        if next_link:
-            url = next_link
-            continue
-
-        finished = True
-        break
+                if sync_service.is_full_message(it):
+                    full_items[str(mid)] = it
+
+            # 7) Procesar ids (reusa pipeline real: dedupe + cases + attachments)
+            #    con avance por mensaje en el checkpoint (flush por tiempo durante la página)
+            if msg_ids:
+                tracker = _PageProgress(item_ids, start=skip)
+                work = asyncio.create_task(
+                    _process_message_ids(
+                        msg_ids,
+                        mailbox_id=mailbox_id,
+                        prefetched=full_items,
+                        stats=ingest_stats,
+                        on_progress=lambda ids: cp.progress(tracker.mark(ids)),
+                    )
+                )
+                try:
+                    while not work.done():
+                        await asyncio.wait({work}, timeout=checkpoint_seconds)
+                        if not work.done():
+                            await cp.maybe_flush()
+                finally:
+                    if not work.done():
+                        work.cancel()
+                        await asyncio.gather(work, return_exceptions=True)
+                processed_messages += work.result()
+
+            # 8) Links
+            new_next = data.get("@odata.nextLink")
+            new_delta = data.get("@odata.deltaLink")
+
+            next_link = str(new_next) if new_next else None
+
+            # 9) Checkpoint (solo páginas ya procesadas); a DB cada N páginas / T segundos
+            cp.end_page(delta_link=(str(new_delta) if new_delta else None), next_link=next_link)
+            await cp.maybe_flush()
+
+            # 10) Continuar o terminar
+            if not next_link:
+                finished = True
+                break
+            if cp.lease_lost:
+                break  # otra instancia tomó la carpeta: sigue ella desde su estado
+            if processed_messages >= max_messages:
+                break
+    except Exception as e:
+        await cp.flush(status_code=None, error=f"{type(e).__name__}: {e}"[:500])
+        raise
+    finally:
+        # Páginas pre-cargadas y no procesadas se descartan: el estado apunta a la siguiente
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        # fin de corrida / cancelación (shutdown): lo pendiente va a DB ya
+        try:
+            await cp.flush()
+        finally:
+            delta_checkpoints.close(cp)
 
     return {
         "folder_id": folder_id,
@@ -284,31 +437,37 @@ async def _run_delta_for_folder(
         "pages": pages,
         "total_items": total_items,
         "processed_messages": processed_messages,
+        "new_messages": ingest_stats["new"],
+        "duplicates": ingest_stats["duplicates"],
         "finished": bool(finished),
         "note": ("stopped_by_limits" if not finished else None),
     }
 
 
-async def _process_message_ids(message_ids: list[str]) -> int:
+async def _process_message_ids(
+    message_ids: list[str],
+    *,
+    mailbox_id: int,
+    prefetched: dict[str, dict[str, Any]] | None = None,
+    stats: dict[str, int] | None = None,
+    on_progress: Callable[[list[str]], None] | None = None,
+) -> int:
     """
-    Concurrency control para no saturar Graph/DB.
-    Retorna cuántos se intentaron procesar (ok contabilizados).
+    Concurrency control para no saturar Graph/DB: hasta DELTA_CONCURRENCY chunks
+    de esta página en paralelo, dentro del presupuesto global (ingest_slots)
+    que comparte con el webhook.
+    Los que ya vienen completos en `prefetched` no se vuelven a pedir.
+    Retorna cuántos se procesaron OK.
     """
-    concurrency = int(getattr(settings, "DELTA_CONCURRENCY", 3))
-    sem = asyncio.Semaphore(concurrency)
-
-    ok_count = 0
-
-    async def _one(mid: str) -> None:
-        nonlocal ok_count
-        async with sem:
-            try:
-                # IMPORTANTE: este método debe existir en tu sync_service
-                # (tú ya lo estás usando y te funcionó con 50 mensajes)
-                await sync_service.process_message_id_async(mid)
-                ok_count += 1
-            except Exception:
-                logger.exception("Delta processing failed message_id=%s", mid)
-
-    await asyncio.gather(*[_one(m) for m in message_ids])
-    return ok_count
+    try:
+        return await sync_service.process_message_ids_async(
+            message_ids,
+            mailbox_id=mailbox_id,
+            prefetched=prefetched,
+            max_parallel=int(getattr(settings, "DELTA_CONCURRENCY", 3)),
+            stats=stats,
+            on_progress=on_progress,
+        )
+    except Exception:
+        logger.exception("Delta processing failed message_ids=%s", len(message_ids))
+        return 0
@@ -1,9 +1,11 @@
 from __future__ import annotations
 import asyncio
 import logging
-from typing import Any
+from typing import Any, AsyncIterator
 import httpx
 from app.auth_graph import graph_auth
+from app.graph_throttle import graph_throttle
+from app.settings import settings
 import json
 
 
@@ -19,10 +21,117 @@ FOLDER_CODE_TO_GRAPH = {
     "JUNK": "JunkEmail",
 }
 
+# OJO:
+# - NO existe "inReplyTo" en Graph v1.0 => NO lo selecciones
+# - Si necesitas "In-Reply-To", viene como header dentro de internetMessageHeaders
+MESSAGE_SELECT_FIELDS = [
+    "id",
+    "subject",
+    "receivedDateTime",
+    "sentDateTime",
+    "from",
+    "toRecipients",
+    "ccRecipients",
+    "bccRecipients",
+    "replyTo",
+    "body",
+    "internetMessageId",
+    "internetMessageHeaders",  # ✅ para leer In-Reply-To desde headers
+    "conversationId",
+    "hasAttachments",
+]
+
+# Metadata de adjuntos SIN contentBytes (el contenido se baja por /$value)
+# contentId es propiedad de fileAttachment, no del tipo base attachment: en $select va con cast
+# (sin cast Graph puede responder 400 para todo el listado). La respuesta la trae como "contentId".
+ATTACHMENT_META_FIELDS = ["id", "name", "contentType", "size", "isInline", "microsoft.graph.fileAttachment/contentId"]
+
+# Límite duro de Graph JSON batching
+GRAPH_BATCH_MAX = 20
+
+
+def _accept_encoding() -> str:
+    """
+    httpx solo descomprime br si hay decoder instalado (brotli/brotlicffi).
+    No anunciamos br si no lo podemos leer.
+    """
+    try:
+        import brotli  # noqa: F401
+        return "gzip, deflate, br"
+    except ImportError:
+        pass
+    try:
+        import brotlicffi  # noqa: F401
+        return "gzip, deflate, br"
+    except ImportError:
+        return "gzip, deflate"
+
+
+class GraphSubscriptionNotFound(RuntimeError):
+    """
+    404 sobre /subscriptions/{id}: Graph ya no tiene la suscripción (vencida / eliminada).
+    """
+
 
 class GraphClient:
     def __init__(self) -> None:
-        self._timeout = 60
+        self._timeout = int(settings.GRAPH_HTTP_TIMEOUT_SECONDS)
+        self._client: httpx.AsyncClient | None = None
+
+    # ============================================================
+    # Cliente HTTP compartido (keep-alive + HTTP/2)
+    # ============================================================
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(
+            max_connections=int(settings.GRAPH_POOL_MAX_CONNECTIONS),
+            max_keepalive_connections=int(settings.GRAPH_POOL_MAX_KEEPALIVE),
+            keepalive_expiry=float(settings.GRAPH_POOL_KEEPALIVE_EXPIRY_SECONDS),
+        )
+        kwargs: dict[str, Any] = {
+            "limits": limits,
+            "timeout": self._timeout,
+            "headers": {"Accept-Encoding": _accept_encoding()},
+        }
+
+        if settings.GRAPH_HTTP2:
+            try:
+                return httpx.AsyncClient(http2=True, **kwargs)
+            except ImportError:
+                # http2 requiere el extra httpx[http2] (paquete h2)
+                logger.warning("GraphClient: h2 not installed - falling back to HTTP/1.1")
+
+        return httpx.AsyncClient(**kwargs)
+
+    async def open(self) -> None:
+        """
+        Abre el cliente compartido. Se llama en FastAPI startup.
+        """
+        if self._client is not None and not self._client.is_closed:
+            return
+        self._client = self._build_client()
+        logger.info(
+            "GraphClient opened | http2=%s | max_connections=%s | keepalive=%s",
+            bool(settings.GRAPH_HTTP2),
+            settings.GRAPH_POOL_MAX_CONNECTIONS,
+            settings.GRAPH_POOL_MAX_KEEPALIVE,
+        )
+
+    async def close(self) -> None:
+        """
+        Cierra el pool. Se llama en FastAPI shutdown.
+        """
+        client = self._client
+        self._client = None
+        if client is not None and not client.is_closed:
+            await client.aclose()
+            logger.info("GraphClient closed")
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Fallback perezoso (scripts/CLI que no pasan por el startup de FastAPI)
+        if self._client is None or self._client.is_closed:
+            self._client = self._build_client()
+        return self._client
 
     async def _headers(self) -> dict[str, str]:
         token = await graph_auth.get_token()
@@ -31,27 +140,50 @@ class GraphClient:
             "Accept": "application/json",
         }
 
-    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+    async def _request(
+        self,
+        method: str,
+        url: str,
+        *,
+        cost: int = 1,
+        throttle_url: str | None = None,
+        **kwargs,
+    ) -> httpx.Response:
+        """
+        Request con reintentos, pasando por el coordinador de throttling del buzón
+        (graph_throttle). cost: tokens a consumir ($batch = nº de sub-requests).
+        throttle_url: URL que identifica el buzón cuando `url` no lo trae ($batch).
+        """
         headers = await self._headers()
         kwargs.setdefault("headers", headers)
         kwargs.setdefault("timeout", self._timeout)
 
-        async with httpx.AsyncClient() as client:
-            resp: httpx.Response | None = None
-            for attempt in range(1, 4):
+        client = self._get_client()
+        resp: httpx.Response | None = None
+        for attempt in range(1, 4):
+            async with graph_throttle.slot(throttle_url or url, cost) as mt:
                 resp = await client.request(method, url, **kwargs)
+                if mt is not None:
+                    mt.observe(resp.status_code, resp.headers.get("Retry-After"))
 
-                if resp.status_code in (429, 500, 502, 503, 504):
-                    retry_after = resp.headers.get("Retry-After")
-                    sleep_s = int(retry_after) if (retry_after and retry_after.isdigit()) else attempt * 2
+            if resp.status_code in (429, 500, 502, 503, 504):
+                retry_after = resp.headers.get("Retry-After")
+                if mt is not None and resp.status_code in (429, 503):
+                    # La pausa la impone el coordinador a TODOS los llamadores del buzón
                     logger.warning(
-                        "Graph retry %s %s status=%s sleep=%ss",
-                        method, url, resp.status_code, sleep_s
+                        "Graph retry %s %s status=%s retry_after=%s (throttle)",
+                        method, url, resp.status_code, retry_after
                     )
-                    await asyncio.sleep(sleep_s)
                     continue
+                sleep_s = int(retry_after) if (retry_after and retry_after.isdigit()) else attempt * 2
+                logger.warning(
+                    "Graph retry %s %s status=%s sleep=%ss",
+                    method, url, resp.status_code, sleep_s
+                )
+                await asyncio.sleep(sleep_s)
+                continue
 
-                return resp
+            return resp
 
         return resp  # type: ignore[return-value]
 
@@ -76,30 +208,7 @@ class GraphClient:
 
     async def get_message(self, mailbox_email: str, message_id: str) -> dict[str, Any]:
         url = f"{GRAPH_BASE}/users/{mailbox_email}/messages/{message_id}"
-
-        # OJO:
-        # - NO existe "inReplyTo" en Graph v1.0 => NO lo selecciones
-        # - Si necesitas "In-Reply-To", viene como header dentro de internetMessageHeaders
-        params = {
-            "$select": ",".join(
-                [
-                    "id",
-                    "subject",
-                    "receivedDateTime",
-                    "sentDateTime",
-                    "from",
-                    "toRecipients",
-                    "ccRecipients",
-                    "bccRecipients",
-                    "replyTo",
-                    "body",
-                    "internetMessageId",
-                    "internetMessageHeaders",  # ✅ para leer In-Reply-To desde headers
-                    "conversationId",
-                    "hasAttachments",
-                ]
-            )
-        }
+        params = {"$select": ",".join(MESSAGE_SELECT_FIELDS)}
 
         resp = await self._request("GET", url, params=params)
         if resp.status_code != 200:
@@ -107,13 +216,20 @@ class GraphClient:
             raise RuntimeError("Graph get_message failed")
         return resp.json()
 
-    async def list_attachments(self, mailbox_email: str, message_id: str) -> list[dict[str, Any]]:
+    async def list_attachments(
+        self,
+        mailbox_email: str,
+        message_id: str,
+        *,
+        metadata_only: bool = False,
+    ) -> list[dict[str, Any]]:
         url = f"{GRAPH_BASE}/users/{mailbox_email}/messages/{message_id}/attachments"
+        params = {"$select": ",".join(ATTACHMENT_META_FIELDS)} if metadata_only else None
 
         last_err: Exception | None = None
 
         for attempt in range(1, 4):
-            resp = await self._request("GET", url)
+            resp = await self._request("GET", url, params=params)
 
             if resp.status_code != 200:
                 logger.error("list_attachments failed: %s %s", resp.status_code, resp.text)
@@ -154,6 +270,175 @@ class GraphClient:
             raise RuntimeError("Graph get_attachment failed")
         return resp.json()
 
+    async def iter_attachment_value(
+        self,
+        mailbox_email: str,
+        message_id: str,
+        attachment_id: str,
+        *,
+        chunk_size: int = 256 * 1024,
+    ) -> AsyncIterator[bytes]:
+        """
+        Contenido crudo del adjunto vía /$value, en chunks (sin base64 ni JSON).
+        Si el consumidor deja de iterar (p.ej. tamaño excedido) el stream se cierra.
+        """
+        url = f"{GRAPH_BASE}/users/{mailbox_email}/messages/{message_id}/attachments/{attachment_id}/$value"
+        client = self._get_client()
+
+        for attempt in range(1, 4):
+            headers = await self._headers()
+            headers["Accept"] = "*/*"
+
+            async with (
+                graph_throttle.slot(url) as mt,
+                client.stream("GET", url, headers=headers, timeout=self._timeout) as resp,
+            ):
+                if mt is not None:
+                    mt.observe(resp.status_code, resp.headers.get("Retry-After"))
+
+                if resp.status_code in (429, 500, 502, 503, 504) and attempt < 3:
+                    retry_after = resp.headers.get("Retry-After")
+                    if mt is not None and resp.status_code in (429, 503):
+                        logger.warning("Graph retry GET %s status=%s (throttle)", url, resp.status_code)
+                        continue
+                    sleep_s = int(retry_after) if (retry_after and retry_after.isdigit()) else attempt * 2
+                    logger.warning(
+                        "Graph retry GET %s status=%s sleep=%ss",
+                        url, resp.status_code, sleep_s
+                    )
+                    await asyncio.sleep(sleep_s)
+                    continue
+
+                if resp.status_code != 200:
+                    body = await resp.aread()
+                    logger.error("attachment $value failed: %s %s", resp.status_code, body[:800])
+                    raise RuntimeError(f"Graph attachment $value failed status={resp.status_code}")
+
+                async for chunk in resp.aiter_bytes(chunk_size):
+                    yield chunk
+                return
+
+    # ============================
+    # JSON batching ($batch)
+    # ============================
+
+    async def batch(self, requests: list[dict[str, Any]], *, max_attempts: int = 4) -> list[dict[str, Any]]:
+        """
+        Empaqueta sub-requests en POST /$batch (máx 20 por llamada).
+
+        requests: [{"method": "GET", "url": "/users/.../messages/ID?$select=..."}]
+                  (url relativa a /v1.0)
+        Devuelve una respuesta por request, en el mismo orden:
+          {"status": int, "headers": {...}, "body": Any}
+
+        Los 429/503 se reintentan por sub-request (respetando Retry-After);
+        el resto de sub-requests del mismo batch no se repite.
+        """
+        results: list[dict[str, Any] | None] = [None] * len(requests)
+        pending = list(range(len(requests)))
+
+        for attempt in range(1, max_attempts + 1):
+            retry: list[int] = []
+            sleep_s = 0
+
+            for start in range(0, len(pending), GRAPH_BATCH_MAX):
+                chunk = pending[start : start + GRAPH_BATCH_MAX]
+                payload = {
+                    "requests": [
+                        {
+                            "id": str(i),
+                            "method": requests[i].get("method", "GET"),
+                            "url": requests[i]["url"],
+                            **({"headers": requests[i]["headers"]} if requests[i].get("headers") else {}),
+                            **({"body": requests[i]["body"]} if "body" in requests[i] else {}),
+                        }
+                        for i in chunk
+                    ]
+                }
+
+                resp = await self._request(
+                    "POST",
+                    f"{GRAPH_BASE}/$batch",
+                    json=payload,
+                    cost=len(chunk),
+                    throttle_url=requests[chunk[0]]["url"],
+                )
+                if resp.status_code != 200:
+                    logger.error("batch failed: %s %s", resp.status_code, resp.text[:800])
+                    raise RuntimeError(f"Graph batch failed status={resp.status_code}")
+
+                for sub in resp.json().get("responses") or []:
+                    try:
+                        i = int(sub.get("id"))
+                    except (TypeError, ValueError):
+                        continue
+                    status = int(sub.get("status") or 0)
+                    headers = sub.get("headers") or {}
+
+                    if status in (429, 503, 504) and attempt < max_attempts:
+                        ra = str(headers.get("Retry-After") or headers.get("retry-after") or "")
+                        sleep_s = max(sleep_s, int(ra) if ra.isdigit() else attempt * 2)
+                        retry.append(i)
+                        continue
+
+                    results[i] = {"status": status, "headers": headers, "body": sub.get("body")}
+
+            if not retry:
+                break
+
+            logger.warning("Graph batch retry sub_requests=%s sleep=%ss", len(retry), sleep_s)
+            if graph_throttle.enabled:
+                # pausa coordinada: el próximo slot() del buzón espera por todos
+                graph_throttle.for_url(requests[retry[0]]["url"]).throttle(float(sleep_s))
+            else:
+                await asyncio.sleep(sleep_s)
+            pending = sorted(retry)
+
+        return [r if r is not None else {"status": 0, "headers": {}, "body": None} for r in results]
+
+    async def get_messages_batch(self, mailbox_email: str, message_ids: list[str]) -> dict[str, dict[str, Any]]:
+        """
+        get_message para varios IDs vía $batch.
+        Devuelve {message_id: message}; los que fallen NO vienen (el caller
+        decide si cae al GET individual).
+        """
+        select = ",".join(MESSAGE_SELECT_FIELDS)
+        reqs = [
+            {"method": "GET", "url": f"/users/{mailbox_email}/messages/{mid}?$select={select}"}
+            for mid in message_ids
+        ]
+        out: dict[str, dict[str, Any]] = {}
+        for mid, r in zip(message_ids, await self.batch(reqs)):
+            if r["status"] == 200 and isinstance(r["body"], dict):
+                out[mid] = r["body"]
+            else:
+                logger.warning("get_messages_batch miss message_id=%s status=%s", mid, r["status"])
+        return out
+
+    async def list_attachments_batch(
+        self,
+        mailbox_email: str,
+        message_ids: list[str],
+        *,
+        metadata_only: bool = False,
+    ) -> dict[str, list[dict[str, Any]]]:
+        """
+        list_attachments para varios mensajes vía $batch.
+        Devuelve {message_id: [attachments]}; los que fallen NO vienen.
+        """
+        query = f"?$select={','.join(ATTACHMENT_META_FIELDS)}" if metadata_only else ""
+        reqs = [
+            {"method": "GET", "url": f"/users/{mailbox_email}/messages/{mid}/attachments{query}"}
+            for mid in message_ids
+        ]
+        out: dict[str, list[dict[str, Any]]] = {}
+        for mid, r in zip(message_ids, await self.batch(reqs)):
+            if r["status"] == 200 and isinstance(r["body"], dict):
+                out[mid] = r["body"].get("value") or []
+            else:
+                logger.warning("list_attachments_batch miss message_id=%s status=%s", mid, r["status"])
+        return out
+
     # ============================
     # Subscriptions (webhooks)
     # ============================
@@ -166,7 +451,13 @@ class GraphClient:
         resource: str,
         expiration_datetime_iso: str,
         client_state: str,
+        lifecycle_notification_url: str | None = None,
+        extra: dict[str, Any] | None = None,
     ) -> dict[str, Any]:
+        """
+        lifecycle_notification_url: solo se puede fijar al crear (Graph no lo acepta en PATCH).
+        extra: campos adicionales del POST (p.ej. includeResourceData + encryptionCertificate).
+        """
         url = f"{GRAPH_BASE}/subscriptions"
         payload = {
             "changeType": change_type,
@@ -175,7 +466,10 @@ class GraphClient:
             "expirationDateTime": expiration_datetime_iso,
             "clientState": client_state,
             "latestSupportedTlsVersion": "v1_2",
+            **(extra or {}),
         }
+        if lifecycle_notification_url:
+            payload["lifecycleNotificationUrl"] = lifecycle_notification_url
         resp = await self._request("POST", url, json=payload)
         if resp.status_code not in (200, 201):
             logger.error("create_subscription failed: %s %s", resp.status_code, resp.text)
@@ -186,9 +480,12 @@ class GraphClient:
         url = f"{GRAPH_BASE}/subscriptions/{subscription_id}"
         payload = {"expirationDateTime": expiration_datetime_iso}
         resp = await self._request("PATCH", url, json=payload)
+        if resp.status_code == 404:
+            logger.warning("renew_subscription: subscription not found id=%s", subscription_id)
+            raise GraphSubscriptionNotFound(f"Graph subscription {subscription_id} not found")
         if resp.status_code != 200:
             logger.error("renew_subscription failed: %s %s", resp.status_code, resp.text)
-            raise RuntimeError("Graph renew_subscription failed")
+            raise RuntimeError(f"Graph renew_subscription failed status={resp.status_code}")
         return resp.json()
 
     async def get_subscription(self, subscription_id: str) -> dict[str, Any]:
@@ -216,20 +513,26 @@ class GraphClient:
         graph_folder_id: str | None,
         url: str | None,
         page_size: int = 50,
+        full: bool = False,
     ) -> tuple[int, dict[str, Any]]:
         """
         Returns (status_code, json).
         If url is provided, it is used directly (nextLink/deltaLink).
         Otherwise starts a fresh delta query.
+
+        full=True selecciona los mismos campos que get_message (+ changeKey),
+        así cada item ya viene listo para persistir sin un segundo GET.
+        nextLink/deltaLink conservan el $select original.
         """
         if url:
             resp = await self._request("GET", url)
         else:
             folder_ref = self._folder_ref(folder_code=folder_code, graph_folder_id=graph_folder_id)
             delta_url = f"{GRAPH_BASE}/users/{mailbox_email}/mailFolders('{folder_ref}')/messages/delta"
+            select = ",".join(MESSAGE_SELECT_FIELDS + ["changeKey"]) if full else "id"  # id = delta minimalista
             params = {
                 "$top": str(int(page_size)),
-                "$select": "id",  # ✅ delta minimalista
+                "$select": select,
             }
             headers = await self._headers()
             headers["Prefer"] = f"odata.maxpagesize={int(page_size)}"
@@ -243,5 +546,41 @@ class GraphClient:
 
         return status, data
 
+    async def list_messages_window(
+        self,
+        *,
+        mailbox_email: str,
+        folder_code: str,
+        received_from_iso: str,
+        received_to_iso: str,
+        url: str | None = None,
+        page_size: int = 200,
+    ) -> tuple[int, dict[str, Any]]:
+        """
+        Backfill: mensajes de una carpeta con receivedDateTime en [from, to), del más
+        reciente al más antiguo, con el mismo $select que get_message (payload completo).
+        Si url viene (nextLink) se usa tal cual. Returns (status_code, json).
+        """
+        if url:
+            resp = await self._request("GET", url)
+        else:
+            folder_ref = self._folder_ref(folder_code=folder_code, graph_folder_id=None)
+            list_url = f"{GRAPH_BASE}/users/{mailbox_email}/mailFolders('{folder_ref}')/messages"
+            params = {
+                "$filter": f"receivedDateTime ge {received_from_iso} and receivedDateTime lt {received_to_iso}",
+                "$orderby": "receivedDateTime desc",
+                "$top": str(int(page_size)),
+                "$select": ",".join(MESSAGE_SELECT_FIELDS),
+            }
+            resp = await self._request("GET", list_url, params=params)
+
+        status = resp.status_code
+        try:
+            data = resp.json()
+        except Exception:
+            data = {"raw": resp.text}
+
+        return status, data
+
 
 graph_client = GraphClient()
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
+
+from app.settings import settings
+from app.concurrency import low_priority
+
+logger = logging.getLogger("app.graph_throttle")
+
+_USERS_RE = re.compile(r"/users/([^/?]+)", re.IGNORECASE)
+
+# Sin buzón en la URL (subscriptions, $batch vacío...): bucket compartido del tenant
+TENANT_KEY = "_tenant"
+
+
+def mailbox_key(url: str) -> str:
+    """
+    Buzón destino de una URL de Graph (/users/{mailbox}/...), en minúsculas.
+    """
+    m = _USERS_RE.search(url or "")
+    return m.group(1).lower() if m else TENANT_KEY
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class MailboxThrottle:
+    """
+    Coordinador de llamadas a Graph para UN buzón (compartido por todas las tareas del proceso):
+      - token bucket: GRAPH_RATE_PER_SECOND sostenido, ráfaga GRAPH_RATE_BURST
+        (un $batch cuesta 1 token por sub-request)
+      - pausa global: un Retry-After recibido por cualquiera frena a todos hasta que venza
+      - AIMD: el límite de requests en vuelo sube +1 por "ventana" sin throttling
+        y se multiplica por GRAPH_AIMD_DECREASE ante 429/503
+      - carril bajo (concurrency.low_priority, backfill): espera si hay llamadas normales
+        esperando, deja un slot de concurrencia y 1/4 del bucket libres para el tráfico en vivo
+    """
+
+    def __init__(
+        self,
+        key: str,
+        *,
+        rate: float,
+        burst: int,
+        initial: int,
+        min_limit: int,
+        max_limit: int,
+        decrease: float,
+    ) -> None:
+        self.key = key
+        self._rate = max(0.1, float(rate))
+        self._burst = max(1, int(burst))
+        self._min = max(1, int(min_limit))
+        self._max = max(self._min, int(max_limit))
+        self._decrease = min(0.95, max(0.1, float(decrease)))
+
+        self._limit = float(min(self._max, max(self._min, int(initial))))
+        self._tokens = float(self._burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._in_flight = 0
+        self._high_waiting = 0
+        self._cond = asyncio.Condition()
+
+        self.throttled = 0
+        self.requests = 0
+
+    @property
+    def limit(self) -> int:
+        return max(self._min, int(self._limit))
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self._burst, self._tokens + (now - self._refilled_at) * self._rate)
+        self._refilled_at = now
+
+    @asynccontextmanager
+    async def slot(self, cost: int = 1) -> AsyncIterator[None]:
+        cost = max(1, min(int(cost), self._burst))
+        low = low_priority.get()
+        # baja prioridad: necesita margen de tokens y de concurrencia
+        need = min(self._burst, cost + self._burst // 4) if low else cost
+        async with self._cond:
+            if not low:
+                self._high_waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    limit = max(1, self.limit - 1) if low else self.limit
+                    timeout: float | None
+                    if self._paused_until > now:
+                        timeout = self._paused_until - now
+                    elif self._in_flight >= limit or (low and self._high_waiting):
+                        timeout = None  # despierta al liberar un slot
+                    else:
+                        self._refill(now)
+                        if self._tokens >= need:
+                            self._tokens -= cost
+                            self._in_flight += 1
+                            break
+                        timeout = (need - self._tokens) / self._rate
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                if not low:
+                    self._high_waiting -= 1
+                    self._cond.notify_all()
+
+        self.requests += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def observe(self, status_code: int, retry_after: str | None = None) -> None:
+        """
+        Resultado de una llamada hecha con slot(). Síncrono: el notify lo hace la salida del slot.
+        """
+        if status_code in (429, 503):
+            self.throttle(parse_retry_after(retry_after))
+        elif status_code < 500:
+            # additive increase: ~+1 por cada `limit` respuestas OK
+            self._limit = min(float(self._max), self._limit + 1.0 / max(1.0, self._limit))
+
+    def throttle(self, retry_after_s: float | None) -> None:
+        """
+        Graph pidió frenar: pausa a todos los llamadores del buzón y baja la concurrencia.
+        Un mismo evento suele llegar en varias respuestas a la vez: solo un decrease por ventana.
+        """
+        now = time.monotonic()
+        pause = retry_after_s if retry_after_s is not None else 2.0
+        self.throttled += 1
+        self._paused_until = max(self._paused_until, now + pause)
+        self._tokens = 0.0
+        self._refilled_at = max(self._refilled_at, now + pause)
+
+        if now - self._last_decrease >= max(1.0, pause):
+            before = self.limit
+            self._limit = max(float(self._min), self._limit * self._decrease)
+            self._last_decrease = now
+            logger.warning(
+                "Graph throttled mailbox=%s pause=%.1fs concurrency %s -> %s",
+                self.key, pause, before, self.limit,
+            )
+
+    def snapshot(self) -> dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "concurrency_limit": self.limit,
+            "in_flight": self._in_flight,
+            "tokens": round(min(self._burst, self._tokens + max(0.0, now - self._refilled_at) * self._rate), 2),
+            "paused_seconds": round(max(0.0, self._paused_until - now), 2),
+            "requests": self.requests,
+            "throttled": self.throttled,
+        }
+
+
+class GraphThrottle:
+    """
+    Registro de MailboxThrottle por buzón (lazy).
+    GRAPH_THROTTLE_ENABLED=0 -> slot() no limita (solo se conservan los reintentos de _request).
+    """
+
+    def __init__(self) -> None:
+        self._mailboxes: dict[str, MailboxThrottle] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(settings.GRAPH_THROTTLE_ENABLED)
+
+    def for_url(self, url: str) -> MailboxThrottle:
+        key = mailbox_key(url)
+        mt = self._mailboxes.get(key)
+        if mt is None:
+            mt = MailboxThrottle(
+                key,
+                rate=settings.GRAPH_RATE_PER_SECOND,
+                burst=settings.GRAPH_RATE_BURST,
+                initial=settings.GRAPH_CONCURRENCY_INITIAL,
+                min_limit=settings.GRAPH_CONCURRENCY_MIN,
+                max_limit=settings.GRAPH_CONCURRENCY_MAX,
+                decrease=settings.GRAPH_AIMD_DECREASE,
+            )
+            self._mailboxes[key] = mt
+        return mt
+
+    @asynccontextmanager
+    async def slot(self, url: str, cost: int = 1) -> AsyncIterator[MailboxThrottle | None]:
+        if not self.enabled:
+            yield None
+            return
+        mt = self.for_url(url)
+        async with mt.slot(cost):
+            yield mt
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        return {k: v.snapshot() for k, v in self._mailboxes.items()}
+
+
+graph_throttle = GraphThrottle()
@@ -0,0 +1,12 @@
+from __future__ import annotations
+
+from fastapi import APIRouter, Request
+from app.admin_auth import require_admin_key
+from app.ingest_queue import webhook_inbox
+
+router = APIRouter()
+
+@router.get("/graph/inbox/stats")
+async def inbox_stats(request: Request) -> dict:
+    require_admin_key(request)
+    return await webhook_inbox.stats()
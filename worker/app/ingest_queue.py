@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Any
+
+from app.settings import settings
+from app.db import run_db
+from app import repos, sync_service
+
+logger = logging.getLogger("app.ingest_queue")
+
+
+class WebhookInbox:
+    """
+    Cola durable para notificaciones de Graph (tabla webhook_inbox).
+
+    - El webhook persiste el payload ANTES de responder 202 (enqueue).
+    - Un pool fijo de consumidores (INBOX_CONSUMERS) drena la tabla: nada de
+      create_task por POST, el trabajo en vuelo queda acotado.
+    - Filas PROCESSING de un worker caído se re-toman al vencer el lease.
+    - stop() deja de tomar filas, espera lo que está en vuelo y devuelve
+      a PENDING lo que no alcanzó a procesar.
+    """
+
+    def __init__(self) -> None:
+        self._owner = f"{settings.WORKER_INSTANCE_ID}:{os.getpid()}"
+        self._stop: asyncio.Event | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._table_ready = False
+
+        # métricas en memoria (backpressure)
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.last_lag_seconds = 0.0
+
+    # ============================
+    # Productor (webhook)
+    # ============================
+
+    async def _ensure_table(self) -> None:
+        if not self._table_ready:
+            await run_db(repos.ensure_webhook_inbox_table)
+            self._table_ready = True
+
+    async def enqueue(self, payload: dict[str, Any], *, lifecycle: bool = False) -> int:
+        """
+        lifecycle=True (missed / subscriptionRemoved / reauthorizationRequired): la fila va
+        sin subscription_id, así no cuenta como tráfico de webhook de esa suscripción
+        (webhook_inbox_last_received_by_subscription -> silencio por buzón del delta).
+        """
+        await self._ensure_table()
+        notifications = payload.get("value") or []
+        subs = {str(n.get("subscriptionId") or "") for n in notifications if isinstance(n, dict)}
+        inbox_id = await run_db(
+            repos.enqueue_webhook_payload,
+            payload=payload,
+            subscription_id=(next(iter(subs)) if len(subs) == 1 and not lifecycle else None),
+            notifications=len(notifications),
+        )
+        self.enqueued += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return inbox_id
+
+    # ============================
+    # Consumidores
+    # ============================
+
+    async def start(self) -> None:
+        if self._stop is not None:
+            return
+        await self._ensure_table()
+
+        self._stop = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        n = max(1, int(settings.INBOX_CONSUMERS))
+        self._tasks = [asyncio.create_task(self._consumer(i), name=f"inbox_consumer_{i}") for i in range(n)]
+        self._tasks.append(asyncio.create_task(self._housekeeping(), name="inbox_housekeeping"))
+        logger.warning("Webhook inbox started | consumers=%s | owner=%s", n, self._owner)
+
+    async def stop(self) -> None:
+        if self._stop is None:
+            return
+        self._stop.set()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+        timeout = int(settings.INBOX_DRAIN_TIMEOUT_SECONDS)
+        _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        logger.warning(
+            "Webhook inbox stopped | processed=%s | failed=%s | cancelled_consumers=%s",
+            self.processed, self.failed, len(pending),
+        )
+        self._tasks = []
+        self._stop = None
+        self._wakeup = None
+
+    async def _consumer(self, idx: int) -> None:
+        assert self._stop is not None and self._wakeup is not None
+        poll = max(1, int(settings.INBOX_POLL_SECONDS))
+
+        while not self._stop.is_set():
+            claim_token = f"{self._owner}:{idx}:{uuid.uuid4().hex[:8]}"
+            try:
+                rows = await run_db(
+                    repos.claim_webhook_inbox,
+                    claim_token=claim_token,
+                    limit=max(1, int(settings.INBOX_CLAIM_BATCH)),
+                    lease_seconds=int(settings.INBOX_LEASE_SECONDS),
+                )
+            except Exception as e:
+                logger.exception("Inbox claim failed: %s", e)
+                rows = []
+
+            if not rows:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=poll)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for pos, (inbox_id, payload, attempts) in enumerate(rows):
+                if self._stop.is_set():
+                    # shutdown: lo no procesado vuelve a la cola sin gastar intento
+                    leftover = [r[0] for r in rows[pos:]]
+                    await run_db(repos.release_webhook_inbox_claims, inbox_ids=leftover, claim_token=claim_token)
+                    break
+                # el lease corre desde el claim: las filas 2..N lo renuevan al empezar,
+                # si ya venció y otro consumidor la tomó, se deja
+                try:
+                    still_ours = await run_db(
+                        repos.renew_webhook_inbox_claim, inbox_id=inbox_id, claim_token=claim_token
+                    )
+                except Exception as e:
+                    logger.warning("Inbox claim renew failed id=%s err=%s", inbox_id, e)
+                    continue
+                if not still_ours:
+                    logger.warning("Inbox claim lost (lease expired) id=%s token=%s", inbox_id, claim_token)
+                    continue
+                await self._handle(inbox_id, payload, attempts, claim_token)
+
+    async def _handle(self, inbox_id: int, payload: dict[str, Any], attempts: int, claim_token: str) -> None:
+        self.in_flight += 1
+        started = time.monotonic()
+        try:
+            await sync_service.process_notifications_async(payload)
+            if not await run_db(repos.mark_webhook_inbox_done, inbox_id=inbox_id, claim_token=claim_token):
+                logger.warning("Inbox claim lost before done id=%s token=%s", inbox_id, claim_token)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            max_attempts = int(settings.INBOX_MAX_ATTEMPTS)
+            retry_in = None if attempts >= max_attempts else min(300, 2 ** attempts * 5)
+            logger.exception("Inbox item failed id=%s attempts=%s retry_in=%s err=%s", inbox_id, attempts, retry_in, e)
+            try:
+                marked = await run_db(
+                    repos.mark_webhook_inbox_failed,
+                    inbox_id=inbox_id,
+                    claim_token=claim_token,
+                    error=str(e),
+                    retry_in_seconds=retry_in,
+                )
+                if not marked:
+                    logger.warning("Inbox claim lost before fail id=%s token=%s", inbox_id, claim_token)
+            except Exception:
+                logger.exception("Inbox mark failed id=%s", inbox_id)
+        finally:
+            self.in_flight -= 1
+            self.last_lag_seconds = time.monotonic() - started
+
+    async def _housekeeping(self) -> None:
+        """
+        Métricas de backpressure en log + purga de filas DONE antiguas.
+        """
+        assert self._stop is not None
+        interval = max(10, int(settings.INBOX_METRICS_INTERVAL_SECONDS))
+
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+
+            try:
+                st = await self.stats()
+                level = logging.WARNING if st["pending"] >= int(settings.INBOX_HIGH_WATERMARK) else logging.INFO
+                logger.log(
+                    level,
+                    "Inbox | pending=%s | processing=%s | failed=%s | oldest_pending_s=%s | in_flight=%s | processed=%s",
+                    st["pending"], st["processing"], st["failed"], st["oldest_pending_seconds"],
+                    st["in_flight"], st["processed"],
+                )
+                await run_db(repos.purge_webhook_inbox, keep_days=int(settings.INBOX_KEEP_DAYS))
+            except Exception as e:
+                logger.warning("Inbox housekeeping failed: %s", e)
+
+    async def stats(self) -> dict[str, Any]:
+        await self._ensure_table()
+        db_stats = await run_db(repos.webhook_inbox_stats)
+        return {
+            **db_stats,
+            "consumers": len([t for t in self._tasks if t.get_name().startswith("inbox_consumer_")]),
+            "in_flight": self.in_flight,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed_attempts": self.failed,
+            "last_item_seconds": round(self.last_lag_seconds, 3),
+        }
+
+
+webhook_inbox = WebhookInbox()
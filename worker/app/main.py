@@ -10,7 +10,12 @@ from app.settings import settings
 from app.webhook import router as webhook_router
 from app.subscriptions_routes import router as subs_router
 from app.delta_routes import router as delta_router
+from app.cache_routes import router as cache_router
+from app.inbox_routes import router as inbox_router
+from app.graph_client import graph_client
+from app import ref_cache, sync_service
 from app.background_jobs import start_background_jobs, stop_background_jobs
+from app.backfill_service import backfill_runner
 
 logger = logging.getLogger("app.main")
 
@@ -32,11 +37,22 @@ def create_app() -> FastAPI:
             "worker/.env",
         )
 
+        await graph_client.open()
+        await ref_cache.warm()
+        # ALTERs de messages antes de que arranque la ingesta (no desde el hot path).
+        # Si la DB no responde, no bloquea el arranque: la ingesta lo re-chequea en el primer chunk.
+        try:
+            await sync_service.ensure_ingest_schema()
+        except Exception as e:
+            logger.warning("Ingest schema check failed at startup (will retry on first ingest): %s", e)
         await start_background_jobs()
 
     @app.on_event("shutdown")
     async def on_shutdown() -> None:
+        # Backfill: la ventana en curso vuelve a PENDING con su cursor
+        await backfill_runner.stop()
         await stop_background_jobs()
+        await graph_client.close()
 
     @app.get("/health")
     def health() -> dict:
@@ -45,6 +61,8 @@ def create_app() -> FastAPI:
     app.include_router(webhook_router)
     app.include_router(subs_router)
     app.include_router(delta_router)
+    app.include_router(cache_router)
+    app.include_router(inbox_router)
 
     return app
 
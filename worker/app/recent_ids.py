@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+
+from app.settings import settings
+
+
+class RecentIds:
+    """
+    LRU acotado de (mailbox_id, provider_message_id) ya ingestados por completo
+    (mensaje + adjuntos). Va delante del SELECT de dedupe en bloque.
+
+    Usamos LRU y no Bloom: un falso positivo de Bloom haría saltar un correo nuevo.
+    max_size=0 lo desactiva.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max(0, int(max_size))
+        self._items: OrderedDict[tuple[int, str], None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: tuple[int, str]) -> bool:
+        if not self._max_size:
+            return False
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return True
+            return False
+
+    def add(self, key: tuple[int, str]) -> None:
+        if not self._max_size:
+            return
+        with self._lock:
+            self._items[key] = None
+            self._items.move_to_end(key)
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+
+    def discard(self, key: tuple[int, str]) -> None:
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+recent_ids = RecentIds(settings.DEDUPE_CACHE_SIZE)
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import Callable, Generic, TypeVar
+
+from sqlalchemy.orm import Session
+
+from app.settings import settings
+from app.db import run_db
+from app import repos
+
+logger = logging.getLogger("app.ref_cache")
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class TtlCache(Generic[K, V]):
+    """
+    Cache en proceso con TTL e invalidación explícita.
+    Thread-safe (se usa desde el event loop y desde los threads del pool de DB).
+    """
+
+    def __init__(self, name: str, ttl_seconds: int) -> None:
+        self.name = name
+        self._ttl = max(1, int(ttl_seconds))
+        self._items: dict[K, tuple[float, V]] = {}
+        self._lock = threading.Lock()
+
+    def peek(self, key: K) -> V | None:
+        with self._lock:
+            hit = self._items.get(key)
+        if hit is None or hit[0] < time.monotonic():
+            return None
+        return hit[1]
+
+    def put(self, key: K, value: V) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic() + self._ttl, value)
+
+    def get_or_load(self, key: K, loader: Callable[[], V]) -> V:
+        value = self.peek(key)
+        if value is None:
+            value = loader()
+            self.put(key, value)
+        return value
+
+    def invalidate(self, key: K | None = None) -> None:
+        with self._lock:
+            if key is None:
+                self._items.clear()
+            else:
+                self._items.pop(key, None)
+
+
+_ttl = int(settings.REF_CACHE_TTL_SECONDS)
+
+mailboxes: TtlCache[str, int] = TtlCache("mailboxes", _ttl)  # email (lower) -> mailbox_id
+mailbox_emails: TtlCache[int, str] = TtlCache("mailbox_emails", _ttl)  # mailbox_id -> email
+active_mailboxes: TtlCache[str, list[tuple[int, str]]] = TtlCache("active_mailboxes", _ttl)  # "all" -> [(id, email)]
+subscription_mailboxes: TtlCache[str, int] = TtlCache("subscription_mailboxes", _ttl)  # subscription_id -> mailbox_id
+statuses: TtlCache[str, int] = TtlCache("case_statuses", _ttl)  # code -> status_id
+folders: TtlCache[int, list[tuple[int, str, str | None]]] = TtlCache("mailbox_folders", _ttl)  # mailbox_id -> folders
+system_config: TtlCache[str, dict[str, str]] = TtlCache("system_config", _ttl)  # "all" -> config
+
+
+# ============================================================
+# Acceso síncrono (dentro de una transacción / pool de DB)
+# ============================================================
+
+def get_mailbox_id(db: Session, email: str) -> int:
+    mailbox_id = mailboxes.get_or_load(email.strip().lower(), lambda: repos.get_or_create_mailbox(db, email))
+    if mailbox_emails.peek(mailbox_id) is None:
+        mailbox_emails.put(mailbox_id, email.strip())
+    return mailbox_id
+
+
+def get_mailbox_email(db: Session, mailbox_id: int) -> str:
+    return mailbox_emails.get_or_load(mailbox_id, lambda: repos.get_mailbox_email(db, mailbox_id))
+
+
+def get_active_mailboxes(db: Session) -> list[tuple[int, str]]:
+    def _load() -> list[tuple[int, str]]:
+        # MAILBOX_EMAIL (instalaciones de un solo buzón) se registra en mailboxes si falta
+        if settings.MAILBOX_EMAIL:
+            get_mailbox_id(db, settings.MAILBOX_EMAIL)
+        rows = repos.list_active_mailboxes(db)
+        for mailbox_id, email in rows:
+            mailboxes.put(email.strip().lower(), mailbox_id)
+            mailbox_emails.put(mailbox_id, email)
+        return rows
+
+    return active_mailboxes.get_or_load("all", _load)
+
+
+def get_status_id(db: Session, code: str) -> int:
+    return statuses.get_or_load(code, lambda: repos.get_status_id_by_code(db, code))
+
+
+def get_monitored_folders(db: Session, mailbox_id: int) -> list[tuple[int, str, str | None]]:
+    return folders.get_or_load(mailbox_id, lambda: repos.list_monitored_folders(db, mailbox_id=mailbox_id))
+
+
+def get_system_config(db: Session) -> dict[str, str]:
+    return system_config.get_or_load("all", lambda: repos.load_system_config(db))
+
+
+# ============================================================
+# Acceso async: en hit no hay salto de thread ni sesión
+# ============================================================
+
+async def mailbox_id_for(email: str) -> int:
+    hit = mailboxes.peek(email.strip().lower())
+    if hit is not None:
+        return hit
+    return await run_db(get_mailbox_id, email)
+
+
+async def mailbox_email_for(mailbox_id: int) -> str:
+    hit = mailbox_emails.peek(mailbox_id)
+    if hit is not None:
+        return hit
+    return await run_db(get_mailbox_email, mailbox_id)
+
+
+async def active_mailboxes_for() -> list[tuple[int, str]]:
+    """
+    Buzones activos (mailboxes.is_active = 1): [(mailbox_id, email)].
+    """
+    hit = active_mailboxes.peek("all")
+    if hit is not None:
+        return hit
+    return await run_db(get_active_mailboxes)
+
+
+async def default_mailbox_id() -> int:
+    """
+    Buzón para entradas sin mailbox explícito (rutas admin, notificaciones sin
+    suscripción conocida): MAILBOX_EMAIL, o el único activo.
+    """
+    if settings.MAILBOX_EMAIL:
+        return await mailbox_id_for(settings.MAILBOX_EMAIL)
+    active = await active_mailboxes_for()
+    if len(active) == 1:
+        return active[0][0]
+    raise RuntimeError(f"mailbox is required (MAILBOX_EMAIL not set, {len(active)} active mailboxes)")
+
+
+async def mailbox_for_subscription(subscription_id: str) -> int | None:
+    """
+    subscriptionId de Graph -> mailbox_id (graph_subscriptions). None si no se conoce.
+    """
+    hit = subscription_mailboxes.peek(subscription_id)
+    if hit is not None:
+        return hit
+    mailbox_id = await run_db(repos.get_subscription_mailbox_id, subscription_id=subscription_id)
+    if mailbox_id is not None:
+        subscription_mailboxes.put(subscription_id, mailbox_id)
+    return mailbox_id
+
+
+async def monitored_folders_for(mailbox_id: int) -> list[tuple[int, str, str | None]]:
+    hit = folders.peek(mailbox_id)
+    if hit is not None:
+        return hit
+    return await run_db(get_monitored_folders, mailbox_id)
+
+
+def invalidate_all() -> None:
+    for c in (mailboxes, mailbox_emails, active_mailboxes, subscription_mailboxes, statuses, folders, system_config):
+        c.invalidate()
+    logger.info("Reference cache invalidated")
+
+
+def _warm(db: Session) -> None:
+    for mailbox_id, _ in get_active_mailboxes(db):
+        get_monitored_folders(db, mailbox_id)
+    get_status_id(db, "NUEVO")
+    if settings.DB_CONFIG_ENABLED:
+        get_system_config(db)
+
+
+async def warm() -> None:
+    """
+    Precarga en startup. Si la DB no responde, no bloquea el arranque:
+    el cache se llena en el primer uso.
+    """
+    try:
+        await run_db(_warm)
+        logger.info("Reference cache warmed")
+    except Exception as e:
+        logger.warning("Reference cache warm-up failed: %s", e)
@@ -3,7 +3,8 @@ from __future__ import annotations
 import json
 import logging
 from datetime import datetime, timezone
-from sqlalchemy import text
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import Session
 
 logger = logging.getLogger("app.repos")
@@ -13,6 +14,11 @@ def utcnow() -> datetime:
     return datetime.now(timezone.utc).replace(tzinfo=None)
 
 
+def db_now(db: Session) -> datetime:
+    """NOW(6) del servidor (para INSERT multi-fila, que no admite NOW(6) en VALUES)."""
+    return db.execute(text("SELECT NOW(6)")).scalar_one()
+
+
 def get_or_create_mailbox(db: Session, email: str) -> int:
     row = db.execute(text("SELECT id FROM mailboxes WHERE email = :email LIMIT 1"), {"email": email}).fetchone()
     if row:
@@ -28,6 +34,22 @@ def get_or_create_mailbox(db: Session, email: str) -> int:
     return int(row2[0])
 
 
+def list_active_mailboxes(db: Session) -> list[tuple[int, str]]:
+    rows = db.execute(text("""
+        SELECT id, email FROM mailboxes
+        WHERE is_active = 1
+        ORDER BY id
+    """)).fetchall()
+    return [(int(r[0]), str(r[1])) for r in rows]
+
+
+def get_mailbox_email(db: Session, mailbox_id: int) -> str:
+    row = db.execute(text("SELECT email FROM mailboxes WHERE id = :id LIMIT 1"), {"id": mailbox_id}).fetchone()
+    if not row:
+        raise RuntimeError(f"Missing mailbox in DB: id={mailbox_id}")
+    return str(row[0])
+
+
 def get_status_id_by_code(db: Session, code: str) -> int:
     row = db.execute(text("SELECT id FROM case_statuses WHERE code = :code LIMIT 1"), {"code": code}).fetchone()
     if not row:
@@ -51,6 +73,47 @@ def next_case_number(db: Session) -> str:
     return f"ICBF-{year}-{new_val:06d}"
 
 
+def ensure_case_sequence_blocks_table(db: Session) -> None:
+    db.execute(text("""
+        CREATE TABLE IF NOT EXISTS case_sequence_blocks (
+          id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+          year INT NOT NULL,
+          worker_id VARCHAR(50) NOT NULL,
+          first_value INT NOT NULL,
+          last_value INT NOT NULL,
+          reserved_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+          PRIMARY KEY (id),
+          KEY idx_year_worker (year, worker_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """))
+
+
+def reserve_case_number_block(db: Session, *, year: int, size: int, worker_id: str) -> tuple[int, int]:
+    """
+    Reserva un rango [first, last] de case_sequences para un worker.
+    Debe correr en su propia transacción corta: el FOR UPDATE se libera al commit.
+    """
+    db.execute(text("INSERT IGNORE INTO case_sequences (year, last_value, updated_at) VALUES (:y, 0, NOW(6))"), {"y": year})
+    row = db.execute(
+        text("SELECT last_value FROM case_sequences WHERE year = :y FOR UPDATE"),
+        {"y": year},
+    ).fetchone()
+    last = int(row[0]) if row else 0
+    first_value, last_value = last + 1, last + int(size)
+    db.execute(
+        text("UPDATE case_sequences SET last_value = :v, updated_at = NOW(6) WHERE year = :y"),
+        {"v": last_value, "y": year},
+    )
+    db.execute(
+        text("""
+            INSERT INTO case_sequence_blocks (year, worker_id, first_value, last_value, reserved_at)
+            VALUES (:y, :w, :first, :last, NOW(6))
+        """),
+        {"y": year, "w": worker_id[:50], "first": first_value, "last": last_value},
+    )
+    return first_value, last_value
+
+
 def create_case(
     db: Session,
     *,
@@ -59,11 +122,20 @@ def create_case(
     requester_email: str,
     requester_name: str | None,
     received_at: datetime,
+    case_number: str | None = None,
+    status_id: int | None = None,
 ) -> int:
-    status_id = get_status_id_by_code(db, "NUEVO")
-    case_number = next_case_number(db)
+    """
+    case_number: si viene (allocator por bloques), se usa tal cual;
+    si no, se toma 1 número de case_sequences dentro de esta transacción.
+    status_id: id de 'NUEVO' (cacheado por el caller); si no viene se consulta.
+    """
+    if status_id is None:
+        status_id = get_status_id_by_code(db, "NUEVO")
+    if not case_number:
+        case_number = next_case_number(db)
 
-    db.execute(
+    res = db.execute(
         text("""
             INSERT INTO cases (
               mailbox_id, case_number, subject, requester_email, requester_name,
@@ -95,8 +167,7 @@ def create_case(
             "last_activity_at": received_at,
         },
     )
-    row = db.execute(text("SELECT id FROM cases WHERE case_number = :cn LIMIT 1"), {"cn": case_number}).fetchone()
-    return int(row[0])
+    return int(res.lastrowid)
 
 
 def touch_case_activity(db: Session, *, case_id: int, last_activity_at: datetime) -> None:
@@ -112,6 +183,25 @@ def touch_case_activity(db: Session, *, case_id: int, last_activity_at: datetime
     )
 
 
+def touch_cases_activity_many(db: Session, activity: dict[int, datetime]) -> None:
+    """
+    Un UPDATE por caso tocado en el batch (executemany), no uno por mensaje.
+    activity: {case_id: last_activity_at}
+    """
+    if not activity:
+        return
+    db.execute(
+        text("""
+            UPDATE cases
+            SET last_activity_at = :dt,
+                updated_at = NOW(6)
+            WHERE id = :cid
+            LIMIT 1
+        """),
+        [{"cid": cid, "dt": dt} for cid, dt in activity.items()],
+    )
+
+
 def get_case_by_message_dedupe(db: Session, mailbox_id: int, provider_message_id: str) -> int | None:
     row = db.execute(
         text("""
@@ -139,6 +229,127 @@ def get_case_by_conversation_id(db: Session, *, mailbox_id: int, conversation_id
     return int(row[0]) if row else None
 
 
+_MESSAGE_INBOUND_COLUMNS = """
+              case_id, mailbox_id, folder_id, direction,
+              provider_message_id, conversation_id, internet_message_id, in_reply_to,
+              from_email, to_emails, cc_emails, bcc_emails,
+              subject, body_text, body_html,
+              received_at, sent_at,
+              has_attachments, processed_by_worker,
+              created_at
+"""
+
+# Duplicado: no se pisa el mensaje; dedupe_hits fuerza "changed" (rowcount 2) y
+# LAST_INSERT_ID(id) devuelve el PK existente en lastrowid.
+_MESSAGE_UPSERT_CLAUSE = """
+            ON DUPLICATE KEY UPDATE
+              id = LAST_INSERT_ID(id),
+              dedupe_hits = dedupe_hits + 1
+"""
+
+
+# MySQL: 1060 columna duplicada, 1061 índice duplicado (otro proceso ya aplicó el ALTER)
+_DDL_ALREADY_APPLIED = (1060, 1061)
+
+
+def _ddl_already_applied(e: DBAPIError) -> bool:
+    args = getattr(e.orig, "args", None) or (None,)
+    return args[0] in _DDL_ALREADY_APPLIED
+
+
+def ensure_messages_ingest_schema(db: Session) -> bool:
+    """
+    Safe-guard para el upsert de ingesta:
+      - columna messages.dedupe_hits
+      - UNIQUE (mailbox_id, provider_message_id)
+    Si hay duplicados históricos el unique no se puede crear: retorna False
+    (el caller mantiene el SELECT previo como dedupe). True si el unique existe.
+    """
+    has_col = db.execute(text("""
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'messages' AND COLUMN_NAME = 'dedupe_hits'
+    """)).scalar()
+    if not has_col:
+        try:
+            db.execute(text("ALTER TABLE messages ADD COLUMN dedupe_hits INT NOT NULL DEFAULT 0"))
+        except DBAPIError as e:
+            if not _ddl_already_applied(e):
+                raise
+
+    has_unique = db.execute(text("""
+        SELECT INDEX_NAME
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'messages' AND NON_UNIQUE = 0
+        GROUP BY INDEX_NAME
+        HAVING GROUP_CONCAT(COLUMN_NAME ORDER BY SEQ_IN_INDEX) = 'mailbox_id,provider_message_id'
+        LIMIT 1
+    """)).fetchone()
+    if has_unique:
+        return True
+
+    dup = db.execute(text("""
+        SELECT 1 FROM messages
+        GROUP BY mailbox_id, provider_message_id
+        HAVING COUNT(*) > 1
+        LIMIT 1
+    """)).fetchone()
+    if dup:
+        return False
+
+    try:
+        db.execute(text("""
+            ALTER TABLE messages
+            ADD UNIQUE KEY uq_messages_mailbox_provider (mailbox_id, provider_message_id)
+        """))
+    except DBAPIError as e:
+        if not _ddl_already_applied(e):
+            raise
+    return True
+
+
+def _message_inbound_params(
+    *,
+    case_id: int,
+    mailbox_id: int,
+    folder_id: int | None,
+    provider_message_id: str,
+    conversation_id: str | None,
+    internet_message_id: str | None,
+    in_reply_to: str | None,
+    from_email: str,
+    to_emails: str | None,
+    cc_emails: str | None,
+    bcc_emails: str | None,
+    subject: str,
+    body_text: str | None,
+    body_html: str | None,
+    received_at: datetime | None,
+    sent_at: datetime | None,
+    has_attachments: int,
+    processed_by_worker: str | None,
+) -> dict:
+    return {
+        "case_id": case_id,
+        "mailbox_id": mailbox_id,
+        "folder_id": folder_id,
+        "provider_message_id": provider_message_id[:190],
+        "conversation_id": (conversation_id[:190] if conversation_id else None),
+        "internet_message_id": (internet_message_id[:255] if internet_message_id else None),
+        "in_reply_to": (in_reply_to[:255] if in_reply_to else None),
+        "from_email": from_email[:190],
+        "to_emails": to_emails,
+        "cc_emails": cc_emails,
+        "bcc_emails": bcc_emails,
+        "subject": subject[:255],
+        "body_text": body_text,
+        "body_html": body_html,
+        "received_at": received_at,
+        "sent_at": sent_at,
+        "has_attachments": int(has_attachments),
+        "processed_by_worker": (processed_by_worker[:50] if processed_by_worker else None),
+    }
+
+
 def insert_message_inbound(
     db: Session,
     *,
@@ -160,18 +371,16 @@ def insert_message_inbound(
     sent_at: datetime | None,
     has_attachments: int,
     processed_by_worker: str | None,
-) -> None:
-    db.execute(
-        text("""
-            INSERT INTO messages (
-              case_id, mailbox_id, folder_id, direction,
-              provider_message_id, conversation_id, internet_message_id, in_reply_to,
-              from_email, to_emails, cc_emails, bcc_emails,
-              subject, body_text, body_html,
-              received_at, sent_at,
-              has_attachments, processed_by_worker,
-              created_at
-            )
+) -> tuple[int, bool]:
+    """
+    Upsert atómico sobre uq_messages_mailbox_provider (ver ensure_messages_ingest_schema).
+    Un solo statement inserta o, si ya existía, no toca el mensaje (solo dedupe_hits)
+    y deja su id en LAST_INSERT_ID.
+    Retorna (message_pk, inserted). Con CLIENT_FOUND_ROWS: 1 = insert, 2 = duplicado.
+    """
+    res = db.execute(
+        text(f"""
+            INSERT INTO messages ({_MESSAGE_INBOUND_COLUMNS})
             VALUES (
               :case_id, :mailbox_id, :folder_id, 'IN',
               :provider_message_id, :conversation_id, :internet_message_id, :in_reply_to,
@@ -181,28 +390,86 @@ def insert_message_inbound(
               :has_attachments, :processed_by_worker,
               NOW(6)
             )
+            {_MESSAGE_UPSERT_CLAUSE}
         """),
-        {
-            "case_id": case_id,
-            "mailbox_id": mailbox_id,
-            "folder_id": folder_id,
-            "provider_message_id": provider_message_id[:190],
-            "conversation_id": (conversation_id[:190] if conversation_id else None),
-            "internet_message_id": (internet_message_id[:255] if internet_message_id else None),
-            "in_reply_to": (in_reply_to[:255] if in_reply_to else None),
-            "from_email": from_email[:190],
-            "to_emails": to_emails,
-            "cc_emails": cc_emails,
-            "bcc_emails": bcc_emails,
-            "subject": subject[:255],
-            "body_text": body_text,
-            "body_html": body_html,
-            "received_at": received_at,
-            "sent_at": sent_at,
-            "has_attachments": int(has_attachments),
-            "processed_by_worker": (processed_by_worker[:50] if processed_by_worker else None),
-        },
+        _message_inbound_params(
+            case_id=case_id,
+            mailbox_id=mailbox_id,
+            folder_id=folder_id,
+            provider_message_id=provider_message_id,
+            conversation_id=conversation_id,
+            internet_message_id=internet_message_id,
+            in_reply_to=in_reply_to,
+            from_email=from_email,
+            to_emails=to_emails,
+            cc_emails=cc_emails,
+            bcc_emails=bcc_emails,
+            subject=subject,
+            body_text=body_text,
+            body_html=body_html,
+            received_at=received_at,
+            sent_at=sent_at,
+            has_attachments=has_attachments,
+            processed_by_worker=processed_by_worker,
+        ),
     )
+    return int(res.lastrowid), res.rowcount == 1
+
+
+def find_cases_by_conversations(db: Session, *, mailbox_id: int, conversation_ids: list[str]) -> dict[str, int]:
+    """
+    conversationId -> case_id del último mensaje del hilo (un solo SELECT para todo el batch).
+    """
+    if not conversation_ids:
+        return {}
+    rows = db.execute(
+        text("""
+            SELECT m.conversation_id, m.case_id
+            FROM messages m
+            JOIN (
+                SELECT conversation_id, MAX(id) AS max_id
+                FROM messages
+                WHERE mailbox_id = :mailbox_id
+                  AND conversation_id IN :cids
+                GROUP BY conversation_id
+            ) last ON last.max_id = m.id
+        """).bindparams(bindparam("cids", expanding=True)),
+        {"mailbox_id": mailbox_id, "cids": list(conversation_ids)},
+    ).fetchall()
+    return {str(r[0]): int(r[1]) for r in rows}
+
+
+def insert_messages_inbound_many(db: Session, rows: list[dict], *, created_at: datetime) -> int:
+    """
+    INSERT multi-fila (executemany) de mensajes entrantes, con el mismo upsert
+    que insert_message_inbound.
+    rows: mismos kwargs que insert_message_inbound.
+    VALUES lleva SOLO placeholders (incluye direction/created_at) para que
+    PyMySQL lo reescriba como un único INSERT ... VALUES (...), (...), ...
+    Retorna cuántas filas se insertaron; si es menor que len(rows), otro worker
+    ya había insertado alguna (el caller decide, p.ej. rollback y por-mensaje).
+    """
+    if not rows:
+        return 0
+    params = [{**_message_inbound_params(**r), "direction": "IN", "created_at": created_at} for r in rows]
+    res = db.execute(
+        text(f"""
+            INSERT INTO messages ({_MESSAGE_INBOUND_COLUMNS})
+            VALUES (
+              :case_id, :mailbox_id, :folder_id, :direction,
+              :provider_message_id, :conversation_id, :internet_message_id, :in_reply_to,
+              :from_email, :to_emails, :cc_emails, :bcc_emails,
+              :subject, :body_text, :body_html,
+              :received_at, :sent_at,
+              :has_attachments, :processed_by_worker,
+              :created_at
+            )
+            {_MESSAGE_UPSERT_CLAUSE}
+        """),
+        params,
+    )
+    # 1 por insert, 2 por duplicado
+    return 2 * len(rows) - int(res.rowcount)
 
 
 def insert_attachment(
@@ -240,6 +507,27 @@ def insert_attachment(
         },
     )
 
+def list_known_messages(db: Session, *, mailbox_id: int, provider_message_ids: list[str]) -> dict[str, tuple[int, int]]:
+    """
+    Dedupe en bloque (un solo SELECT ... IN) para una página delta / ráfaga de webhook.
+    Returns: {provider_message_id: (has_attachments, attachments_count)}
+    """
+    if not provider_message_ids:
+        return {}
+    rows = db.execute(
+        text("""
+            SELECT m.provider_message_id,
+                   COALESCE(m.has_attachments, 0),
+                   (SELECT COUNT(*) FROM attachments a WHERE a.message_id = m.id)
+            FROM messages m
+            WHERE m.mailbox_id = :mailbox_id
+              AND m.provider_message_id IN :pmids
+        """).bindparams(bindparam("pmids", expanding=True)),
+        {"mailbox_id": mailbox_id, "pmids": list(provider_message_ids)},
+    ).fetchall()
+    return {str(r[0]): (int(r[1]), int(r[2])) for r in rows}
+
+
 def get_message_pk(db: Session, mailbox_id: int, provider_message_id: str) -> int:
     row = db.execute(
         text("""
@@ -254,6 +542,31 @@ def get_message_pk(db: Session, mailbox_id: int, provider_message_id: str) -> in
     return int(row[0])
 
 
+def _case_event_params(
+    *,
+    case_id: int,
+    actor_user_id: int | None,
+    source: str,
+    event_type: str,
+    from_status_id: int | None,
+    to_status_id: int | None,
+    details: dict,
+    ip_address: str | None = None,
+    user_agent: str | None = None,
+) -> dict:
+    return {
+        "case_id": case_id,
+        "actor_user_id": actor_user_id,
+        "source": source,
+        "ip_address": ip_address,
+        "user_agent": user_agent,
+        "event_type": event_type[:40],
+        "from_status_id": from_status_id,
+        "to_status_id": to_status_id,
+        "details_json": json.dumps(details, ensure_ascii=False),
+    }
+
+
 def insert_case_event(
     db: Session,
     *,
@@ -282,17 +595,43 @@ def insert_case_event(
               :details_json, NOW(6)
             )
         """),
-        {
-            "case_id": case_id,
-            "actor_user_id": actor_user_id,
-            "source": source,
-            "ip_address": ip_address,
-            "user_agent": user_agent,
-            "event_type": event_type[:40],
-            "from_status_id": from_status_id,
-            "to_status_id": to_status_id,
-            "details_json": json.dumps(details, ensure_ascii=False),
-        },
+        _case_event_params(
+            case_id=case_id,
+            actor_user_id=actor_user_id,
+            source=source,
+            event_type=event_type,
+            from_status_id=from_status_id,
+            to_status_id=to_status_id,
+            details=details,
+            ip_address=ip_address,
+            user_agent=user_agent,
+        ),
+    )
+
+
+def insert_case_events_many(db: Session, rows: list[dict], *, created_at: datetime) -> None:
+    """
+    INSERT multi-fila (executemany) de case_events. rows: mismos kwargs que insert_case_event.
+    """
+    if not rows:
+        return
+    params = [{**_case_event_params(**r), "created_at": created_at} for r in rows]
+    db.execute(
+        text("""
+            INSERT INTO case_events (
+              case_id, actor_user_id,
+              source, ip_address, user_agent,
+              event_type, from_status_id, to_status_id,
+              details_json, created_at
+            )
+            VALUES (
+              :case_id, :actor_user_id,
+              :source, :ip_address, :user_agent,
+              :event_type, :from_status_id, :to_status_id,
+              :details_json, :created_at
+            )
+        """),
+        params,
     )
 
 
@@ -311,7 +650,7 @@ def ensure_graph_subscriptions_table(db: Session) -> None:
           id INT AUTO_INCREMENT PRIMARY KEY,
           mailbox_id INT NOT NULL,
           subscription_id VARCHAR(190) NOT NULL,
-          resource VARCHAR(255) NOT NULL,
+          resource VARCHAR(600) NOT NULL,
           notification_url VARCHAR(600) NOT NULL,
           expires_at DATETIME(6) NOT NULL,
           status VARCHAR(30) NOT NULL DEFAULT 'ACTIVE',
@@ -324,6 +663,14 @@ def ensure_graph_subscriptions_table(db: Session) -> None:
         ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
     """))
 
+    # Tablas viejas (VARCHAR(255)): el resource con $select de rich notifications no entra
+    resource_len = db.execute(text("""
+        SELECT CHARACTER_MAXIMUM_LENGTH FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'graph_subscriptions' AND COLUMN_NAME = 'resource'
+    """)).scalar()
+    if resource_len is not None and int(resource_len) < 600:
+        db.execute(text("ALTER TABLE graph_subscriptions MODIFY resource VARCHAR(600) NOT NULL"))
+
 
 def upsert_subscription(
     db: Session,
@@ -357,6 +704,22 @@ def upsert_subscription(
     })
 
 
+def update_subscription_expiry(db: Session, *, subscription_id: str, expires_at: datetime) -> int:
+    """
+    Renovación de UNA suscripción concreta (lifecycle reauthorizationRequired).
+    """
+    res = db.execute(text("""
+        UPDATE graph_subscriptions
+        SET expires_at = :expires_at,
+            status = 'ACTIVE',
+            last_renew_at = CURRENT_TIMESTAMP(6),
+            updated_at = CURRENT_TIMESTAMP(6)
+        WHERE subscription_id = :subscription_id
+        LIMIT 1
+    """), {"subscription_id": subscription_id, "expires_at": expires_at})
+    return int(res.rowcount or 0)
+
+
 def get_active_subscription(db: Session, *, mailbox_id: int, resource: str):
     return db.execute(text("""
         SELECT subscription_id, expires_at, status
@@ -369,6 +732,15 @@ def get_active_subscription(db: Session, *, mailbox_id: int, resource: str):
     """), {"mailbox_id": mailbox_id, "resource": resource}).fetchone()
 
 
+def get_subscription_mailbox_id(db: Session, *, subscription_id: str) -> int | None:
+    row = db.execute(text("""
+        SELECT mailbox_id FROM graph_subscriptions
+        WHERE subscription_id = :subscription_id
+        LIMIT 1
+    """), {"subscription_id": subscription_id}).fetchone()
+    return int(row[0]) if row else None
+
+
 def mark_subscription_status(db: Session, *, subscription_id: str, status: str) -> None:
     db.execute(text("""
         UPDATE graph_subscriptions
@@ -397,6 +769,8 @@ def ensure_graph_delta_state_table(db: Session) -> None:
           last_sync_at DATETIME(6) NULL,
           last_status_code INT NULL,
           last_error VARCHAR(500) NULL,
+          page_offset INT NOT NULL DEFAULT 0,
+          run_requested_at DATETIME(6) NULL,
           created_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
           updated_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
           PRIMARY KEY (id),
@@ -406,6 +780,22 @@ def ensure_graph_delta_state_table(db: Session) -> None:
         ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
     """))
 
+    # Tablas creadas antes del checkpoint por mensaje
+    has_offset = db.execute(text("""
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'graph_delta_state' AND COLUMN_NAME = 'page_offset'
+    """)).scalar()
+    if not has_offset:
+        db.execute(text("ALTER TABLE graph_delta_state ADD COLUMN page_offset INT NOT NULL DEFAULT 0 AFTER last_error"))
+
+    # Pedido de corrida inmediata (lifecycle 'missed' / suscripción recreada)
+    has_requested = db.execute(text("""
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'graph_delta_state' AND COLUMN_NAME = 'run_requested_at'
+    """)).scalar()
+    if not has_requested:
+        db.execute(text("ALTER TABLE graph_delta_state ADD COLUMN run_requested_at DATETIME(6) NULL AFTER page_offset"))
+
 
 def list_monitored_folders(db: Session, *, mailbox_id: int) -> list[tuple[int, str, str | None]]:
     """
@@ -428,10 +818,11 @@ def list_monitored_folders(db: Session, *, mailbox_id: int) -> list[tuple[int, s
 def get_delta_state(db: Session, *, mailbox_id: int, folder_id: int):
     """
     Returns row or None:
-      (delta_link, next_link, last_sync_at, last_status_code, last_error)
+      (delta_link, next_link, last_sync_at, last_status_code, last_error, page_offset)
+    page_offset: ítems ya procesados de la página en curso (next_link, o delta_link si no hay).
     """
     return db.execute(text("""
-        SELECT delta_link, next_link, last_sync_at, last_status_code, last_error
+        SELECT delta_link, next_link, last_sync_at, last_status_code, last_error, page_offset
         FROM graph_delta_state
         WHERE mailbox_id = :mid AND folder_id = :fid
         LIMIT 1
@@ -448,20 +839,25 @@ def upsert_delta_state(
     last_sync_at: datetime | None,
     last_status_code: int | None,
     last_error: str | None,
+    page_offset: int = 0,
 ) -> None:
     db.execute(text("""
         INSERT INTO graph_delta_state
-          (mailbox_id, folder_id, delta_link, next_link, last_sync_at, last_status_code, last_error, created_at, updated_at)
+          (mailbox_id, folder_id, delta_link, next_link, last_sync_at, last_status_code, last_error,
+           page_offset, created_at, updated_at)
         VALUES
-          (:mid, :fid, :delta_link, :next_link, :last_sync_at, :last_status_code, :last_error, NOW(6), NOW(6))
+          (:mid, :fid, :delta_link, :next_link, :last_sync_at, :last_status_code, :last_error,
+           :page_offset, NOW(6), NOW(6))
         ON DUPLICATE KEY UPDATE
           delta_link = VALUES(delta_link),
           next_link  = VALUES(next_link),
           last_sync_at = VALUES(last_sync_at),
           last_status_code = VALUES(last_status_code),
           last_error = VALUES(last_error),
+          page_offset = VALUES(page_offset),
           updated_at = NOW(6)
     """), {
+        "page_offset": int(page_offset),
         "mid": mailbox_id,
         "fid": folder_id,
         "delta_link": delta_link,
@@ -472,6 +868,40 @@ def upsert_delta_state(
     })
 
 
+def request_delta_run(db: Session, *, mailbox_id: int, folder_ids: list[int], requested_at: datetime) -> int:
+    """
+    Marca carpetas para corrida delta inmediata; la toma el scheduler que tenga su lease.
+    Solo filas existentes: una carpeta sin estado todavía no corrió y ya corre de inmediato.
+    """
+    if not folder_ids:
+        return 0
+    res = db.execute(text("""
+        UPDATE graph_delta_state
+        SET run_requested_at = :requested_at
+        WHERE mailbox_id = :mid
+          AND folder_id IN :fids
+    """).bindparams(bindparam("fids", expanding=True)), {
+        "mid": mailbox_id,
+        "fids": [int(f) for f in folder_ids],
+        "requested_at": requested_at,
+    })
+    return int(res.rowcount or 0)
+
+
+def list_pending_delta_runs(db: Session) -> list[tuple[int, int, datetime]]:
+    """
+    Pedidos de corrida aún no atendidos (ninguna corrida escribió estado después del pedido).
+    Returns: [(mailbox_id, folder_id, run_requested_at), ...]
+    """
+    rows = db.execute(text("""
+        SELECT mailbox_id, folder_id, run_requested_at
+        FROM graph_delta_state
+        WHERE run_requested_at IS NOT NULL
+          AND (last_sync_at IS NULL OR run_requested_at > last_sync_at)
+    """)).fetchall()
+    return [(int(r[0]), int(r[1]), r[2]) for r in rows]
+
+
 def reset_delta_state(db: Session, *, mailbox_id: int, folder_id: int, note: str = "reset") -> None:
     upsert_delta_state(
         db,
@@ -483,3 +913,493 @@ def reset_delta_state(db: Session, *, mailbox_id: int, folder_id: int, note: str
         last_status_code=None,
         last_error=note,
     )
+
+
+# ============================================================
+# Webhook inbox (cola durable de notificaciones)
+# ============================================================
+
+def ensure_webhook_inbox_table(db: Session) -> None:
+    db.execute(text("""
+        CREATE TABLE IF NOT EXISTS webhook_inbox (
+          id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+          subscription_id VARCHAR(190) NULL,
+          notifications INT NOT NULL DEFAULT 0,
+          payload_json MEDIUMTEXT NOT NULL,
+          status VARCHAR(20) NOT NULL DEFAULT 'PENDING',
+          attempts INT NOT NULL DEFAULT 0,
+          locked_by VARCHAR(120) NULL,
+          locked_at DATETIME(6) NULL,
+          available_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+          last_error VARCHAR(500) NULL,
+          received_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+          processed_at DATETIME(6) NULL,
+          PRIMARY KEY (id),
+          KEY idx_webhook_inbox_status (status, available_at, id),
+          KEY idx_webhook_inbox_locked_by (locked_by),
+          KEY idx_webhook_inbox_subscription (subscription_id, received_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """))
+
+    # Tablas creadas antes de la agenda delta por buzón
+    has_sub_key = db.execute(text("""
+        SELECT COUNT(*) FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'webhook_inbox'
+          AND INDEX_NAME = 'idx_webhook_inbox_subscription'
+    """)).scalar()
+    if not has_sub_key:
+        try:
+            db.execute(text("ALTER TABLE webhook_inbox ADD KEY idx_webhook_inbox_subscription (subscription_id, received_at)"))
+        except DBAPIError as e:
+            if not _ddl_already_applied(e):
+                raise
+
+
+def webhook_inbox_last_received_by_subscription(db: Session) -> dict[str, float]:
+    """
+    {subscription_id: segundos desde su último payload encolado} (cualquier proceso).
+    Solo notificaciones de cambios: las de lifecycle se encolan sin subscription_id.
+    """
+    rows = db.execute(text("""
+        SELECT subscription_id, TIMESTAMPDIFF(MICROSECOND, MAX(received_at), NOW(6))
+        FROM webhook_inbox
+        WHERE subscription_id IS NOT NULL
+        GROUP BY subscription_id
+    """)).fetchall()
+    return {str(r[0]): max(0.0, int(r[1]) / 1_000_000) for r in rows if r[1] is not None}
+
+
+def enqueue_webhook_payload(db: Session, *, payload: dict, subscription_id: str | None, notifications: int) -> int:
+    res = db.execute(text("""
+        INSERT INTO webhook_inbox (subscription_id, notifications, payload_json, status, received_at, available_at)
+        VALUES (:sid, :n, :payload, 'PENDING', NOW(6), NOW(6))
+    """), {
+        "sid": (subscription_id[:190] if subscription_id else None),
+        "n": int(notifications),
+        "payload": json.dumps(payload, ensure_ascii=False),
+    })
+    return int(res.lastrowid)
+
+
+def claim_webhook_inbox(db: Session, *, claim_token: str, limit: int, lease_seconds: int) -> list[tuple[int, dict, int]]:
+    """
+    Toma hasta `limit` filas PENDING (o PROCESSING con lease vencido: worker caído)
+    marcándolas con claim_token. Returns: [(id, payload, attempts), ...]
+    """
+    db.execute(text("""
+        UPDATE webhook_inbox
+        SET status = 'PROCESSING',
+            locked_by = :token,
+            locked_at = NOW(6),
+            attempts = attempts + 1
+        WHERE (status = 'PENDING' AND available_at <= NOW(6))
+           OR (status = 'PROCESSING' AND locked_at < NOW(6) - INTERVAL :lease SECOND)
+        ORDER BY id ASC
+        LIMIT :lim
+    """), {"token": claim_token[:120], "lease": int(lease_seconds), "lim": int(limit)})
+    rows = db.execute(text("""
+        SELECT id, payload_json, attempts
+        FROM webhook_inbox
+        WHERE locked_by = :token AND status = 'PROCESSING'
+        ORDER BY id ASC
+    """), {"token": claim_token[:120]}).fetchall()
+    return [(int(r[0]), json.loads(r[1]), int(r[2])) for r in rows]
+
+
+def renew_webhook_inbox_claim(db: Session, *, inbox_id: int, claim_token: str) -> bool:
+    """
+    Renueva locked_at justo antes de procesar la fila. False => el lease venció y
+    otro consumidor la re-tomó: no hay que procesarla ni marcarla.
+    """
+    res = db.execute(text("""
+        UPDATE webhook_inbox
+        SET locked_at = NOW(6)
+        WHERE id = :id AND locked_by = :token AND status = 'PROCESSING'
+        LIMIT 1
+    """), {"id": inbox_id, "token": claim_token[:120]})
+    return int(res.rowcount or 0) == 1
+
+
+def mark_webhook_inbox_done(db: Session, *, inbox_id: int, claim_token: str) -> bool:
+    """Solo si la fila sigue tomada con claim_token. Returns: False si se perdió el claim."""
+    res = db.execute(text("""
+        UPDATE webhook_inbox
+        SET status = 'DONE', processed_at = NOW(6), locked_by = NULL, last_error = NULL
+        WHERE id = :id AND locked_by = :token
+        LIMIT 1
+    """), {"id": inbox_id, "token": claim_token[:120]})
+    return int(res.rowcount or 0) == 1
+
+
+def mark_webhook_inbox_failed(
+    db: Session,
+    *,
+    inbox_id: int,
+    claim_token: str,
+    error: str,
+    retry_in_seconds: int | None,
+) -> bool:
+    """
+    retry_in_seconds=None => FAILED definitivo; si no, vuelve a PENDING con backoff.
+    Solo si la fila sigue tomada con claim_token. Returns: False si se perdió el claim.
+    """
+    res = db.execute(text("""
+        UPDATE webhook_inbox
+        SET status = :status,
+            locked_by = NULL,
+            available_at = NOW(6) + INTERVAL :delay SECOND,
+            last_error = :err
+        WHERE id = :id AND locked_by = :token
+        LIMIT 1
+    """), {
+        "id": inbox_id,
+        "token": claim_token[:120],
+        "status": ("FAILED" if retry_in_seconds is None else "PENDING"),
+        "delay": int(retry_in_seconds or 0),
+        "err": (error[:500] if error else None),
+    })
+    return int(res.rowcount or 0) == 1
+
+
+def release_webhook_inbox_claims(db: Session, *, inbox_ids: list[int], claim_token: str) -> None:
+    """Devuelve a PENDING filas tomadas con claim_token y no procesadas (shutdown)."""
+    if not inbox_ids:
+        return
+    db.execute(text("""
+        UPDATE webhook_inbox
+        SET status = 'PENDING', locked_by = NULL, attempts = GREATEST(attempts - 1, 0)
+        WHERE id IN :ids AND locked_by = :token AND status = 'PROCESSING'
+    """).bindparams(bindparam("ids", expanding=True)), {"ids": list(inbox_ids), "token": claim_token[:120]})
+
+
+def webhook_inbox_stats(db: Session) -> dict[str, int]:
+    row = db.execute(text("""
+        SELECT
+          SUM(status = 'PENDING'),
+          SUM(status = 'PROCESSING'),
+          SUM(status = 'FAILED'),
+          COALESCE(TIMESTAMPDIFF(SECOND, MIN(CASE WHEN status = 'PENDING' THEN received_at END), NOW(6)), 0)
+        FROM webhook_inbox
+        WHERE status <> 'DONE'
+    """)).fetchone()
+    return {
+        "pending": int(row[0] or 0),
+        "processing": int(row[1] or 0),
+        "failed": int(row[2] or 0),
+        "oldest_pending_seconds": int(row[3] or 0),
+    }
+
+
+def purge_webhook_inbox(db: Session, *, keep_days: int) -> int:
+    res = db.execute(text("""
+        DELETE FROM webhook_inbox
+        WHERE status = 'DONE' AND processed_at < NOW(6) - INTERVAL :d DAY
+        LIMIT 5000
+    """), {"d": int(keep_days)})
+    return int(res.rowcount or 0)
+
+
+# ============================================================
+# Backfill histórico (ventanas por receivedDateTime)
+# ============================================================
+
+def ensure_backfill_jobs_table(db: Session) -> None:
+    db.execute(text("""
+        CREATE TABLE IF NOT EXISTS backfill_jobs (
+          id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+          mailbox_id BIGINT UNSIGNED NOT NULL,
+          folder_code VARCHAR(40) NOT NULL,
+          window_start DATETIME(6) NOT NULL,
+          window_end DATETIME(6) NOT NULL,
+          status VARCHAR(20) NOT NULL DEFAULT 'PENDING',
+          next_link MEDIUMTEXT NULL,
+          pages INT NOT NULL DEFAULT 0,
+          messages INT NOT NULL DEFAULT 0,
+          new_messages INT NOT NULL DEFAULT 0,
+          attempts INT NOT NULL DEFAULT 0,
+          available_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+          locked_by VARCHAR(120) NULL,
+          locked_at DATETIME(6) NULL,
+          last_error VARCHAR(500) NULL,
+          created_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+          updated_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+          PRIMARY KEY (id),
+          UNIQUE KEY uq_backfill_jobs_window (mailbox_id, folder_code, window_start, window_end),
+          KEY idx_backfill_jobs_status (mailbox_id, status, window_end)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """))
+
+    # Tablas creadas antes del backoff por ventana
+    has_available = db.execute(text("""
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'backfill_jobs' AND COLUMN_NAME = 'available_at'
+    """)).scalar()
+    if not has_available:
+        try:
+            db.execute(text(
+                "ALTER TABLE backfill_jobs ADD COLUMN available_at DATETIME(6) NOT NULL "
+                "DEFAULT CURRENT_TIMESTAMP(6) AFTER attempts"
+            ))
+        except DBAPIError as e:
+            if not _ddl_already_applied(e):
+                raise
+
+
+def plan_backfill_windows(
+    db: Session,
+    *,
+    mailbox_id: int,
+    folder_code: str,
+    windows: list[tuple[datetime, datetime]],
+) -> int:
+    """
+    Registra las ventanas [start, end) como PENDING. Idempotente (re-planificar no duplica).
+    Retorna cuántas ventanas nuevas se agregaron.
+    """
+    if not windows:
+        return 0
+    res = db.execute(text("""
+        INSERT IGNORE INTO backfill_jobs (mailbox_id, folder_code, window_start, window_end, status)
+        VALUES (:mid, :folder, :ws, :we, 'PENDING')
+    """), [
+        {"mid": mailbox_id, "folder": folder_code[:40], "ws": ws, "we": we}
+        for ws, we in windows
+    ])
+    return int(res.rowcount or 0)
+
+
+def claim_backfill_window(
+    db: Session,
+    *,
+    mailbox_id: int,
+    claim_token: str,
+    lease_seconds: int,
+) -> tuple[int, str, datetime, datetime, str | None, int] | None:
+    """
+    Toma la ventana PENDING más reciente ya disponible (available_at: backoff tras error)
+    o RUNNING con lease vencido (worker caído).
+    Returns: (id, folder_code, window_start, window_end, next_link, attempts) o None.
+    """
+    db.execute(text("""
+        UPDATE backfill_jobs
+        SET status = 'RUNNING',
+            locked_by = :token,
+            locked_at = NOW(6),
+            attempts = attempts + 1
+        WHERE mailbox_id = :mid
+          AND ((status = 'PENDING' AND available_at <= NOW(6))
+               OR (status = 'RUNNING' AND locked_at < NOW(6) - INTERVAL :lease SECOND))
+        ORDER BY window_end DESC
+        LIMIT 1
+    """), {"mid": mailbox_id, "token": claim_token[:120], "lease": int(lease_seconds)})
+    row = db.execute(text("""
+        SELECT id, folder_code, window_start, window_end, next_link, attempts
+        FROM backfill_jobs
+        WHERE locked_by = :token AND status = 'RUNNING'
+        LIMIT 1
+    """), {"token": claim_token[:120]}).fetchone()
+    if not row:
+        return None
+    return int(row[0]), str(row[1]), row[2], row[3], (str(row[4]) if row[4] else None), int(row[5])
+
+
+def save_backfill_cursor(
+    db: Session,
+    *,
+    job_id: int,
+    next_link: str | None,
+    pages: int,
+    messages: int,
+    new_messages: int,
+) -> None:
+    """
+    Cursor por página (renueva el lease). next_link None = ventana terminada.
+    """
+    db.execute(text("""
+        UPDATE backfill_jobs
+        SET next_link = :next_link,
+            pages = pages + :pages,
+            messages = messages + :messages,
+            new_messages = new_messages + :new_messages,
+            status = CASE WHEN :next_link IS NULL THEN 'DONE' ELSE status END,
+            locked_at = NOW(6),
+            last_error = NULL
+        WHERE id = :id
+    """), {
+        "id": job_id,
+        "next_link": next_link,
+        "pages": int(pages),
+        "messages": int(messages),
+        "new_messages": int(new_messages),
+    })
+
+
+def release_backfill_window(
+    db: Session,
+    *,
+    job_id: int,
+    error: str | None,
+    failed: bool = False,
+    count_attempt: bool = True,
+    retry_in_seconds: int = 0,
+) -> None:
+    """
+    Devuelve la ventana a PENDING (shutdown / error transitorio) o la marca FAILED.
+    El cursor (next_link) se conserva: al retomarla sigue desde ahí.
+    count_attempt=False (shutdown): el claim no gasta intento.
+    retry_in_seconds: backoff antes de que se pueda volver a tomar.
+    """
+    db.execute(text("""
+        UPDATE backfill_jobs
+        SET status = :status,
+            attempts = IF(:count_attempt, attempts, GREATEST(attempts - 1, 0)),
+            available_at = NOW(6) + INTERVAL :retry_in SECOND,
+            locked_by = NULL,
+            locked_at = NULL,
+            last_error = :err
+        WHERE id = :id AND status = 'RUNNING'
+    """), {
+        "id": job_id,
+        "status": ("FAILED" if failed else "PENDING"),
+        "count_attempt": 1 if count_attempt else 0,
+        "retry_in": max(0, int(retry_in_seconds)),
+        "err": (error[:500] if error else None),
+    })
+
+
+def backfill_next_available_seconds(db: Session, *, mailbox_id: int) -> float | None:
+    """
+    Segundos hasta que la próxima ventana PENDING en backoff se pueda tomar (0 = ya).
+    None si no queda ninguna PENDING.
+    """
+    row = db.execute(text("""
+        SELECT TIMESTAMPDIFF(MICROSECOND, NOW(6), MIN(available_at))
+        FROM backfill_jobs
+        WHERE mailbox_id = :mid AND status = 'PENDING'
+    """), {"mid": mailbox_id}).fetchone()
+    return max(0.0, int(row[0]) / 1_000_000) if row and row[0] is not None else None
+
+
+def backfill_stats(db: Session, *, mailbox_id: int) -> dict[str, int]:
+    rows = db.execute(text("""
+        SELECT status, COUNT(*), COALESCE(SUM(messages), 0), COALESCE(SUM(new_messages), 0)
+        FROM backfill_jobs
+        WHERE mailbox_id = :mid
+        GROUP BY status
+    """), {"mid": mailbox_id}).fetchall()
+    out = {"pending": 0, "running": 0, "done": 0, "failed": 0, "messages": 0, "new_messages": 0}
+    for status, n, msgs, new in rows:
+        out[str(status).lower()] = int(n)
+        out["messages"] += int(msgs)
+        out["new_messages"] += int(new)
+    return out
+
+
+# ============================================================
+# Work leases (reparto de trabajo entre instancias del worker)
+# ============================================================
+
+def ensure_worker_leases_tables(db: Session) -> None:
+    db.execute(text("""
+        CREATE TABLE IF NOT EXISTS worker_instances (
+          owner VARCHAR(120) NOT NULL,
+          started_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+          heartbeat_at DATETIME(6) NOT NULL,
+          PRIMARY KEY (owner),
+          KEY idx_worker_instances_heartbeat (heartbeat_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """))
+    db.execute(text("""
+        CREATE TABLE IF NOT EXISTS worker_leases (
+          resource VARCHAR(190) NOT NULL,
+          owner VARCHAR(120) NOT NULL,
+          acquired_at DATETIME(6) NOT NULL,
+          expires_at DATETIME(6) NOT NULL,
+          PRIMARY KEY (resource),
+          KEY idx_worker_leases_owner (owner)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """))
+
+
+def heartbeat_worker(db: Session, *, owner: str, ttl_seconds: int) -> tuple[int, list[str]]:
+    """
+    Latido de la instancia: se registra viva y renueva TODOS sus leases.
+    Returns: (instancias vivas, recursos que sigue teniendo).
+    """
+    params = {"owner": owner[:120], "ttl": int(ttl_seconds)}
+    db.execute(text("""
+        INSERT INTO worker_instances (owner, heartbeat_at)
+        VALUES (:owner, NOW(6))
+        ON DUPLICATE KEY UPDATE heartbeat_at = NOW(6)
+    """), params)
+    db.execute(text("""
+        UPDATE worker_leases
+        SET expires_at = NOW(6) + INTERVAL :ttl SECOND
+        WHERE owner = :owner AND expires_at >= NOW(6)
+    """), params)
+    held = db.execute(text("""
+        SELECT resource FROM worker_leases
+        WHERE owner = :owner AND expires_at >= NOW(6)
+    """), params).fetchall()
+    live = db.execute(text("""
+        SELECT COUNT(*) FROM worker_instances
+        WHERE heartbeat_at >= NOW(6) - INTERVAL :ttl SECOND
+    """), params).scalar()
+    # Instancias muertas hace rato: fuera del registro
+    db.execute(text("""
+        DELETE FROM worker_instances
+        WHERE heartbeat_at < NOW(6) - INTERVAL 1 DAY
+        LIMIT 100
+    """))
+    return int(live or 0), [str(r[0]) for r in held]
+
+
+def list_worker_leases(db: Session, *, prefix: str = "") -> dict[str, tuple[str, bool]]:
+    """
+    Returns: {resource: (owner, vigente)}.
+    """
+    rows = db.execute(text("""
+        SELECT resource, owner, expires_at >= NOW(6)
+        FROM worker_leases
+        WHERE resource LIKE :prefix
+    """), {"prefix": prefix.replace("%", r"\%").replace("_", r"\_") + "%"}).fetchall()
+    return {str(r[0]): (str(r[1]), bool(r[2])) for r in rows}
+
+
+def try_acquire_lease(db: Session, *, resource: str, owner: str, ttl_seconds: int) -> bool:
+    """
+    Toma (o renueva) el lease si está libre, vencido o ya es nuestro.
+    """
+    params = {"resource": resource[:190], "owner": owner[:120], "ttl": int(ttl_seconds)}
+    res = db.execute(text("""
+        UPDATE worker_leases
+        SET acquired_at = IF(owner = :owner, acquired_at, NOW(6)),
+            owner = :owner,
+            expires_at = NOW(6) + INTERVAL :ttl SECOND
+        WHERE resource = :resource
+          AND (owner = :owner OR expires_at < NOW(6))
+    """), params)
+    if (res.rowcount or 0) > 0:
+        return True
+    res = db.execute(text("""
+        INSERT IGNORE INTO worker_leases (resource, owner, acquired_at, expires_at)
+        VALUES (:resource, :owner, NOW(6), NOW(6) + INTERVAL :ttl SECOND)
+    """), params)
+    return (res.rowcount or 0) > 0
+
+
+def release_worker_leases(db: Session, *, owner: str, resources: list[str] | None = None) -> int:
+    """
+    Suelta leases propios (resources None = todos, y se da de baja la instancia).
+    """
+    if resources is None:
+        db.execute(text("DELETE FROM worker_instances WHERE owner = :owner"), {"owner": owner[:120]})
+        res = db.execute(text("DELETE FROM worker_leases WHERE owner = :owner"), {"owner": owner[:120]})
+        return int(res.rowcount or 0)
+    if not resources:
+        return 0
+    res = db.execute(text("""
+        DELETE FROM worker_leases
+        WHERE owner = :owner AND resource IN :resources
+    """).bindparams(bindparam("resources", expanding=True)), {"owner": owner[:120], "resources": list(resources)})
+    return int(res.rowcount or 0)
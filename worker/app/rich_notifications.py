@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Any
+
+import httpx
+import jwt
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, padding as sym_padding, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from app.settings import settings
+
+logger = logging.getLogger("app.rich_notifications")
+
+# App de Microsoft que emite los validationTokens de change notifications (azp)
+GRAPH_NOTIFICATIONS_APP_ID = "0bf30f3b-4a52-48df-9a82-234910c4a086"
+
+# JWKS: re-descarga por kid desconocido como máximo cada tanto (rotación de claves)
+_JWKS_MIN_REFRESH_SECONDS = 300
+
+
+class RichNotificationError(RuntimeError):
+    pass
+
+
+class RichNotifications:
+    """
+    Notificaciones con datos del recurso (includeResourceData=true):
+      - la suscripción lleva el certificado público de GraphAuth (GRAPH_CERT_*)
+      - Graph manda el mensaje cifrado en encryptedContent:
+          dataKey       -> clave AES-256 cifrada con RSA-OAEP (nuestra clave privada)
+          data          -> JSON del mensaje, AES-256-CBC (IV = primeros 16 bytes de la clave)
+          dataSignature -> HMAC-SHA256(clave, data)
+      - cada POST trae validationTokens (JWT de Microsoft) que se validan contra
+        el JWKS cacheado antes de confiar en el contenido
+    Si algo no valida, la notificación sigue el camino normal (GET del mensaje).
+    """
+
+    def __init__(self) -> None:
+        self._private_key: Any = None
+        self._cert_der: bytes | None = None
+        self._jwks: dict[str, jwt.PyJWK] = {}
+        self._jwks_at = 0.0
+        self._jwks_lock: asyncio.Lock | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(int(settings.RICH_NOTIFICATIONS_ENABLED))
+
+    # ============================
+    # Certificado (el mismo de GraphAuth)
+    # ============================
+
+    def _load_material(self) -> None:
+        if self._private_key is not None:
+            return
+        if not settings.GRAPH_CERT_PRIVATE_KEY_PATH:
+            raise RichNotificationError("GRAPH_CERT_PRIVATE_KEY_PATH is required for rich notifications")
+        key_path = Path(settings.GRAPH_CERT_PRIVATE_KEY_PATH).expanduser()
+        # GRAPH_CERT_PATH vacío: el certificado viene en el mismo PEM que la clave
+        cert_path = Path(settings.GRAPH_CERT_PATH).expanduser() if settings.GRAPH_CERT_PATH else key_path
+        try:
+            cert = x509.load_pem_x509_certificate(cert_path.read_bytes())
+        except ValueError:
+            raise RichNotificationError(f"No PEM certificate in {cert_path} (set GRAPH_CERT_PATH)")
+        self._cert_der = cert.public_bytes(serialization.Encoding.DER)
+        self._private_key = serialization.load_pem_private_key(key_path.read_bytes(), password=None)
+
+    @property
+    def certificate_id(self) -> str:
+        self._load_material()
+        assert self._cert_der is not None
+        thumb = settings.GRAPH_CERT_THUMBPRINT.strip().replace(" ", "").lower()
+        return thumb or hashlib.sha1(self._cert_der).hexdigest()
+
+    def subscription_fields(self) -> dict[str, Any]:
+        """
+        Campos extra del POST /subscriptions para recibir el recurso cifrado.
+        """
+        self._load_material()
+        assert self._cert_der is not None
+        return {
+            "includeResourceData": True,
+            "encryptionCertificate": base64.b64encode(self._cert_der).decode("ascii"),
+            "encryptionCertificateId": self.certificate_id,
+        }
+
+    # ============================
+    # Descifrado
+    # ============================
+
+    def decrypt(self, encrypted: dict[str, Any]) -> dict[str, Any]:
+        self._load_material()
+        cert_id = encrypted.get("encryptionCertificateId")
+        if cert_id and str(cert_id).lower() != self.certificate_id:
+            raise RichNotificationError(f"Unknown encryptionCertificateId={cert_id}")
+
+        key = self._private_key.decrypt(
+            base64.b64decode(encrypted["dataKey"]),
+            padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA1()), algorithm=hashes.SHA1(), label=None),
+        )
+        data = base64.b64decode(encrypted["data"])
+
+        signature = hmac.new(key, data, hashlib.sha256).digest()
+        if not hmac.compare_digest(signature, base64.b64decode(encrypted.get("dataSignature") or "")):
+            raise RichNotificationError("dataSignature mismatch")
+
+        decryptor = Cipher(algorithms.AES(key), modes.CBC(key[:16])).decryptor()
+        unpadder = sym_padding.PKCS7(128).unpadder()
+        plain = unpadder.update(decryptor.update(data) + decryptor.finalize()) + unpadder.finalize()
+        return json.loads(plain.decode("utf-8"))
+
+    # ============================
+    # validationTokens
+    # ============================
+
+    async def _fetch_jwks(self) -> None:
+        async with httpx.AsyncClient(timeout=10) as client:
+            resp = await client.get(settings.GRAPH_JWKS_URL)
+            resp.raise_for_status()
+            keys = resp.json().get("keys") or []
+        jwks: dict[str, jwt.PyJWK] = {}
+        for k in keys:
+            try:
+                if k.get("kid"):
+                    jwks[str(k["kid"])] = jwt.PyJWK(k)
+            except jwt.PyJWTError:
+                continue
+        self._jwks = jwks
+        self._jwks_at = time.monotonic()
+        logger.info("JWKS loaded | keys=%s", len(jwks))
+
+    async def _signing_key(self, kid: str) -> jwt.PyJWK:
+        if self._jwks_lock is None:
+            self._jwks_lock = asyncio.Lock()
+        age = time.monotonic() - self._jwks_at
+        if kid not in self._jwks or age >= int(settings.GRAPH_JWKS_CACHE_SECONDS):
+            async with self._jwks_lock:
+                age = time.monotonic() - self._jwks_at
+                stale = age >= int(settings.GRAPH_JWKS_CACHE_SECONDS)
+                if stale or (kid not in self._jwks and age >= _JWKS_MIN_REFRESH_SECONDS):
+                    await self._fetch_jwks()
+        key = self._jwks.get(kid)
+        if key is None:
+            raise RichNotificationError(f"Unknown signing key kid={kid}")
+        return key
+
+    async def validate_tokens(self, tokens: list[str]) -> bool:
+        """
+        Todos los validationTokens deben ser JWT válidos de Microsoft para nuestra app.
+        """
+        if not tokens:
+            return False
+        issuers = {
+            f"https://sts.windows.net/{settings.GRAPH_TENANT_ID}/",
+            f"https://login.microsoftonline.com/{settings.GRAPH_TENANT_ID}/v2.0",
+        }
+        for token in tokens:
+            try:
+                kid = str(jwt.get_unverified_header(token).get("kid") or "")
+                key = await self._signing_key(kid)
+                claims = jwt.decode(
+                    token,
+                    key.key,
+                    algorithms=["RS256"],
+                    audience=settings.GRAPH_CLIENT_ID,
+                    options={"require": ["exp", "iss", "aud"]},
+                    leeway=60,
+                )
+            except (jwt.PyJWTError, RichNotificationError, httpx.HTTPError) as e:
+                logger.warning("Rich notification validationToken rejected: %s", e)
+                return False
+            if claims.get("iss") not in issuers:
+                logger.warning("Rich notification validationToken rejected: iss=%s", claims.get("iss"))
+                return False
+            if claims.get("azp", claims.get("appid")) != GRAPH_NOTIFICATIONS_APP_ID:
+                logger.warning("Rich notification validationToken rejected: azp=%s", claims.get("azp"))
+                return False
+        return True
+
+    # ============================
+    # Entrada desde sync_service
+    # ============================
+
+    async def extract_messages(
+        self,
+        *,
+        notifications: list[dict[str, Any]],
+        validation_tokens: list[str] | None,
+    ) -> dict[str, dict[str, Any]]:
+        """
+        {message_id: mensaje descifrado} de las notificaciones con encryptedContent.
+        Vacío si no hay contenido cifrado o si los validationTokens no validan.
+        """
+        encrypted = [n for n in notifications if isinstance(n.get("encryptedContent"), dict)]
+        if not encrypted:
+            return {}
+        if not await self.validate_tokens(list(validation_tokens or [])):
+            logger.warning("Rich notifications ignored (validationTokens invalid) -> falling back to GET | notifications=%s", len(encrypted))
+            return {}
+
+        def _decrypt_all() -> dict[str, dict[str, Any]]:
+            out: dict[str, dict[str, Any]] = {}
+            for n in encrypted:
+                try:
+                    msg = self.decrypt(n["encryptedContent"])
+                except Exception as e:
+                    logger.warning("Rich notification decrypt failed: %s", e)
+                    continue
+                rd = n.get("resourceData") if isinstance(n.get("resourceData"), dict) else {}
+                mid = str(msg.get("id") or rd.get("id") or "")
+                if mid:
+                    out[mid] = {"id": mid, **msg}
+            return out
+
+        # RSA por notificación: fuera del event loop
+        return await asyncio.to_thread(_decrypt_all)
+
+
+rich_notifications = RichNotifications()
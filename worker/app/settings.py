@@ -26,6 +26,15 @@ class Settings(BaseSettings):
     PORT: int = 8001
     WORKER_INSTANCE_ID: str = "worker-01"
 
+    # Multi-proceso (uvicorn --workers N): jobs programados solo en el proceso líder (GET_LOCK)
+    LEADER_ELECTION_ENABLED: int = 1
+    LEADER_CHECK_SECONDS: int = 10
+
+    # Multi-instancia: leases de trabajo programado (delta por carpeta, rol de suscripciones)
+    WORK_LEASES_ENABLED: int = 1
+    WORK_LEASE_TTL_SECONDS: int = 60  # sin latido en este tiempo, otra instancia toma el trabajo
+    WORK_LEASE_HEARTBEAT_SECONDS: int = 15
+
     # DB
     DB_DIALECT: str = "mysql"
     DB_HOST: str = "127.0.0.1"
@@ -35,6 +44,7 @@ class Settings(BaseSettings):
     DB_PASSWORD: str = ""
     DB_POOL_SIZE: int = 10
     DB_MAX_OVERFLOW: int = 20
+    DB_EXECUTOR_THREADS: int = 0  # threads para DB desde async (0 = DB_POOL_SIZE)
     DB_CONFIG_ENABLED: int = 0
     MAILBOX_ID: int | None = None
 
@@ -43,6 +53,10 @@ class Settings(BaseSettings):
     MAX_ATTACHMENT_SIZE_MB: int = 25
     ALLOWED_ATTACHMENT_EXT: str = "pdf,doc,docx,xls,xlsx,png,jpg,jpeg,txt,zip"
     BLOCKED_ATTACHMENT_EXT: str = "exe,bat,cmd,js,vbs,msi,ps1,jar,com,scr,lnk"
+    ATTACHMENT_STREAMING: int = 1  # descarga /$value en chunks directo a disco
+    ATTACHMENT_CONCURRENCY: int = 4  # descargas simultáneas por proceso
+    ATTACHMENT_IO_THREADS: int = 4  # pool para base64/sha256/escritura a disco
+    ATTACHMENT_MAX_INFLIGHT_MB: int = 100  # tope de bytes en vuelo por proceso
 
     # Graph
     GRAPH_TENANT_ID: str = ""
@@ -52,24 +66,103 @@ class Settings(BaseSettings):
     # Prod recomendado
     GRAPH_CERT_PRIVATE_KEY_PATH: str = ""
     GRAPH_CERT_THUMBPRINT: str = ""
+    GRAPH_CERT_PATH: str = ""  # certificado público PEM (vacío = dentro de GRAPH_CERT_PRIVATE_KEY_PATH)
+
+    # Token: se renueva en background este margen antes de expirar
+    GRAPH_TOKEN_REFRESH_MARGIN_SECONDS: int = 300
+    GRAPH_TOKEN_CACHE_PATH: str = ""  # vacío = solo memoria; si no, cache MSAL serializado en disco
 
     GRAPH_CLIENT_STATE: str = ""
+
+    # Rich notifications (includeResourceData): el mensaje llega cifrado en el webhook, sin GET
+    RICH_NOTIFICATIONS_ENABLED: int = 0
+    RICH_SUBSCRIPTION_LIFETIME_MINUTES: int = 1380  # Graph: máx. 1 día con resource data
+    GRAPH_JWKS_URL: str = "https://login.microsoftonline.com/common/discovery/v2.0/keys"
+    GRAPH_JWKS_CACHE_SECONDS: int = 86400
     MAILBOX_EMAIL: str = ""
     PUBLIC_BASE_URL: str = ""
 
+    # Graph HTTP client (pool compartido, keep-alive)
+    GRAPH_HTTP2: int = 1
+    GRAPH_HTTP_TIMEOUT_SECONDS: int = 60
+    GRAPH_POOL_MAX_CONNECTIONS: int = 20
+    GRAPH_POOL_MAX_KEEPALIVE: int = 10
+    GRAPH_POOL_KEEPALIVE_EXPIRY_SECONDS: int = 90
+
+    # Graph throttling por buzón (token bucket + pausa global en Retry-After + AIMD)
+    GRAPH_THROTTLE_ENABLED: int = 1
+    GRAPH_RATE_PER_SECOND: float = 15.0  # Graph Outlook: ~10.000 req / 10 min por buzón
+    GRAPH_RATE_BURST: int = 20  # >= 20 para que un $batch completo pase de una vez
+    GRAPH_CONCURRENCY_INITIAL: int = 4
+    GRAPH_CONCURRENCY_MIN: int = 1
+    GRAPH_CONCURRENCY_MAX: int = 16
+    GRAPH_AIMD_DECREASE: float = 0.5  # factor multiplicativo al recibir 429/503
+
     # Subscriptions
     AUTO_ENSURE_SUBSCRIPTION: int = 0
     SUBSCRIPTION_CHANGE_TYPE: str = "created"
     SUBSCRIPTION_RESOURCE: str = "users/{MAILBOX_EMAIL}/mailFolders('Inbox')/messages"
     SUBSCRIPTION_LIFETIME_MINUTES: int = 10080
     SUB_RENEW_THRESHOLD_MINUTES: int = 1440
+    # lifecycleNotificationUrl ({PUBLIC_BASE_URL}/graph/lifecycle): missed / subscriptionRemoved / reauthorizationRequired
+    LIFECYCLE_NOTIFICATIONS_ENABLED: int = 1
+
+    # Cache de datos de referencia (mailboxes, estados, carpetas, system_config)
+    REF_CACHE_TTL_SECONDS: int = 300
+
+    # Números de caso: reserva por bloques por worker
+    CASE_NUMBER_BLOCK_SIZE: int = 100
+
+    # Dedupe antes de ir a Graph (LRU en memoria; 0 = desactivado)
+    DEDUPE_CACHE_SIZE: int = 50000
+
+    # Webhook inbox (cola durable en MySQL)
+    INBOX_CONSUMERS: int = 4
+    INBOX_CLAIM_BATCH: int = 5
+    INBOX_POLL_SECONDS: int = 5
+    INBOX_LEASE_SECONDS: int = 300  # PROCESSING más viejo que esto se re-toma
+    INBOX_MAX_ATTEMPTS: int = 5
+    INBOX_DRAIN_TIMEOUT_SECONDS: int = 20
+    INBOX_HIGH_WATERMARK: int = 500  # pending >= esto => WARNING en métricas
+    INBOX_METRICS_INTERVAL_SECONDS: int = 60
+    INBOX_KEEP_DAYS: int = 7
+
+    # Ingesta: chunks (hasta 20 mensajes) en vuelo por proceso, webhook + delta juntos
+    INGEST_CONCURRENCY: int = 6
+    NOTIFICATION_CONCURRENCY: int = 4  # chunks simultáneos por lote de notificaciones
 
     # Delta backstop
     DELTA_ENABLED: int = 1
     DELTA_INTERVAL_MINUTES: int = 10
     DELTA_PAGE_SIZE: int = 50
     DELTA_MAX_PAGES_PER_RUN: int = 25
-    DELTA_CONCURRENCY: int = 3   
+    DELTA_CONCURRENCY: int = 3  # chunks simultáneos por página delta (dentro de INGEST_CONCURRENCY)
+    DELTA_FOLDER_CONCURRENCY: int = 3  # carpetas en paralelo por corrida (por buzón)
+    DELTA_MAILBOX_CONCURRENCY: int = 4  # buzones en paralelo por corrida
+    DELTA_PREFETCH_PAGES: int = 1  # páginas delta pedidas por adelantado mientras se procesa la actual
+
+    # Agenda adaptativa del delta (por carpeta; base = DELTA_LOOP_INTERVAL_SECONDS)
+    DELTA_LOOP_INTERVAL_SECONDS: int = 300
+    DELTA_LOOP_JITTER_SECONDS: int = 20
+    DELTA_MIN_INTERVAL_SECONDS: int = 60
+    DELTA_MAX_INTERVAL_SECONDS: int = 1800
+    DELTA_BACKOFF_FACTOR: float = 1.5  # solo duplicados -> intervalo * factor
+    DELTA_WEBHOOK_SILENCE_SECONDS: int = 900  # sin webhooks (y con tráfico esperado) -> mínimo
+    DELTA_SCHEDULER_TICK_SECONDS: int = 15
+
+    # Checkpoint delta (write-behind de graph_delta_state)
+    DELTA_CHECKPOINT_EVERY_PAGES: int = 5
+    DELTA_CHECKPOINT_EVERY_SECONDS: int = 30
+    DELTA_FULL_PAYLOAD: int = 1  # delta trae el mensaje completo (sin GET adicional)
+
+    # Backfill histórico (ventanas por receivedDateTime, carril de baja prioridad)
+    BACKFILL_WINDOW_DAYS: int = 7
+    BACKFILL_PAGE_SIZE: int = 200
+    BACKFILL_WINDOW_CONCURRENCY: int = 2  # ventanas en paralelo
+    BACKFILL_CONCURRENCY: int = 4  # chunks simultáneos por página de backfill
+    BACKFILL_INGEST_SLOTS: int = 2  # tope de INGEST_CONCURRENCY para baja prioridad
+    BACKFILL_LEASE_SECONDS: int = 600
+    BACKFILL_MAX_ATTEMPTS: int = 5
 
     # Admin
     ADMIN_API_KEY: str = ""
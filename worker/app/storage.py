@@ -1,12 +1,29 @@
 from __future__ import annotations
 
+import asyncio
+import base64
 import hashlib
 import mimetypes
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
+from typing import Any, AsyncIterator, Callable
 
 from app.settings import settings
 
+# Pool dedicado: base64/sha256/escritura a disco NO corren en el event loop
+_io_executor = ThreadPoolExecutor(
+    max_workers=max(1, int(settings.ATTACHMENT_IO_THREADS)),
+    thread_name_prefix="attachments-io",
+)
+
+
+async def run_io(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor, partial(fn, *args, **kwargs))
+
 
 @dataclass
 class StoredAttachment:
@@ -60,6 +77,11 @@ def sha256_bytes(data: bytes) -> str:
     return h.hexdigest()
 
 
+def _final_rel_path(digest: str, filename: str) -> Path:
+    safe_name = Path(filename).name
+    return Path(digest[:2]) / digest[2:4] / f"{digest}_{safe_name}"
+
+
 def save_attachment_bytes(filename: str, content_bytes: bytes, content_type: str | None = None) -> StoredAttachment:
     base = attachments_base_dir()
 
@@ -68,8 +90,7 @@ def save_attachment_bytes(filename: str, content_bytes: bytes, content_type: str
 
     digest = sha256_bytes(content_bytes)
 
-    safe_name = Path(filename).name
-    rel_path = Path(digest[:2]) / digest[2:4] / f"{digest}_{safe_name}"
+    rel_path = _final_rel_path(digest, filename)
     abs_path = base / rel_path
     abs_path.parent.mkdir(parents=True, exist_ok=True)
     tmp_path = abs_path.with_suffix(abs_path.suffix + ".tmp")
@@ -84,3 +105,92 @@ def save_attachment_bytes(filename: str, content_bytes: bytes, content_type: str
         size_bytes=size_bytes,
         content_type=ct,
     )
+
+
+def save_attachment_b64(filename: str, content_b64: str, content_type: str | None = None) -> StoredAttachment:
+    """
+    Decodifica + guarda (pensado para correr en el pool vía run_io).
+    ValueError si el base64 es inválido o el adjunto no pasa validación.
+    """
+    try:
+        raw = base64.b64decode(content_b64)
+    except Exception as e:
+        raise ValueError("Invalid base64 attachment") from e
+    return save_attachment_bytes(filename=filename, content_bytes=raw, content_type=content_type)
+
+
+class _PartFile:
+    """
+    Archivo .part con sha256 y tamaño incrementales. Métodos bloqueantes:
+    se llaman desde el pool de IO.
+    """
+
+    def __init__(self, base: Path) -> None:
+        tmp_dir = base / "tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        self.path = tmp_dir / f"{uuid.uuid4().hex}.part"
+        self._f = self.path.open("wb")
+        self._h = hashlib.sha256()
+        self.size_bytes = 0
+
+    def write(self, chunk: bytes) -> None:
+        self._h.update(chunk)
+        self._f.write(chunk)
+        self.size_bytes += len(chunk)
+
+    def commit(self, base: Path, filename: str) -> tuple[Path, str]:
+        self._f.close()
+        digest = self._h.hexdigest()
+        rel_path = _final_rel_path(digest, filename)
+        abs_path = base / rel_path
+        abs_path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.replace(abs_path)
+        return rel_path, digest
+
+    def discard(self) -> None:
+        self._f.close()
+        self.path.unlink(missing_ok=True)
+
+
+async def save_attachment_stream(
+    filename: str,
+    chunks: AsyncIterator[bytes],
+    content_type: str | None = None,
+) -> StoredAttachment:
+    """
+    Igual que save_attachment_bytes pero consumiendo chunks:
+    - SHA-256 y tamaño se calculan incrementalmente (en el pool de IO).
+    - Se aborta (ValueError) apenas se supera MAX_ATTACHMENT_SIZE_MB.
+    - Se escribe a un .part temporal y al final se mueve a su ruta por digest.
+    """
+    base = attachments_base_dir()
+
+    # Extensión se valida antes de bajar nada
+    validate_attachment(filename=filename, size_bytes=0, content_type=content_type or "")
+
+    limit = settings.max_attachment_bytes()
+    part = await run_io(_PartFile, base)
+
+    try:
+        async for chunk in chunks:
+            if part.size_bytes + len(chunk) > limit:
+                raise ValueError(f"Attachment too large: >{limit} bytes")
+            await run_io(part.write, chunk)
+
+        rel_path, digest = await run_io(part.commit, base, filename)
+    except BaseException:
+        await run_io(part.discard)
+        # cierra el stream HTTP si quedó a medias
+        aclose = getattr(chunks, "aclose", None)
+        if aclose is not None:
+            await aclose()
+        raise
+
+    ct = content_type or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    return StoredAttachment(
+        storage_path=rel_path.as_posix(),
+        sha256=digest,
+        size_bytes=part.size_bytes,
+        content_type=ct,
+    )
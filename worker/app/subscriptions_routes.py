@@ -3,7 +3,8 @@ from __future__ import annotations
 from fastapi import APIRouter, Header, HTTPException, Query
 
 from app.settings import settings
-from app.subscriptions_service import ensure_subscription
+from app import ref_cache
+from app.subscriptions_service import ensure_subscription, ensure_subscriptions
 
 router = APIRouter(prefix="/graph/subscription", tags=["graph-subscription"])
 
@@ -18,7 +19,10 @@ def _check_admin_key(x_admin_key: str | None) -> None:
 @router.post("/ensure")
 async def ensure(
     dry_run: bool = Query(default=False),
+    mailbox: str | None = Query(default=None),
     x_admin_key: str | None = Header(default=None),
 ) -> dict:
     _check_admin_key(x_admin_key)
-    return await ensure_subscription(dry_run=dry_run)
+    if mailbox:
+        return await ensure_subscription(dry_run=dry_run, mailbox_id=await ref_cache.mailbox_id_for(mailbox))
+    return await ensure_subscriptions(dry_run=dry_run)
@@ -1,12 +1,15 @@
 from __future__ import annotations
 
 import logging
+import re
 from datetime import datetime, timedelta, timezone
+from typing import Any
 
 from app.settings import settings
-from app.graph_client import graph_client
-from app.db import get_db_session
-from app import repos
+from app.graph_client import graph_client, FOLDER_CODE_TO_GRAPH, MESSAGE_SELECT_FIELDS, GraphSubscriptionNotFound
+from app.rich_notifications import rich_notifications
+from app.db import get_async_db_session, run_db
+from app import repos, ref_cache
 
 logger = logging.getLogger("app.subscriptions_service")
 
@@ -16,100 +19,253 @@ def _utc_iso(dt: datetime) -> str:
     return dt.replace(microsecond=0).isoformat().replace("+00:00", "Z")
 
 
-def _resolve_resource() -> str:
-    return settings.SUBSCRIPTION_RESOURCE.replace("{MAILBOX_EMAIL}", settings.MAILBOX_EMAIL)
+def _resolve_resource(mailbox_email: str) -> str:
+    resource = settings.SUBSCRIPTION_RESOURCE.replace("{MAILBOX_EMAIL}", mailbox_email)
+    if rich_notifications.enabled and "$select=" not in resource:
+        # Outlook con includeResourceData exige $select: los mismos campos que get_message
+        fields = ",".join(f for f in MESSAGE_SELECT_FIELDS if f != "id")
+        resource = f"{resource}{'&' if '?' in resource else '?'}$select={fields}"
+    return resource
 
 
-def _notification_url() -> str:
+def _lifetime_minutes() -> int:
+    minutes = int(settings.SUBSCRIPTION_LIFETIME_MINUTES)
+    if rich_notifications.enabled:
+        minutes = min(minutes, int(settings.RICH_SUBSCRIPTION_LIFETIME_MINUTES))
+    return minutes
+
+
+def _public_base_url() -> str:
     base = (settings.PUBLIC_BASE_URL or "").rstrip("/")
     if not base:
         raise RuntimeError("PUBLIC_BASE_URL is required")
     if not base.lower().startswith("https://"):
         raise RuntimeError("PUBLIC_BASE_URL must be HTTPS")
-    return f"{base}/graph/webhook"
+    return base
+
+
+def _notification_url() -> str:
+    return f"{_public_base_url()}/graph/webhook"
+
+
+def _lifecycle_url() -> str | None:
+    if not int(settings.LIFECYCLE_NOTIFICATIONS_ENABLED):
+        return None
+    return f"{_public_base_url()}/graph/lifecycle"
 
 
 def _needs_renew(expires_at: datetime) -> bool:
     now = datetime.now(timezone.utc).replace(tzinfo=None)
     delta = expires_at - now
-    return delta.total_seconds() <= int(settings.SUB_RENEW_THRESHOLD_MINUTES) * 60
+    # Con vida corta (rich: < 1 día) el umbral no puede cubrir toda la vida: se renovaría siempre
+    threshold = min(int(settings.SUB_RENEW_THRESHOLD_MINUTES), _lifetime_minutes() // 3)
+    return delta.total_seconds() <= threshold * 60
+
 
+async def ensure_subscriptions(dry_run: bool = False) -> dict:
+    """
+    ensure_subscription para cada buzón activo (mailboxes.is_active = 1).
+    Un buzón que falla no frena a los demás.
+    """
+    results: list[dict] = []
+    for mailbox_id, email in await ref_cache.active_mailboxes_for():
+        try:
+            results.append(await ensure_subscription(dry_run=dry_run, mailbox_id=mailbox_id))
+        except Exception as e:
+            logger.exception("Ensure subscription failed | mailbox=%s | err=%s", email, e)
+            results.append({"action": "error", "mailbox": email, "error": str(e)})
+    return {"ok": all(r.get("action") != "error" for r in results), "mailboxes": results}
 
-async def ensure_subscription(dry_run: bool = False) -> dict:
-    if not settings.MAILBOX_EMAIL:
-        raise RuntimeError("MAILBOX_EMAIL is required")
+
+async def ensure_subscription(dry_run: bool = False, *, mailbox_id: int | None = None) -> dict:
+    if mailbox_id is None:
+        mailbox_id = await ref_cache.default_mailbox_id()
+    mailbox_email = await ref_cache.mailbox_email_for(mailbox_id)
 
     notification_url = _notification_url()
-    resource = _resolve_resource()
+    resource = _resolve_resource(mailbox_email)
 
-    exp_dt = datetime.now(timezone.utc) + timedelta(minutes=int(settings.SUBSCRIPTION_LIFETIME_MINUTES))
+    exp_dt = datetime.now(timezone.utc) + timedelta(minutes=_lifetime_minutes())
 
     if dry_run:
         return {
             "action": "dry_run",
+            "mailbox": mailbox_email,
             "notification_url": notification_url,
             "resource": resource,
             "changeType": settings.SUBSCRIPTION_CHANGE_TYPE,
+            "includeResourceData": rich_notifications.enabled,
+            "lifecycle_notification_url": _lifecycle_url(),
             "would_expire_at": _utc_iso(exp_dt),
             "note": "Dry run: no se llamó a Graph (dry_run=1).",
         }
 
-    with get_db_session() as db:
-        mailbox_id = repos.get_or_create_mailbox(db, settings.MAILBOX_EMAIL)
-        repos.ensure_graph_subscriptions_table(db)
-        current = repos.get_active_subscription(db, mailbox_id=mailbox_id, resource=resource)
+    async with get_async_db_session() as adb:
+        await adb.run(repos.ensure_graph_subscriptions_table)
+        current = await adb.run(repos.get_active_subscription, mailbox_id=mailbox_id, resource=resource)
 
     if not current:
-        logger.info("Creating Graph subscription | url=%s | resource=%s", notification_url, resource)
+        logger.info("Creating Graph subscription | mailbox=%s | url=%s | resource=%s", mailbox_email, notification_url, resource)
         created = await graph_client.create_subscription(
             change_type=settings.SUBSCRIPTION_CHANGE_TYPE,
             notification_url=notification_url,
             resource=resource,
             expiration_datetime_iso=_utc_iso(exp_dt),
             client_state=settings.GRAPH_CLIENT_STATE,
+            lifecycle_notification_url=_lifecycle_url(),
+            extra=(rich_notifications.subscription_fields() if rich_notifications.enabled else None),
         )
 
         sid = created["id"]
         exp = created["expirationDateTime"]
+        ref_cache.subscription_mailboxes.put(sid, mailbox_id)
         exp_parsed = datetime.fromisoformat(exp.replace("Z", "+00:00")).astimezone(timezone.utc).replace(tzinfo=None)
 
-        with get_db_session() as db:
-            mailbox_id = repos.get_or_create_mailbox(db, settings.MAILBOX_EMAIL)
-            repos.upsert_subscription(
-                db,
-                subscription_id=sid,
-                mailbox_id=mailbox_id,
-                resource=resource,
-                notification_url=notification_url,
-                expires_at=exp_parsed,
-                status="ACTIVE",
-            )
+        await run_db(
+            repos.upsert_subscription,
+            subscription_id=sid,
+            mailbox_id=mailbox_id,
+            resource=resource,
+            notification_url=notification_url,
+            expires_at=exp_parsed,
+            status="ACTIVE",
+        )
 
-        return {"action": "created", "subscription_id": sid, "expiration": exp}
+        return {"action": "created", "mailbox": mailbox_email, "subscription_id": sid, "expiration": exp}
 
     sid = str(current[0])
     expires_at = current[1]
 
     if _needs_renew(expires_at):
-        logger.info("Renewing Graph subscription | id=%s", sid)
-        new_exp_dt = datetime.now(timezone.utc) + timedelta(minutes=int(settings.SUBSCRIPTION_LIFETIME_MINUTES))
+        logger.info("Renewing Graph subscription | mailbox=%s | id=%s", mailbox_email, sid)
+        new_exp_dt = datetime.now(timezone.utc) + timedelta(minutes=_lifetime_minutes())
         renewed = await graph_client.renew_subscription(sid, _utc_iso(new_exp_dt))
 
         exp = renewed["expirationDateTime"]
         exp_parsed = datetime.fromisoformat(exp.replace("Z", "+00:00")).astimezone(timezone.utc).replace(tzinfo=None)
 
-        with get_db_session() as db:
-            mailbox_id = repos.get_or_create_mailbox(db, settings.MAILBOX_EMAIL)
-            repos.upsert_subscription(
-                db,
-                subscription_id=sid,
-                mailbox_id=mailbox_id,
-                resource=resource,
-                notification_url=notification_url,
-                expires_at=exp_parsed,
-                status="ACTIVE",
-            )
-
-        return {"action": "renewed", "subscription_id": sid, "expiration": exp}
-
-    return {"action": "ok", "subscription_id": sid, "expiration": str(expires_at)}
+        await run_db(
+            repos.upsert_subscription,
+            subscription_id=sid,
+            mailbox_id=mailbox_id,
+            resource=resource,
+            notification_url=notification_url,
+            expires_at=exp_parsed,
+            status="ACTIVE",
+        )
+
+        return {"action": "renewed", "mailbox": mailbox_email, "subscription_id": sid, "expiration": exp}
+
+    return {"action": "ok", "mailbox": mailbox_email, "subscription_id": sid, "expiration": str(expires_at)}
+
+
+# ============================
+# Lifecycle notifications (/graph/lifecycle -> webhook_inbox -> aquí)
+# ============================
+
+
+def _affected_folder_ids(resource: str, folders: list[tuple[int, str, str | None]]) -> list[int]:
+    """
+    Carpetas cubiertas por la suscripción: la de mailFolders('X') del resource,
+    o todas las monitoreadas si el resource es el buzón completo / no se reconoce.
+    """
+    m = re.search(r"mailFolders\('([^']+)'\)", resource, flags=re.IGNORECASE)
+    if m:
+        name = m.group(1).lower()
+        hit = [
+            fid for fid, code, graph_folder_id in folders
+            if name in (code.lower(), FOLDER_CODE_TO_GRAPH.get(code.upper(), "").lower(), (graph_folder_id or "").lower())
+        ]
+        if hit:
+            return hit
+    return [fid for fid, _, _ in folders]
+
+
+async def request_delta_catchup(mailbox_id: int, *, reason: str) -> int:
+    """
+    Corrida delta inmediata de las carpetas de la suscripción del buzón.
+    Se registra en graph_delta_state: la toma el scheduler que tenga el lease
+    de cada carpeta (cualquier instancia), en su próximo tick.
+    """
+    mailbox_email = await ref_cache.mailbox_email_for(mailbox_id)
+    folders = list(await ref_cache.monitored_folders_for(mailbox_id))
+    folder_ids = _affected_folder_ids(_resolve_resource(mailbox_email), folders)
+    n = await run_db(
+        repos.request_delta_run,
+        mailbox_id=mailbox_id,
+        folder_ids=folder_ids,
+        requested_at=repos.utcnow(),
+    )
+    logger.warning("Delta catch-up requested | mailbox=%s | folders=%s | reason=%s", mailbox_email, folder_ids, reason)
+    return n
+
+
+async def _recreate_subscription(subscription_id: str, mailbox_id: int) -> dict:
+    await run_db(repos.mark_subscription_status, subscription_id=subscription_id, status="REMOVED")
+    return await ensure_subscription(mailbox_id=mailbox_id)
+
+
+async def _reauthorize_subscription(subscription_id: str, mailbox_id: int) -> dict:
+    """
+    Renueva la suscripción del evento (no la fila ACTIVE del buzón, que puede ser otra).
+    Solo si Graph ya no la tiene (404) se recrea; cualquier otro error (429 / 5xx) se propaga
+    y el inbox reintenta: recrear con la original viva duplicaría las notificaciones.
+    """
+    exp_dt = datetime.now(timezone.utc) + timedelta(minutes=_lifetime_minutes())
+    try:
+        renewed = await graph_client.renew_subscription(subscription_id, _utc_iso(exp_dt))
+    except GraphSubscriptionNotFound:
+        logger.warning("Reauthorization: subscription gone -> recreating | subscription_id=%s", subscription_id)
+        res = await _recreate_subscription(subscription_id, mailbox_id)
+        await request_delta_catchup(mailbox_id, reason="reauthorizationRequired")
+        return res
+
+    exp = renewed["expirationDateTime"]
+    exp_parsed = datetime.fromisoformat(exp.replace("Z", "+00:00")).astimezone(timezone.utc).replace(tzinfo=None)
+    await run_db(repos.update_subscription_expiry, subscription_id=subscription_id, expires_at=exp_parsed)
+    return {
+        "action": "renewed",
+        "mailbox": await ref_cache.mailbox_email_for(mailbox_id),
+        "subscription_id": subscription_id,
+        "expiration": exp,
+    }
+
+
+async def handle_lifecycle_notifications(notifications: list[dict[str, Any]]) -> list[dict]:
+    """
+    - missed                  -> delta inmediato de la(s) carpeta(s) de la suscripción
+    - subscriptionRemoved     -> recrear ya + delta (lo que llegó mientras no existía)
+    - reauthorizationRequired -> renovar esa suscripción ya (solo si Graph da 404: recrear + delta)
+    Un error se propaga: el ítem del inbox se reintenta con backoff.
+    """
+    results: list[dict] = []
+    seen: set[tuple[str, str]] = set()
+    for n in notifications:
+        event = str(n.get("lifecycleEvent") or "")
+        sid = str(n.get("subscriptionId") or "")
+        if (sid, event) in seen:
+            continue
+        seen.add((sid, event))
+
+        mailbox_id = await ref_cache.mailbox_for_subscription(sid) if sid else None
+        if mailbox_id is None:
+            logger.warning("Lifecycle event for unknown subscription | event=%s | subscription_id=%s", event, sid or "-")
+            continue
+        logger.warning("Lifecycle event | event=%s | subscription_id=%s | mailbox_id=%s", event, sid, mailbox_id)
+
+        if event == "missed":
+            await request_delta_catchup(mailbox_id, reason="missed")
+            results.append({"event": event, "subscription_id": sid, "action": "delta_requested"})
+
+        elif event == "subscriptionRemoved":
+            res = await _recreate_subscription(sid, mailbox_id)
+            await request_delta_catchup(mailbox_id, reason="subscriptionRemoved")
+            results.append({"event": event, "subscription_id": sid, **res})
+
+        elif event == "reauthorizationRequired":
+            res = await _reauthorize_subscription(sid, mailbox_id)
+            results.append({"event": event, "subscription_id": sid, **res})
+
+        else:
+            logger.warning("Lifecycle event ignored | event=%s | subscription_id=%s", event or "-", sid)
+    return results
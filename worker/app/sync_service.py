@@ -1,20 +1,27 @@
 from __future__ import annotations
 
-import base64
+import asyncio
 import logging
+import re
 from datetime import datetime, timezone
-from typing import Any, Iterable
+from typing import Any, Callable, Iterable, TypeVar
 
 from sqlalchemy import text
 
 from app.settings import settings
-from app.graph_client import graph_client
-from app.db import get_db_session
-from app import repos
-from app.storage import save_attachment_bytes
+from app.graph_client import graph_client, GRAPH_BATCH_MAX
+from app.db import run_db
+from app import repos, ref_cache, subscriptions_service
+from app.storage import run_io, save_attachment_b64, save_attachment_stream, validate_attachment
+from app.concurrency import attachment_bytes, attachment_slots, ingest_slots, message_flights
+from app.recent_ids import recent_ids
+from app.case_numbers import case_number_allocator
+from app.rich_notifications import rich_notifications
 
 logger = logging.getLogger("app.sync_service")
 
+T = TypeVar("T")
+
 
 def _iso_to_dt(value: str | None) -> datetime | None:
     if not value:
@@ -91,6 +98,18 @@ def _normalize_notifications(payload_or_list: dict[str, Any] | list[dict[str, An
     return []
 
 
+def is_full_message(item: dict[str, Any]) -> bool:
+    """
+    True si el item (delta / rich notification) ya trae los campos que
+    _persist_message necesita, y por lo tanto no hace falta get_message.
+    """
+    return isinstance(item, dict) and bool(item.get("id")) and "receivedDateTime" in item and "body" in item
+
+
+# resource de la notificación: "Users/{id o email}/Messages/{id}" (o "Users('{id}')/Messages('{id}')")
+_RESOURCE_USER_RE = re.compile(r"^/?users(?:/|\(')([^/']+)", re.IGNORECASE)
+
+
 def _should_accept(notification: dict[str, Any]) -> bool:
     """
     Defensa extra: el webhook ya filtró por clientState,
@@ -154,48 +173,402 @@ def _attachments_count(db, *, message_pk: int) -> int:
     return int(row[0]) if row else 0
 
 
-async def process_notifications_async(payload_or_list: dict[str, Any] | list[dict[str, Any]]) -> None:
+# None = sin verificar; False = no hay UNIQUE (duplicados históricos) -> SELECT previo al upsert
+_ingest_unique: bool | None = None
+_ingest_schema_lock: asyncio.Lock | None = None
+
+
+async def ensure_ingest_schema() -> None:
     """
-    Entrada esperada desde webhook:
-      {"value":[{notification},{notification},...]}
+    ALTERs de ingesta sobre messages, una sola vez por proceso.
+    Lo llama on_startup; la ingesta solo lo re-chequea (CLI de backfill, o si falló al arrancar).
+    El lock evita que chunks concurrentes (webhook / delta / backfill) corran el mismo ALTER.
     """
-    if not settings.MAILBOX_EMAIL:
-        logger.error("MAILBOX_EMAIL missing - cannot process")
+    global _ingest_unique, _ingest_schema_lock
+    if _ingest_unique is not None:
         return
+    if _ingest_schema_lock is None:
+        _ingest_schema_lock = asyncio.Lock()
+    async with _ingest_schema_lock:
+        if _ingest_unique is not None:
+            return
+        _ingest_unique = await run_db(repos.ensure_messages_ingest_schema)
+    if not _ingest_unique:
+        logger.error(
+            "messages has duplicated (mailbox_id, provider_message_id) rows; "
+            "UNIQUE key not created, falling back to select-then-insert dedupe"
+        )
 
+
+async def process_notifications_async(payload_or_list: dict[str, Any] | list[dict[str, Any]]) -> None:
+    """
+    Entrada esperada desde webhook:
+      {"value":[{notification},{notification},...], "validationTokens": [...]}
+    Cada notificación va al buzón de su suscripción (subscriptionId -> graph_subscriptions).
+    Rich notifications (encryptedContent) se descifran aquí y van directo a persistencia.
+    Lifecycle notifications (lifecycleEvent, desde /graph/lifecycle) van a subscriptions_service.
+    """
     notifications = _normalize_notifications(payload_or_list)
 
     # filtro extra por clientState (defensa)
     notifications = [n for n in notifications if _should_accept(n)]
 
+    lifecycle = [n for n in notifications if n.get("lifecycleEvent")]
+    if lifecycle:
+        await subscriptions_service.handle_lifecycle_notifications(lifecycle)
+        notifications = [n for n in notifications if not n.get("lifecycleEvent")]
+        if not notifications:
+            return
+
     if not notifications:
         logger.info("No valid notifications to process")
         return
 
     logger.info("Processing notifications=%s", len(notifications))
 
-    # mailbox_id una sola vez
-    with get_db_session() as db:
-        mailbox_id = repos.get_or_create_mailbox(db, settings.MAILBOX_EMAIL)
+    # Mensajes que ya vienen en la notificación (cifrados): sin get_message
+    prefetched: dict[str, dict[str, Any]] = {}
+    if rich_notifications.enabled and isinstance(payload_or_list, dict):
+        decrypted = await rich_notifications.extract_messages(
+            notifications=notifications,
+            validation_tokens=payload_or_list.get("validationTokens"),
+        )
+        prefetched = {mid: msg for mid, msg in decrypted.items() if is_full_message(msg)}
+        if decrypted:
+            logger.info("Rich notifications decrypted=%s | full=%s", len(decrypted), len(prefetched))
 
+    by_mailbox: dict[int, list[str]] = {}
     for n in notifications:
         msg_id = _extract_message_id(n)
         if not msg_id:
             logger.warning("Skipping notification without message id")
             continue
+        mailbox_id = await _mailbox_for_notification(n)
+        if mailbox_id is None:
+            continue
+        by_mailbox.setdefault(mailbox_id, []).append(msg_id)
 
+    # Buzones en paralelo: cada uno con su cupo (ingest_slots reparte por buzón)
+    stats: dict[int, dict[str, int]] = {mailbox_id: {} for mailbox_id in by_mailbox}
+    await asyncio.gather(*[
+        process_message_ids_async(
+            ids,
+            mailbox_id=mailbox_id,
+            prefetched={mid: prefetched[mid] for mid in ids if mid in prefetched},
+            stats=stats[mailbox_id],
+        )
+        for mailbox_id, ids in by_mailbox.items()
+    ])
+
+    # Algún correo falló (GET / DB / adjunto): el ítem del inbox se reintenta con backoff;
+    # los que ya quedaron OK se saltan por dedupe en el reintento
+    failed = sum(st.get("failed", 0) for st in stats.values())
+    if failed:
+        raise RuntimeError(f"{failed} message(s) failed to process")
+
+
+async def _mailbox_for_notification(n: dict[str, Any]) -> int | None:
+    sid = str(n.get("subscriptionId") or "")
+    mailbox_id = await ref_cache.mailbox_for_subscription(sid) if sid else None
+    if mailbox_id is not None:
+        return mailbox_id
+
+    # Suscripción no registrada (creada a mano / tabla vacía):
+    #  - resource "Users/{usuario}/Messages/{id}" con el email de un buzón activo
+    #  - si no, solo con UN buzón activo; con varios, pedir el correo en otro buzón
+    #    daría 404 y se perdería: se descarta (el delta backstop lo trae)
+    active = await ref_cache.active_mailboxes_for()
+    m = _RESOURCE_USER_RE.match(str(n.get("resource") or ""))
+    if m:
+        user = m.group(1).lower()
+        for mid, email in active:
+            if email.lower() == user:
+                return mid
+    if len(active) == 1:
+        return active[0][0]
+    logger.warning(
+        "Skipping notification for unknown subscription_id=%s | resource=%s | active_mailboxes=%s",
+        sid or "-", str(n.get("resource") or "-")[:200], len(active),
+    )
+    return None
+
+
+async def process_message_ids_async(
+    message_ids: list[str],
+    *,
+    mailbox_id: int | None = None,
+    prefetched: dict[str, dict[str, Any]] | None = None,
+    max_parallel: int | None = None,
+    stats: dict[str, int] | None = None,
+    on_progress: Callable[[list[str]], None] | None = None,
+) -> int:
+    """
+    Procesa varios correos de una vez (ráfaga de webhook / página delta).
+    Con más de un ID usa Graph $batch (hasta 20 sub-requests por POST)
+    para get_message y list_attachments.
+    prefetched: {message_id: payload completo} (p.ej. delta con $select completo);
+    esos no se vuelven a pedir a Graph.
+    max_parallel: chunks simultáneos de esta llamada (default NOTIFICATION_CONCURRENCY);
+    además cada chunk toma un cupo de ingest_slots, compartido con delta.
+    stats: si viene, acumula {"new": ingestados ahora, "duplicates": ya conocidos/en vuelo,
+    "failed": con error}.
+    on_progress: si viene, se llama con los IDs que ya terminaron (OK o con error),
+    a medida que terminan (checkpoint delta por mensaje).
+    mailbox_id: buzón de los IDs (default: ref_cache.default_mailbox_id).
+    Retorna cuántos se procesaron OK; los errores quedan aislados por mensaje.
+    """
+    if mailbox_id is None:
+        mailbox_id = await ref_cache.default_mailbox_id()
+    mailbox_email = await ref_cache.mailbox_email_for(mailbox_id)
+
+    await ensure_ingest_schema()
+
+    # IDs repetidos en el mismo lote (created+updated del mismo correo) se procesan una vez
+    unique_ids = list(dict.fromkeys(message_ids))
+    if len(unique_ids) < len(message_ids):
+        logger.info("Collapsed duplicate message_ids %s -> %s", len(message_ids), len(unique_ids))
+
+    # Single-flight: lo que otra tarea (webhook/delta) ya está procesando no se vuelve a pedir;
+    # se espera su resultado. Lo recién ingestado (recent_ids) retorna de inmediato.
+    keys = [(mailbox_id, mid) for mid in unique_ids if (mailbox_id, mid) not in recent_ids]
+    ok_count = len(unique_ids) - len(keys)
+    owned, joined = message_flights.claim(keys)
+    if joined:
+        logger.info("Joining in-flight message_ids=%s", len(joined))
+    if on_progress is not None and len(keys) < len(unique_ids):
+        pending = {mid for _, mid in keys}
+        on_progress([mid for mid in unique_ids if mid not in pending])
+
+    ok_ids: set[str] = set()
+    fetch_set: set[str] = set()
+    try:
+        owned_ids = [mid for _, mid in owned]
+
+        # Dedupe ANTES de ir a Graph: solo desconocidos (o conocidos sin adjuntos)
+        to_fetch = await _filter_unknown_ids(mailbox_id=mailbox_id, message_ids=owned_ids) if owned_ids else []
+        fetch_set = set(to_fetch)
+        ok_ids.update(mid for mid in owned_ids if mid not in fetch_set)
+        if on_progress is not None and len(fetch_set) < len(owned_ids):
+            on_progress([mid for mid in owned_ids if mid not in fetch_set])
+
+        if to_fetch:
+            # Chunks parejos: con pocos IDs conviene repartir entre los cupos antes que llenar un $batch
+            parallel = max(1, int(max_parallel or settings.NOTIFICATION_CONCURRENCY))
+            size = min(GRAPH_BATCH_MAX, -(-len(to_fetch) // parallel))
+            chunks = [to_fetch[i : i + size] for i in range(0, len(to_fetch), size)]
+            local_slots = asyncio.Semaphore(parallel)
+            prefetched = prefetched or {}
+
+            async def _run(chunk: list[str]) -> list[str]:
+                async with local_slots, ingest_slots.slot(mailbox_id):
+                    try:
+                        done = await _process_message_chunk(
+                            mailbox_id=mailbox_id,
+                            mailbox_email=mailbox_email,
+                            message_ids=chunk,
+                            prefetched=prefetched,
+                        )
+                    except Exception as e:
+                        logger.exception("Chunk processing failed message_ids=%s err=%s", len(chunk), e)
+                        done = []
+                    # (no en finally: un chunk cancelado no cuenta como avance)
+                    if on_progress is not None:
+                        on_progress(chunk)
+                    return done
+
+            for done in await asyncio.gather(*[_run(c) for c in chunks]):
+                ok_ids.update(done)
+    finally:
+        for key in owned:
+            message_flights.release(key, key[1] in ok_ids)
+
+    ok_count += len(ok_ids)
+    if joined:
+        # shield: si este llamador se cancela, el dueño sigue y los demás reciben el resultado
+        results = await asyncio.gather(*[asyncio.shield(f) for f in joined.values()])
+        ok_count += sum(1 for r in results if r)
+        if on_progress is not None:
+            on_progress([mid for _, mid in joined])
+
+    if stats is not None:
+        new_ok = len(ok_ids & fetch_set)
+        stats["new"] = stats.get("new", 0) + new_ok
+        stats["duplicates"] = stats.get("duplicates", 0) + (len(unique_ids) - len(fetch_set))
+        stats["failed"] = stats.get("failed", 0) + (len(unique_ids) - ok_count)
+    return ok_count
+
+
+async def _filter_unknown_ids(*, mailbox_id: int, message_ids: list[str]) -> list[str]:
+    """
+    1) LRU en memoria de IDs recién ingestados.
+    2) Un solo SELECT ... IN contra messages para el resto.
+    Devuelve los IDs que SÍ deben ir a Graph:
+      - no existen en DB
+      - existen, tienen adjuntos y no hay ninguno guardado
+    """
+    candidates = [mid for mid in message_ids if (mailbox_id, mid) not in recent_ids]
+    if not candidates:
+        logger.info("Dedupe (cache) skipped=%s", len(message_ids))
+        return []
+
+    known = await run_db(repos.list_known_messages, mailbox_id=mailbox_id, provider_message_ids=candidates)
+
+    out: list[str] = []
+    for mid in candidates:
+        k = known.get(mid)
+        if k is None:
+            out.append(mid)
+            continue
+        has_att_db, att_count = k
+        if has_att_db and att_count == 0:
+            logger.warning("Attachments missing in DB for message_id=%s -> will fetch now", mid)
+            out.append(mid)
+            continue
+        recent_ids.add((mailbox_id, mid))
+
+    skipped = len(message_ids) - len(out)
+    if skipped:
+        logger.info("Dedupe before fetch | requested=%s | skipped=%s | to_fetch=%s", len(message_ids), skipped, len(out))
+    return out
+
+
+async def _process_message_chunk(
+    *,
+    mailbox_id: int,
+    mailbox_email: str,
+    message_ids: list[str],
+    prefetched: dict[str, dict[str, Any]],
+) -> list[str]:
+    """
+    Procesa un chunk (<= 20 IDs). Retorna los message_id que quedaron OK.
+    """
+    mb = mailbox_email
+
+    if len(message_ids) == 1:
         try:
-            await _process_single_message(mailbox_id=mailbox_id, message_id=msg_id)
+            await _process_single_message(
+                mailbox_id=mailbox_id,
+                mailbox_email=mb,
+                message_id=message_ids[0],
+                msg=prefetched.get(message_ids[0]),
+            )
+            recent_ids.add((mailbox_id, message_ids[0]))
+            return [message_ids[0]]
         except Exception as e:
-            logger.exception("Failed processing message_id=%s err=%s", msg_id, e)
+            logger.exception("Failed processing message_id=%s err=%s", message_ids[0], e)
+            return []
 
+    # 1) Un solo POST /$batch para los mensajes del chunk que no vienen pre-cargados
+    msgs = {mid: prefetched[mid] for mid in message_ids if mid in prefetched}
+    missing = [mid for mid in message_ids if mid not in msgs]
+    if len(missing) > 1:
+        try:
+            msgs.update(await graph_client.get_messages_batch(mb, missing))
+        except Exception as e:
+            logger.warning("Batch get_message failed (falling back to single GETs) err=%s", e)
+
+    # Lo que el batch no trajo se pide individualmente (aislado por mensaje)
+    items: list[tuple[str, dict[str, Any]]] = []
+    for mid in message_ids:
+        try:
+            msg = msgs.get(mid)
+            if msg is None:
+                msg = await graph_client.get_message(mb, mid)
+            items.append((mid, msg))
+        except Exception as e:
+            logger.exception("Failed processing message_id=%s err=%s", mid, e)
+
+    # 2) Persistencia: todo el chunk en una transacción; si falla, por mensaje (aislada)
+    persisted: dict[str, tuple[str, bool]] = {}
+    try:
+        persisted = await _run_persist(_persist_batch, new_cases=len(items), mailbox_id=mailbox_id, items=items)
+    except Exception as e:
+        logger.warning("Batch persist failed (falling back to per-message) messages=%s err=%s", len(items), e)
+        for mid, msg in items:
+            try:
+                persisted[mid] = await _run_persist(
+                    _persist_message, new_cases=1, mailbox_id=mailbox_id, message_id=mid, msg=msg
+                )
+            except Exception as e2:
+                logger.exception("Failed processing message_id=%s err=%s", mid, e2)
+
+    ok_ids: list[str] = []
+    pending_attachments: dict[str, str] = {}  # message_id -> provider_message_id
+    for mid, (provider_message_id, needs_attachments) in persisted.items():
+        if needs_attachments:
+            pending_attachments[mid] = provider_message_id
+        else:
+            ok_ids.append(mid)
+
+    # 3) list_attachments de los que lo necesitan, también en batch
+    att_lists: dict[str, list[dict[str, Any]]] = {}
+    if pending_attachments:
+        try:
+            att_lists = await graph_client.list_attachments_batch(
+                mb,
+                list(pending_attachments),
+                metadata_only=bool(settings.ATTACHMENT_STREAMING),
+            )
+        except Exception as e:
+            logger.warning("Batch list_attachments failed (falling back to single GETs) err=%s", e)
+
+    # Adjuntos de los mensajes del chunk en paralelo (acotado por attachment_slots/bytes)
+    async def _attachments(mid: str, provider_message_id: str) -> None:
+        try:
+            await _process_attachments(
+                mailbox_id=mailbox_id,
+                provider_message_id=provider_message_id,
+                mailbox_email=mb,
+                message_id=mid,
+                atts=att_lists.get(mid),
+            )
+            ok_ids.append(mid)
+        except Exception as e:
+            logger.exception("Failed processing attachments message_id=%s err=%s", mid, e)
+
+    await asyncio.gather(*[_attachments(mid, pmid) for mid, pmid in pending_attachments.items()])
+
+    for mid in ok_ids:
+        recent_ids.add((mailbox_id, mid))
+    return ok_ids
+
+
+async def _process_single_message(
+    *,
+    mailbox_id: int,
+    mailbox_email: str,
+    message_id: str,
+    msg: dict[str, Any] | None = None,
+) -> None:
+    mb = mailbox_email
 
-async def _process_single_message(*, mailbox_id: int, message_id: str) -> None:
-    mb = settings.MAILBOX_EMAIL
+    # 1) Pull full message from Graph (salvo que ya venga pre-cargado)
+    if msg is None:
+        msg = await graph_client.get_message(mb, message_id)
 
-    # 1) Pull full message from Graph
-    msg = await graph_client.get_message(mb, message_id)
+    provider_message_id, needs_attachments = await _run_persist(
+        _persist_message,
+        new_cases=1,
+        mailbox_id=mailbox_id,
+        message_id=message_id,
+        msg=msg,
+    )
+
+    # 3) Attachments fuera de la transacción
+    if needs_attachments:
+        await _process_attachments(
+            mailbox_id=mailbox_id,
+            provider_message_id=provider_message_id,
+            mailbox_email=mb,
+            message_id=message_id,
+        )
 
+
+def _parse_message(message_id: str, msg: dict[str, Any]) -> dict[str, Any]:
+    """
+    Payload de Graph -> campos listos para repos.insert_message_inbound
+    (sin case_id / mailbox_id / folder_id) + datos del caso.
+    """
     provider_message_id = str(msg.get("id") or message_id)
     subject = str(msg.get("subject") or "(Sin asunto)")
 
@@ -203,12 +576,7 @@ async def _process_single_message(*, mailbox_id: int, message_id: str) -> None:
     from_email = ((from_obj.get("emailAddress") or {}).get("address")) or "unknown@unknown"
     from_name = ((from_obj.get("emailAddress") or {}).get("name")) or None
 
-    to_emails = _emails(msg.get("toRecipients"))
-    cc_emails = _emails(msg.get("ccRecipients"))
-    bcc_emails = _emails(msg.get("bccRecipients"))
-
     received_at = _iso_to_dt(msg.get("receivedDateTime")) or datetime.now(timezone.utc).replace(tzinfo=None)
-    sent_at = _iso_to_dt(msg.get("sentDateTime"))
 
     internet_message_id = msg.get("internetMessageId")
     conversation_id = msg.get("conversationId")
@@ -221,212 +589,404 @@ async def _process_single_message(*, mailbox_id: int, message_id: str) -> None:
     body_type = (body.get("contentType") or "").lower()
     body_content = body.get("content") or ""
 
-    body_html = body_content if body_type == "html" else None
-    body_text = body_content if body_type != "html" else None
+    return {
+        "provider_message_id": provider_message_id,
+        "conversation_id": (str(conversation_id) if conversation_id else None),
+        "internet_message_id": (str(internet_message_id) if internet_message_id else None),
+        "in_reply_to": (str(in_reply_to) if in_reply_to else None),
+        "from_email": str(from_email),
+        "from_name": (str(from_name) if from_name else None),
+        "to_emails": _emails(msg.get("toRecipients")),
+        "cc_emails": _emails(msg.get("ccRecipients")),
+        "bcc_emails": _emails(msg.get("bccRecipients")),
+        "subject": subject,
+        "body_text": (body_content if body_type != "html" else None),
+        "body_html": (body_content if body_type == "html" else None),
+        "received_at": received_at,
+        "sent_at": _iso_to_dt(msg.get("sentDateTime")),
+        "has_attachments": 1 if msg.get("hasAttachments") else 0,
+    }
+
+
+def _message_row(p: dict[str, Any], *, case_id: int, mailbox_id: int) -> dict[str, Any]:
+    return {
+        "case_id": case_id,
+        "mailbox_id": mailbox_id,
+        "folder_id": None,
+        "provider_message_id": p["provider_message_id"],
+        "conversation_id": p["conversation_id"],
+        "internet_message_id": p["internet_message_id"],
+        "in_reply_to": p["in_reply_to"],
+        "from_email": p["from_email"],
+        "to_emails": p["to_emails"],
+        "cc_emails": p["cc_emails"],
+        "bcc_emails": p["bcc_emails"],
+        "subject": p["subject"],
+        "body_text": p["body_text"],
+        "body_html": p["body_html"],
+        "received_at": p["received_at"],
+        "sent_at": p["sent_at"],
+        "has_attachments": p["has_attachments"],
+        "processed_by_worker": settings.WORKER_INSTANCE_ID,
+    }
+
+
+def _event_row(p: dict[str, Any], *, case_id: int, event_type: str) -> dict[str, Any]:
+    return {
+        "case_id": case_id,
+        "actor_user_id": None,
+        "source": "WORKER",
+        "event_type": event_type,
+        "from_status_id": None,
+        "to_status_id": None,
+        "details": {
+            "provider_message_id": p["provider_message_id"],
+            "conversation_id": p["conversation_id"],
+            "from_email": p["from_email"],
+            "subject": p["subject"],
+        },
+    }
+
+
+async def _run_persist(fn: Callable[..., T], *, new_cases: int, **kwargs: Any) -> T:
+    """
+    run_db(fn, case_numbers=[...]) con los números de caso reservados ANTES de la
+    transacción (a lo sumo uno por correo); los no usados vuelven al allocator.
+    """
+    numbers = await case_number_allocator.take(new_cases)
+    try:
+        result = await run_db(fn, case_numbers=numbers, **kwargs)
+    except asyncio.CancelledError:
+        raise  # el thread de DB puede seguir usando `numbers`: no se devuelven (huecos)
+    except Exception:
+        case_number_allocator.give_back(numbers)
+        raise
+    case_number_allocator.give_back(numbers)
+    return result
 
-    has_attachments = 1 if msg.get("hasAttachments") else 0
 
-    # 2) Persistencia (transacción corta y SIN awaits)
-    case_id: int | None = None
-    message_pk_existing: int | None = None
-    should_process_attachments_even_if_dedupe = False
-    event_type: str = "CASE_CREATED"
+def _new_case_for(db, p: dict[str, Any], *, mailbox_id: int, case_numbers: list[str]) -> int:
+    if not case_numbers:
+        raise RuntimeError("No case numbers reserved for this persist call")
+    return repos.create_case(
+        db,
+        mailbox_id=mailbox_id,
+        subject=p["subject"],
+        requester_email=p["from_email"],
+        requester_name=p["from_name"],
+        received_at=p["received_at"],
+        case_number=case_numbers.pop(0),
+        status_id=ref_cache.get_status_id(db, "NUEVO"),
+    )
 
-    with get_db_session() as db:
-        # ✅ Dedupe duro por provider_message_id
+
+def _persist_message(
+    db,
+    *,
+    mailbox_id: int,
+    message_id: str,
+    msg: dict[str, Any],
+    case_numbers: list[str],
+) -> tuple[str, bool]:
+    """
+    Caso + mensaje + evento en una transacción corta, con dedupe atómico:
+    el upsert de messages (UNIQUE mailbox_id + provider_message_id) dice en el
+    mismo statement si el correo ya existía; caso/evento solo si es nuevo.
+    Corre en el pool de DB: await _run_persist(_persist_message, new_cases=1, ...).
+    case_numbers: reservados por _run_persist; se consumen (pop) los que se usan.
+    Retorna (provider_message_id, needs_attachments).
+    """
+    p = _parse_message(message_id, msg)
+    provider_message_id = p["provider_message_id"]
+    has_attachments = p["has_attachments"]
+
+    if not _ingest_unique:
+        # Sin UNIQUE el upsert no detecta duplicados: dedupe por SELECT previo
         existing = _get_existing_message_row(db, mailbox_id=mailbox_id, provider_message_id=provider_message_id)
         if existing:
             message_pk_existing, case_id_existing, has_att_db = existing
             logger.info("Dedupe hit message_id=%s case_id=%s", provider_message_id, case_id_existing)
+            return provider_message_id, _dedupe_needs_attachments(
+                db, message_pk=message_pk_existing, has_attachments=bool(has_att_db or has_attachments)
+            )
 
-            # Si el mensaje indica adjuntos y no hay adjuntos guardados, intentamos recuperarlos
-            if has_att_db or has_attachments:
-                if _attachments_count(db, message_pk=message_pk_existing) == 0:
-                    should_process_attachments_even_if_dedupe = True
-                    logger.warning("Attachments missing in DB for message_id=%s -> will fetch now", provider_message_id)
-
-            # Si fue dedupe, no creamos nada nuevo
-            case_id = case_id_existing
+    # Reusar caso por conversationId (hilo)
+    case_id: int | None = None
+    if p["conversation_id"]:
+        case_id = _find_case_by_conversation(db, mailbox_id=mailbox_id, conversation_id=p["conversation_id"])
+
+    if case_id:
+        event_type = "MESSAGE_ADDED"
+        message_pk, inserted = repos.insert_message_inbound(db, **_message_row(p, case_id=case_id, mailbox_id=mailbox_id))
+    else:
+        # Caso nuevo dentro de un savepoint: si el mensaje resulta duplicado se descarta
+        event_type = "CASE_CREATED"
+        savepoint = db.begin_nested()
+        case_id = _new_case_for(db, p, mailbox_id=mailbox_id, case_numbers=case_numbers)
+        message_pk, inserted = repos.insert_message_inbound(db, **_message_row(p, case_id=case_id, mailbox_id=mailbox_id))
+        if inserted:
+            savepoint.commit()
         else:
-            # Reusar caso por conversationId (hilo)
-            if conversation_id:
-                case_id = _find_case_by_conversation(db, mailbox_id=mailbox_id, conversation_id=str(conversation_id))
-
-            if case_id:
-                event_type = "MESSAGE_ADDED"
-            else:
-                case_id = repos.create_case(
-                    db,
-                    mailbox_id=mailbox_id,
-                    subject=subject,
-                    requester_email=str(from_email),
-                    requester_name=(str(from_name) if from_name else None),
-                    received_at=received_at,
-                )
-                event_type = "CASE_CREATED"
+            savepoint.rollback()
 
-            repos.insert_message_inbound(
-                db,
-                case_id=case_id,
-                mailbox_id=mailbox_id,
-                folder_id=None,
-                provider_message_id=provider_message_id,
-                conversation_id=(str(conversation_id) if conversation_id else None),
-                internet_message_id=(str(internet_message_id) if internet_message_id else None),
-                in_reply_to=(str(in_reply_to) if in_reply_to else None),
-                from_email=str(from_email),
-                to_emails=to_emails,
-                cc_emails=cc_emails,
-                bcc_emails=bcc_emails,
-                subject=subject,
-                body_text=body_text,
-                body_html=body_html,
-                received_at=received_at,
-                sent_at=sent_at,
-                has_attachments=has_attachments,
-                processed_by_worker=settings.WORKER_INSTANCE_ID,
-            )
+    if not inserted:
+        logger.info("Dedupe hit message_id=%s message_pk=%s", provider_message_id, message_pk)
+        return provider_message_id, _dedupe_needs_attachments(
+            db, message_pk=message_pk, has_attachments=bool(has_attachments)
+        )
 
-            _touch_case_activity(db, case_id=case_id, last_activity_at=received_at)
-
-            repos.insert_case_event(
-                db,
-                case_id=case_id,
-                actor_user_id=None,
-                source="WORKER",
-                event_type=event_type,
-                from_status_id=None,
-                to_status_id=None,
-                details={
-                    "provider_message_id": provider_message_id,
-                    "conversation_id": (str(conversation_id) if conversation_id else None),
-                    "from_email": from_email,
-                    "subject": subject,
-                },
-            )
+    _touch_case_activity(db, case_id=case_id, last_activity_at=p["received_at"])
 
-    # 3) Attachments fuera de la transacción
-    if (has_attachments or should_process_attachments_even_if_dedupe) and mailbox_id is not None:
-        await _process_attachments(
-            mailbox_id=mailbox_id,
-            provider_message_id=provider_message_id,
-            mailbox_email=mb,
-            message_id=message_id,
-        )
+    repos.insert_case_event(db, **_event_row(p, case_id=case_id, event_type=event_type))
+
+    return provider_message_id, bool(has_attachments)
 
 
-async def _process_attachments(*, mailbox_id: int, provider_message_id: str, mailbox_email: str, message_id: str) -> None:
+def _dedupe_needs_attachments(db, *, message_pk: int, has_attachments: bool) -> bool:
+    """
+    Correo ya ingestado: si indica adjuntos y no hay ninguno guardado, hay que recuperarlos.
+    """
+    if has_attachments and _attachments_count(db, message_pk=message_pk) == 0:
+        logger.warning("Attachments missing in DB for message_pk=%s -> will fetch now", message_pk)
+        return True
+    return False
+
+
+def _persist_batch(
+    db,
+    *,
+    mailbox_id: int,
+    items: list[tuple[str, dict[str, Any]]],
+    case_numbers: list[str],
+) -> dict[str, tuple[str, bool]]:
+    """
+    Persiste una página delta / ráfaga de webhook en UNA transacción:
+      - dedupe y conversationId -> case_id con un SELECT ... IN cada uno
+      - create_case solo para hilos nuevos
+      - INSERT multi-fila (executemany) para messages y case_events
+      - un UPDATE agrupado por caso para last_activity_at
+    Retorna {message_id: (provider_message_id, needs_attachments)}.
+    Si algo falla, el caller cae al camino por-mensaje (_persist_message).
+    """
+    parsed = [(mid, _parse_message(mid, msg)) for mid, msg in items]
+    out: dict[str, tuple[str, bool]] = {}
+
+    known = repos.list_known_messages(
+        db,
+        mailbox_id=mailbox_id,
+        provider_message_ids=[p["provider_message_id"] for _, p in parsed],
+    )
+
+    new_items: list[tuple[str, dict[str, Any]]] = []
+    seen: set[str] = set()
+    for mid, p in parsed:
+        pmid = p["provider_message_id"]
+        k = known.get(pmid)
+        if k is not None:
+            has_att_db, att_count = k
+            needs = bool((has_att_db or p["has_attachments"]) and att_count == 0)
+            logger.info("Dedupe hit message_id=%s", pmid)
+            out[mid] = (pmid, needs)
+            continue
+        if pmid in seen:
+            out[mid] = (pmid, bool(p["has_attachments"]))
+            continue
+        seen.add(pmid)
+        new_items.append((mid, p))
+
+    if not new_items:
+        return out
+
+    # Hilos: un solo SELECT para todos los conversationId del batch
+    conv_cases = repos.find_cases_by_conversations(
+        db,
+        mailbox_id=mailbox_id,
+        conversation_ids=list({p["conversation_id"] for _, p in new_items if p["conversation_id"]}),
+    )
+
+    message_rows: list[dict[str, Any]] = []
+    event_rows: list[dict[str, Any]] = []
+    activity: dict[int, datetime] = {}
+
+    # En orden de llegada: el primer correo de un hilo nuevo crea el caso
+    for mid, p in sorted(new_items, key=lambda it: it[1]["received_at"]):
+        conv = p["conversation_id"]
+        case_id = conv_cases.get(conv) if conv else None
+        if case_id:
+            event_type = "MESSAGE_ADDED"
+        else:
+            case_id = _new_case_for(db, p, mailbox_id=mailbox_id, case_numbers=case_numbers)
+            event_type = "CASE_CREATED"
+            if conv:
+                conv_cases[conv] = case_id
+
+        message_rows.append(_message_row(p, case_id=case_id, mailbox_id=mailbox_id))
+        event_rows.append(_event_row(p, case_id=case_id, event_type=event_type))
+        activity[case_id] = max(activity.get(case_id, p["received_at"]), p["received_at"])
+        out[mid] = (p["provider_message_id"], bool(p["has_attachments"]))
+
+    now = repos.db_now(db)
+    inserted = repos.insert_messages_inbound_many(db, message_rows, created_at=now)
+    if inserted != len(message_rows):
+        # Otro worker insertó alguno entre el SELECT y el INSERT: rollback y por-mensaje (upsert atómico)
+        raise RuntimeError(f"Concurrent ingest detected: inserted={inserted} expected={len(message_rows)}")
+    repos.touch_cases_activity_many(db, activity)
+    repos.insert_case_events_many(db, event_rows, created_at=now)
+
+    logger.info(
+        "Batch persisted | messages=%s | new_cases=%s | dedupe=%s",
+        len(message_rows),
+        sum(1 for e in event_rows if e["event_type"] == "CASE_CREATED"),
+        len(items) - len(new_items),
+    )
+    return out
+
+
+async def _process_attachments(
+    *,
+    mailbox_id: int,
+    provider_message_id: str,
+    mailbox_email: str,
+    message_id: str,
+    atts: list[dict[str, Any]] | None = None,
+) -> None:
     """
     ✅ Importante:
     - NO hacemos awaits dentro de una transacción DB.
     - Primero traemos/decodificamos/guardamos a disco.
     - Luego persistimos rows en attachments.
+
+    atts: lista ya obtenida vía $batch (si es None se pide a Graph).
     """
-    atts = await graph_client.list_attachments(mailbox_email, message_id)
+    if atts is None:
+        atts = await graph_client.list_attachments(
+            mailbox_email,
+            message_id,
+            metadata_only=bool(settings.ATTACHMENT_STREAMING),
+        )
     if not atts:
         return
 
     prepared: list[dict[str, Any]] = []
 
-    # 1) Preparar (descargar/decodificar/guardar en storage) fuera de DB
-    for a in atts:
-        odata_type = str(a.get("@odata.type") or "")
-        att_id = str(a.get("id") or "")
+    # 1) Preparar (descargar/decodificar/guardar en storage) fuera de DB,
+    #    en paralelo acotado (slots + bytes en vuelo por proceso)
+    async def _limited(a: dict[str, Any]) -> dict[str, Any] | None:
+        async with attachment_slots:
+            async with attachment_bytes.reserve(int(a.get("size") or 0)):
+                return await _prepare_attachment(a, mailbox_email=mailbox_email, message_id=message_id)
 
-        if "fileAttachment" not in odata_type:
-            logger.warning("Skipping non-file attachment type=%s id=%s", odata_type, att_id)
-            continue
+    results = await asyncio.gather(*[_limited(a) for a in atts], return_exceptions=True)
 
-        filename = str(a.get("name") or "attachment.bin")
-        content_type = str(a.get("contentType") or "application/octet-stream")
-        size = int(a.get("size") or 0)
-        is_inline = 1 if a.get("isInline") else 0
-        content_id = a.get("contentId")
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        # Igual que antes: si Graph falla, no persistimos a medias; se reintenta completo
+        raise errors[0]
 
-        content_b64 = a.get("contentBytes")
-        if not content_b64 and att_id:
-            full = await graph_client.get_attachment(mailbox_email, message_id, att_id)
-            content_b64 = full.get("contentBytes")
+    prepared.extend(r for r in results if r)
 
-        if not content_b64:
-            logger.warning("Attachment without contentBytes filename=%s id=%s", filename, att_id)
-            continue
+    if not prepared:
+        return
 
-        try:
-            raw = base64.b64decode(content_b64)
-        except Exception:
-            logger.warning("Invalid base64 attachment filename=%s id=%s", filename, att_id)
-            continue
+    # 2) Persistir en DB (una sola transacción corta, en el pool de DB)
+    await run_db(_insert_attachments, mailbox_id=mailbox_id, provider_message_id=provider_message_id, prepared=prepared)
 
-        if size and len(raw) != size:
-            size = len(raw)
+    logger.info("Inserted attachments=%s for provider_message_id=%s", len(prepared), provider_message_id)
 
-        try:
-            stored = save_attachment_bytes(filename=filename, content_bytes=raw, content_type=content_type)
-        except Exception as e:
-            logger.warning("Attachment rejected filename=%s reason=%s", filename, e)
-            continue
 
-        prepared.append(
-            {
-                "filename": filename,
-                "content_type": stored.content_type,
-                "size_bytes": stored.size_bytes,
-                "sha256": stored.sha256,
-                "is_inline": is_inline,
-                "content_id": (str(content_id) if content_id else None),
-                "storage_path": stored.storage_path,
-            }
+def _insert_attachments(db, *, mailbox_id: int, provider_message_id: str, prepared: list[dict[str, Any]]) -> None:
+    message_pk = repos.get_message_pk(db, mailbox_id, provider_message_id)
+
+    # Evita duplicar adjuntos si ya estaban
+    existing_count = _attachments_count(db, message_pk=message_pk)
+    if existing_count > 0:
+        logger.info(
+            "Attachments already exist for message_pk=%s count=%s -> will continue (idempotent insert)",
+            message_pk,
+            existing_count,
         )
 
-        logger.info("Prepared attachment filename=%s bytes=%s sha=%s", filename, stored.size_bytes, stored.sha256[:12])
+    for p in prepared:
+        repos.insert_attachment(
+            db,
+            message_id_pk=message_pk,
+            filename=p["filename"],
+            content_type=p["content_type"],
+            size_bytes=p["size_bytes"],
+            sha256=p["sha256"],
+            is_inline=p["is_inline"],
+            content_id=p["content_id"],
+            storage_path=p["storage_path"],
+        )
 
-    if not prepared:
-        return
 
-    # 2) Persistir en DB (una sola transacción corta)
-    with get_db_session() as db:
-        message_pk = repos.get_message_pk(db, mailbox_id, provider_message_id)
-
-        # Evita duplicar adjuntos si ya estaban
-        existing_count = _attachments_count(db, message_pk=message_pk)
-        if existing_count > 0:
-            logger.info(
-                "Attachments already exist for message_pk=%s count=%s -> will continue (idempotent insert)",
-                message_pk,
-                existing_count,
-            )
+async def _prepare_attachment(a: dict[str, Any], *, mailbox_email: str, message_id: str) -> dict[str, Any] | None:
+    """
+    Descarga + valida + guarda en storage un adjunto.
+    - Si el listado ya trae contentBytes (base64), se usa tal cual.
+    - Si no, y ATTACHMENT_STREAMING=1, se baja /$value en chunks directo a disco
+      (memoria plana; se aborta al superar MAX_ATTACHMENT_SIZE_MB).
+    Retorna el dict para insert_attachment o None si se descarta.
+    """
+    odata_type = str(a.get("@odata.type") or "")
+    att_id = str(a.get("id") or "")
+
+    if "fileAttachment" not in odata_type:
+        logger.warning("Skipping non-file attachment type=%s id=%s", odata_type, att_id)
+        return None
+
+    filename = str(a.get("name") or "attachment.bin")
+    content_type = str(a.get("contentType") or "application/octet-stream")
+    size = int(a.get("size") or 0)
+    is_inline = 1 if a.get("isInline") else 0
+    content_id = a.get("contentId")
+
+    content_b64 = a.get("contentBytes")
 
-        for p in prepared:
-            repos.insert_attachment(
-                db,
-                message_id_pk=message_pk,
-                filename=p["filename"],
-                content_type=p["content_type"],
-                size_bytes=p["size_bytes"],
-                sha256=p["sha256"],
-                is_inline=p["is_inline"],
-                content_id=p["content_id"],
-                storage_path=p["storage_path"],
+    if not content_b64 and att_id and settings.ATTACHMENT_STREAMING:
+        try:
+            # Rechazo temprano por extensión / tamaño declarado (sin descargar)
+            validate_attachment(filename=filename, size_bytes=size, content_type=content_type)
+            stored = await save_attachment_stream(
+                filename=filename,
+                chunks=graph_client.iter_attachment_value(mailbox_email, message_id, att_id),
+                content_type=content_type,
             )
+        except ValueError as e:
+            logger.warning("Attachment rejected filename=%s reason=%s", filename, e)
+            return None
+    else:
+        if not content_b64 and att_id:
+            full = await graph_client.get_attachment(mailbox_email, message_id, att_id)
+            content_b64 = full.get("contentBytes")
 
-    logger.info("Inserted attachments=%s for provider_message_id=%s", len(prepared), provider_message_id)
+        if not content_b64:
+            logger.warning("Attachment without contentBytes filename=%s id=%s", filename, att_id)
+            return None
 
+        try:
+            # decode + sha256 + escritura en el pool de IO (no en el event loop)
+            stored = await run_io(save_attachment_b64, filename, content_b64, content_type)
+        except Exception as e:
+            logger.warning("Attachment rejected filename=%s id=%s reason=%s", filename, att_id, e)
+            return None
+
+    logger.info("Prepared attachment filename=%s bytes=%s sha=%s", filename, stored.size_bytes, stored.sha256[:12])
 
-async def process_message_id_async(message_id: str) -> None:
+    return {
+        "filename": filename,
+        "content_type": stored.content_type,
+        "size_bytes": stored.size_bytes,
+        "sha256": stored.sha256,
+        "is_inline": is_inline,
+        "content_id": (str(content_id) if content_id else None),
+        "storage_path": stored.storage_path,
+    }
+
+
+async def process_message_id_async(message_id: str, *, mailbox_id: int | None = None) -> None:
     """
     Entry-point para Delta backstop: procesa 1 correo por message_id.
-    Reusa la misma lógica de _process_single_message.
+    Pasa por el mismo single-flight que webhook/delta (sin fetch duplicado).
     """
-    if not settings.MAILBOX_EMAIL:
-        logger.error("MAILBOX_EMAIL missing - cannot process message_id=%s", message_id)
-        return
-
-    # mailbox_id una sola vez
-    with get_db_session() as db:
-        mailbox_id = repos.get_or_create_mailbox(db, settings.MAILBOX_EMAIL)
-
-    await _process_single_message(
-        mailbox_id=mailbox_id,
-        message_id=message_id,
-    )
+    await process_message_ids_async([message_id], mailbox_id=mailbox_id)
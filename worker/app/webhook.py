@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import asyncio
 import json
 import logging
 from typing import Any
@@ -8,7 +7,8 @@ from typing import Any
 from fastapi import APIRouter, Request, Response
 
 from app.settings import settings
-from app import sync_service
+from app.ingest_queue import webhook_inbox
+from app.delta_scheduler import delta_scheduler
 
 logger = logging.getLogger("app.webhook")
 router = APIRouter()
@@ -30,7 +30,7 @@ async def graph_webhook_post(request: Request) -> Response:
     if token:
         return Response(content=token, media_type="text/plain", status_code=200)
 
-    # Graph expects quick response. We always respond 202 and process async.
+    # Graph expects quick response. We respond 202 once the payload is queued and process async.
     try:
         raw = await request.body()
         payload = json.loads(raw.decode("utf-8")) if raw else {}
@@ -75,7 +75,24 @@ async def graph_webhook_post(request: Request) -> Response:
 
     if valid:
         # IMPORTANT: sync_service expects {"value": [...]}
-        asyncio.create_task(_process_safe({"value": valid}))
+        # (+ validationTokens: rich notifications, se validan al procesar)
+        # Persistimos en la cola durable ANTES del 202; si no se pudo, Graph debe reintentar.
+        # Una fila por suscripción: webhook_inbox.subscription_id da la actividad por buzón
+        by_sub: dict[str, list[dict[str, Any]]] = {}
+        for n in valid:
+            by_sub.setdefault(str(n.get("subscriptionId") or ""), []).append(n)
+        try:
+            for sub_notifications in by_sub.values():
+                queued: dict[str, Any] = {"value": sub_notifications}
+                if isinstance(payload.get("validationTokens"), list):
+                    queued["validationTokens"] = payload["validationTokens"]
+                inbox_id = await webhook_inbox.enqueue(queued)
+                logger.info("Webhook enqueued | inbox_id=%s | notifications=%s", inbox_id, len(sub_notifications))
+        except Exception as e:
+            logger.exception("Webhook enqueue failed | ip=%s | err=%s", _client_ip(request), e)
+            return Response(content="Unavailable", media_type="text/plain", status_code=503)
+        # salud del webhook (por buzón) para la agenda del delta
+        await delta_scheduler.record_webhook(subs)
     else:
         if invalid:
             logger.warning(
@@ -86,12 +103,61 @@ async def graph_webhook_post(request: Request) -> Response:
     return Response(content="OK", media_type="text/plain", status_code=202)
 
 
-async def _process_safe(payload: dict[str, Any]) -> None:
+@router.get("/graph/lifecycle")
+async def graph_lifecycle_get(request: Request) -> Response:
+    # Graph valida también el lifecycleNotificationUrl al crear la suscripción
+    token = request.query_params.get("validationToken")
+    if token:
+        return Response(content=token, media_type="text/plain", status_code=200)
+    return Response(content="OK", media_type="text/plain", status_code=200)
+
+
+@router.post("/graph/lifecycle")
+async def graph_lifecycle_post(request: Request) -> Response:
+    """
+    Lifecycle notifications (missed / subscriptionRemoved / reauthorizationRequired).
+    Van a la misma cola durable que el webhook; el consumidor las deriva a subscriptions_service.
+    """
+    token = request.query_params.get("validationToken")
+    if token:
+        return Response(content=token, media_type="text/plain", status_code=200)
+
+    try:
+        raw = await request.body()
+        payload = json.loads(raw.decode("utf-8")) if raw else {}
+    except Exception:
+        logger.warning("Lifecycle invalid JSON | ip=%s", _client_ip(request))
+        return Response(status_code=202)
+
+    notifications = payload.get("value") or []
+    if not isinstance(notifications, list):
+        logger.warning("Lifecycle invalid payload shape | ip=%s | keys=%s", _client_ip(request), list(payload.keys()))
+        return Response(status_code=202)
+
+    valid = [
+        n for n in notifications
+        if isinstance(n, dict)
+        and n.get("lifecycleEvent")
+        and n.get("clientState")
+        and n.get("clientState") == settings.GRAPH_CLIENT_STATE
+    ]
+    logger.warning(
+        "Lifecycle received | ip=%s | total=%s | valid=%s | events=%s",
+        _client_ip(request),
+        len(notifications),
+        len(valid),
+        [(n.get("lifecycleEvent"), n.get("subscriptionId")) for n in valid][:5],
+    )
+    if not valid:
+        return Response(content="OK", media_type="text/plain", status_code=202)
+
     try:
-        await sync_service.process_notifications_async(payload)
-        logger.info("Webhook processed notifications=%s", len(payload.get("value") or []))
+        inbox_id = await webhook_inbox.enqueue({"value": valid}, lifecycle=True)
     except Exception as e:
-        logger.exception("Webhook processing failed: %s", e)
+        logger.exception("Lifecycle enqueue failed | ip=%s | err=%s", _client_ip(request), e)
+        return Response(content="Unavailable", media_type="text/plain", status_code=503)
+    logger.info("Lifecycle enqueued | inbox_id=%s | notifications=%s", inbox_id, len(valid))
+    return Response(content="OK", media_type="text/plain", status_code=202)
 
 
 def _client_ip(request: Request) -> str:
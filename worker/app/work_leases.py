@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import os
+import socket
+import time
+import zlib
+from typing import Any
+
+from app.settings import settings
+from app.db import run_db
+from app import repos
+
+logger = logging.getLogger("app.work_leases")
+
+
+def delta_lease(mailbox_id: int, folder_id: int) -> str:
+    """Recurso del lease delta de una carpeta (scheduler y checkpoint usan el mismo nombre)."""
+    return f"delta:{mailbox_id}:{folder_id}"
+
+
+class WorkLeases:
+    """
+    Reparto del trabajo programado entre instancias del worker (tabla worker_leases):
+      - cada instancia late cada WORK_LEASE_HEARTBEAT_SECONDS (worker_instances) y
+        con eso renueva todos sus leases; lo que no se renueva vence en WORK_LEASE_TTL_SECONDS
+      - delta: cada instancia toma su parte justa (ceil(carpetas / instancias vivas));
+        si sobra (entró otro nodo) suelta el exceso, si falta (murió uno) toma lo vencido
+      - roles únicos (p.ej. "role:subscriptions"): los tiene una sola instancia
+    Webhook inbox y backfill ya se reparten por claim en sus propias tablas.
+    Con WORK_LEASES_ENABLED=0 esta instancia se queda con todo (un solo nodo).
+    """
+
+    def __init__(self) -> None:
+        self.owner = f"{settings.WORKER_INSTANCE_ID}:{socket.gethostname()}:{os.getpid()}"
+        self._held: set[str] = set()
+        self._renewed_at = 0.0  # time.monotonic() del último latido OK
+        self._table_ready = False
+        self.live_workers = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(int(settings.WORK_LEASES_ENABLED))
+
+    @property
+    def ttl(self) -> int:
+        return max(10, int(settings.WORK_LEASE_TTL_SECONDS))
+
+    @property
+    def heartbeat_interval(self) -> float:
+        # siempre bastante por debajo del TTL (varios latidos por lease)
+        return float(max(1, min(int(settings.WORK_LEASE_HEARTBEAT_SECONDS), self.ttl // 3)))
+
+    async def _ensure_tables(self) -> None:
+        if not self._table_ready:
+            await run_db(repos.ensure_worker_leases_tables)
+            self._table_ready = True
+
+    def _stale(self) -> bool:
+        # sin latido OK dentro del TTL: los leases pueden haber vencido y ser de otro
+        return time.monotonic() - self._renewed_at >= self.ttl
+
+    def holds(self, resource: str) -> bool:
+        """
+        True si esta instancia tiene el lease (vigente); sin leases, siempre.
+        """
+        if not self.enabled:
+            return True
+        return resource in self._held and not self._stale()
+
+    # ============================
+    # Latido
+    # ============================
+
+    async def heartbeat(self) -> None:
+        if not self.enabled:
+            return
+        await self._ensure_tables()
+        try:
+            live, held = await run_db(repos.heartbeat_worker, owner=self.owner, ttl_seconds=self.ttl)
+        except Exception as e:
+            if self._stale() and self._held:
+                logger.warning("Work leases stale (heartbeat failing) -> dropping %s leases: %s", len(self._held), e)
+                self._held.clear()
+            raise
+        lost = self._held - set(held)
+        if lost:
+            logger.warning("Work leases lost (expired / taken over): %s", sorted(lost))
+        self._held = set(held)
+        self.live_workers = max(1, live)
+        self._renewed_at = time.monotonic()
+
+    async def run(self, stop_event: asyncio.Event) -> None:
+        """
+        Loop de latidos (lo arranca background_jobs).
+        """
+        while not stop_event.is_set():
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.warning("Work lease heartbeat failed: %s", e)
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=self.heartbeat_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def release_all(self) -> None:
+        """
+        Shutdown: suelta todo para que otra instancia lo tome sin esperar al TTL.
+        """
+        if not self.enabled or not self._table_ready:
+            return
+        try:
+            n = await run_db(repos.release_worker_leases, owner=self.owner)
+            logger.warning("Work leases released | owner=%s | leases=%s", self.owner, n)
+        except Exception as e:
+            logger.warning("Work lease release failed: %s", e)
+        self._held.clear()
+        self._renewed_at = 0.0
+
+    # ============================
+    # Roles y reparto
+    # ============================
+
+    async def acquire(self, resource: str) -> bool:
+        """
+        Rol único: True si esta instancia lo tiene (lo toma si está libre o vencido).
+        """
+        if not self.enabled:
+            return True
+        if self._stale():
+            await self.heartbeat()
+        if resource in self._held:
+            return True
+        if await run_db(repos.try_acquire_lease, resource=resource, owner=self.owner, ttl_seconds=self.ttl):
+            self._held.add(resource)
+            logger.warning("Work lease acquired | resource=%s | owner=%s", resource, self.owner)
+            return True
+        return False
+
+    async def balance(self, resources: list[str], *, prefix: str, busy: set[str] | None = None) -> set[str]:
+        """
+        Parte justa de `resources` (todos con el mismo prefix) para esta instancia.
+        busy: recursos con trabajo en curso (corrida delta de la carpeta): nunca se sueltan,
+        aunque sobren o ya no estén en la lista; se sueltan en un balance posterior.
+        Returns: los recursos de la lista que esta instancia tiene después de balancear.
+        """
+        if not self.enabled:
+            return set(resources)
+        if self._stale():
+            await self.heartbeat()
+
+        wanted = set(resources)
+        share = math.ceil(len(resources) / max(1, self.live_workers)) if resources else 0
+        mine = sorted(r for r in self._held if r.startswith(prefix))
+
+        # Recursos que ya no existen (carpeta desmonitoreada) o exceso sobre la parte justa.
+        # Los ocupados se conservan: soltarlos dejaría a dos instancias escribiendo el mismo estado.
+        busy = busy or set()
+        gone = [r for r in mine if r not in wanted and r not in busy]
+        mine = sorted((r for r in mine if r in wanted), key=lambda r: r not in busy)
+        extra = [r for r in mine[share:] if r not in busy]
+        if gone or extra:
+            await run_db(repos.release_worker_leases, owner=self.owner, resources=gone + extra)
+            self._held.difference_update(gone + extra)
+            mine = [r for r in mine if r not in extra]
+            if extra:
+                logger.warning("Work leases rebalanced | released=%s | share=%s | live_workers=%s", extra, share, self.live_workers)
+
+        if len(mine) < share:
+            current = await run_db(repos.list_worker_leases, prefix=prefix)
+            free = [r for r in resources if r not in self._held and not current.get(r, ("", False))[1]]
+            # arranque distinto por instancia: menos choques entre nodos que balancean a la vez
+            if free:
+                start = zlib.crc32(self.owner.encode()) % len(free)
+                free = free[start:] + free[:start]
+            for r in free:
+                if len(mine) >= share:
+                    break
+                if await run_db(repos.try_acquire_lease, resource=r, owner=self.owner, ttl_seconds=self.ttl):
+                    self._held.add(r)
+                    mine.append(r)
+                    logger.info("Work lease acquired | resource=%s", r)
+
+        return set(mine)
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "owner": self.owner,
+            "live_workers": self.live_workers,
+            "held": sorted(self._held),
+            "stale": self.enabled and self._stale(),
+        }
+
+
+work_leases = WorkLeases()
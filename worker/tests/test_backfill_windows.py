@@ -0,0 +1,48 @@
+"""
+Backfill: partición de [since, until) en ventanas (split_windows).
+
+    cd worker && python -m pytest -q tests
+"""
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+
+from app.backfill_service import split_windows
+
+
+def test_windows_aligned_back_from_until_newest_first():
+    since = datetime(2026, 1, 1)
+    until = datetime(2026, 1, 22)
+    assert split_windows(since, until, 7) == [
+        (datetime(2026, 1, 15), datetime(2026, 1, 22)),
+        (datetime(2026, 1, 8), datetime(2026, 1, 15)),
+        (datetime(2026, 1, 1), datetime(2026, 1, 8)),
+    ]
+
+
+def test_last_window_is_partial_and_clipped_to_since():
+    since = datetime(2026, 1, 3, 12, 0)
+    until = datetime(2026, 1, 15)
+    windows = split_windows(since, until, 5)
+    assert windows == [
+        (datetime(2026, 1, 10), datetime(2026, 1, 15)),
+        (datetime(2026, 1, 5), datetime(2026, 1, 10)),
+        (datetime(2026, 1, 3, 12, 0), datetime(2026, 1, 5)),
+    ]
+    # contiguas, sin huecos ni solapes
+    assert all(older[1] == newer[0] for newer, older in zip(windows, windows[1:]))
+
+
+def test_timezone_aware_inputs_become_utc_naive():
+    bogota = timezone(timedelta(hours=-5))
+    since = datetime(2026, 1, 1, 19, 0, tzinfo=bogota)  # 2026-01-02 00:00 UTC
+    until = datetime(2026, 1, 3, 0, 0, tzinfo=timezone.utc)
+    assert split_windows(since, until, 1) == [(datetime(2026, 1, 2), datetime(2026, 1, 3))]
+
+
+def test_empty_range_and_minimum_window():
+    day = datetime(2026, 1, 1)
+    assert split_windows(day, day, 7) == []
+    assert split_windows(day + timedelta(days=1), day, 7) == []
+    # window_days < 1 se trata como 1 día
+    assert len(split_windows(day, day + timedelta(days=3), 0)) == 3
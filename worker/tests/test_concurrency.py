@@ -0,0 +1,150 @@
+"""
+Primitivas de concurrencia de la ingesta: SingleFlight (claim/join/release) y
+PrioritySlots (reparto justo por buzón, carril bajo del backfill).
+Todo en memoria, sin DB ni Graph.
+
+    cd worker && python -m pytest -q tests
+"""
+from __future__ import annotations
+
+import asyncio
+
+from app.concurrency import PrioritySlots, SingleFlight, low_priority
+
+
+async def _settle() -> None:
+    # deja correr a las tareas que quedaron listas (tomar slot / despertar del Condition)
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+async def _hold(slots: PrioritySlots, key, entered: list, release: asyncio.Event, *, low: bool = False) -> None:
+    low_priority.set(low)
+    async with slots.slot(key):
+        entered.append(key)
+        await release.wait()
+
+
+# ============================
+# SingleFlight
+# ============================
+
+def test_single_flight_claim_join_release():
+    async def scenario():
+        flights: SingleFlight[str] = SingleFlight()
+
+        owned, joined = flights.claim(["a", "b"])
+        assert owned == ["a", "b"] and joined == {}
+        assert len(flights) == 2
+
+        owned2, joined2 = flights.claim(["b", "c"])
+        assert owned2 == ["c"]
+        assert set(joined2) == {"b"} and not joined2["b"].done()
+
+        flights.release("b", ok=True)
+        assert await joined2["b"] is True
+
+        # liberada: el siguiente claim vuelve a ser dueño
+        owned3, joined3 = flights.claim(["b"])
+        assert owned3 == ["b"] and joined3 == {}
+
+        _, joined_a = flights.claim(["a"])
+        flights.release("a", ok=False)
+        assert await joined_a["a"] is False
+
+        flights.release("zzz", ok=True)  # clave desconocida: no-op
+        flights.release("b", ok=True)
+        flights.release("c", ok=True)
+        assert len(flights) == 0
+
+    asyncio.run(scenario())
+
+
+# ============================
+# PrioritySlots
+# ============================
+
+def test_priority_slots_fair_by_key():
+    async def scenario():
+        slots = PrioritySlots(2, low_max=1)
+        entered: list = []
+        release_a1, release_a2, release_rest = asyncio.Event(), asyncio.Event(), asyncio.Event()
+
+        # buzón A ocupa los dos slots
+        tasks = [
+            asyncio.create_task(_hold(slots, "A", entered, release_a1)),
+            asyncio.create_task(_hold(slots, "A", entered, release_a2)),
+        ]
+        await _settle()
+        assert entered == ["A", "A"]
+
+        # esperan otra de A (primero) y una de B
+        tasks.append(asyncio.create_task(_hold(slots, "A", entered, release_rest)))
+        await _settle()
+        tasks.append(asyncio.create_task(_hold(slots, "B", entered, release_rest)))
+        await _settle()
+        assert entered == ["A", "A"]
+
+        # se libera un slot: va a B (0 en uso) aunque A llegó antes
+        release_a1.set()
+        await _settle()
+        assert entered == ["A", "A", "B"]
+
+        release_a2.set()
+        await _settle()
+        assert entered == ["A", "A", "B", "A"]
+
+        release_rest.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_priority_slots_low_lane_leaves_a_slot_free():
+    async def scenario():
+        slots = PrioritySlots(3, low_max=5)  # se recorta a capacity - 1
+        entered: list = []
+        release = asyncio.Event()
+
+        tasks = [asyncio.create_task(_hold(slots, f"bf{i}", entered, release, low=True)) for i in range(3)]
+        await _settle()
+        assert len(entered) == 2  # el tercer backfill espera con un slot libre
+
+        tasks.append(asyncio.create_task(_hold(slots, "live", entered, release)))
+        await _settle()
+        assert "live" in entered and len(entered) == 3
+
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_priority_slots_normal_waiter_goes_before_low():
+    async def scenario():
+        slots = PrioritySlots(2, low_max=1)
+        entered: list = []
+        release_first, release_rest = asyncio.Event(), asyncio.Event()
+
+        tasks = [
+            asyncio.create_task(_hold(slots, "A", entered, release_first)),
+            asyncio.create_task(_hold(slots, "B", entered, release_rest)),
+        ]
+        await _settle()
+
+        tasks.append(asyncio.create_task(_hold(slots, "backfill", entered, release_rest, low=True)))
+        await _settle()
+        tasks.append(asyncio.create_task(_hold(slots, "C", entered, release_rest)))
+        await _settle()
+        assert entered == ["A", "B"]
+
+        # el slot libre es del normal en espera aunque el de baja llegó antes
+        release_first.set()
+        await _settle()
+        assert entered == ["A", "B", "C"]
+
+        release_rest.set()
+        await asyncio.gather(*tasks)
+        assert entered[-1] == "backfill"
+
+    asyncio.run(scenario())
@@ -0,0 +1,188 @@
+"""
+Delta: progreso dentro de la página (_PageProgress) y reglas de flush/discard de DeltaCheckpoint.
+Sin DB: run_db se reemplaza por un registro de los upserts.
+
+    cd worker && python -m pytest -q tests
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+
+import pytest
+
+from app import delta_checkpoint
+from app.delta_checkpoint import DeltaCheckpoint
+from app.delta_service import _PageProgress
+from app.settings import settings
+from app.work_leases import delta_lease, work_leases
+
+DELTA_LINK = "https://graph.microsoft.com/v1.0/users/x/mailFolders/inbox/messages/delta?$deltatoken=D1"
+NEXT_LINK = "https://graph.microsoft.com/v1.0/users/x/mailFolders/inbox/messages/delta?$skiptoken=S1"
+
+
+@pytest.fixture
+def upserts(monkeypatch):
+    calls: list[dict] = []
+
+    async def fake_run_db(fn, **kwargs):
+        calls.append(kwargs)
+
+    monkeypatch.setattr(delta_checkpoint, "run_db", fake_run_db)
+    monkeypatch.setattr(settings, "DELTA_CHECKPOINT_EVERY_PAGES", 2)
+    monkeypatch.setattr(settings, "DELTA_CHECKPOINT_EVERY_SECONDS", 3600)
+    return calls
+
+
+def _checkpoint(**kwargs) -> DeltaCheckpoint:
+    params = dict(mailbox_id=1, folder_id=10, delta_link=DELTA_LINK, next_link=None)
+    params.update(kwargs)
+    return DeltaCheckpoint(**params)
+
+
+# ============================
+# _PageProgress
+# ============================
+
+def test_page_progress_out_of_order_chunks():
+    progress = _PageProgress(["a", "b", "c", "d", "e"])
+    assert progress.offset == 0
+
+    # termina primero el chunk de c/d: el prefijo contiguo no avanza
+    assert progress.mark(["c", "d"]) == 0
+    assert progress.mark(["a"]) == 1
+    # al llegar b se suman c y d, que ya estaban hechos
+    assert progress.mark(["b"]) == 4
+    assert progress.mark(["e"]) == 5
+
+
+def test_page_progress_skips_items_without_message():
+    # None = removed / inválido: cuenta como hecho, también al inicio de la página
+    progress = _PageProgress([None, "a", None, None, "b"])
+    assert progress.offset == 1
+    assert progress.mark(["a"]) == 4
+    assert progress.mark(["b"]) == 5
+
+
+def test_page_progress_resumes_from_start():
+    # reanudación: los ítems antes de `start` ya se procesaron en la corrida anterior
+    progress = _PageProgress(["a", "b", "c", "d"], start=2)
+    assert progress.offset == 2
+    assert progress.mark(["d"]) == 2
+    assert progress.mark(["c"]) == 4
+
+
+# ============================
+# DeltaCheckpoint: page_offset solo en páginas nextLink
+# ============================
+
+def test_offset_only_applies_to_next_link_pages():
+    # sin nextLink el page_offset guardado no se usa (deltaLink / inicial se re-sirven distintos)
+    assert _checkpoint(page_offset=7).page_offset == 0
+    assert _checkpoint(next_link=NEXT_LINK, page_offset=7).page_offset == 7
+
+    cp = _checkpoint()
+    cp.start_page(DELTA_LINK, offset=3)
+    assert cp.next_link is None and cp.page_offset == 0
+    cp.progress(5)
+    assert cp.page_offset == 0
+
+    cp.end_page(delta_link=None, next_link=NEXT_LINK)
+    cp.start_page(NEXT_LINK, offset=3)
+    assert cp.page_offset == 3
+    cp.progress(5)
+    cp.progress(4)  # nunca retrocede
+    assert cp.page_offset == 5
+    assert cp.resume_url == NEXT_LINK
+
+
+def test_end_page_resets_offset_and_moves_links():
+    cp = _checkpoint(next_link=NEXT_LINK, page_offset=4)
+    cp.end_page(delta_link="D2", next_link=None)
+    assert (cp.delta_link, cp.next_link, cp.page_offset) == ("D2", None, 0)
+    assert cp.resume_url == "D2"
+
+
+# ============================
+# DeltaCheckpoint: flush / discard
+# ============================
+
+def test_maybe_flush_every_n_pages(upserts):
+    async def scenario():
+        cp = _checkpoint()
+        await cp.maybe_flush()
+        assert upserts == []  # limpio: nada que escribir
+
+        cp.end_page(delta_link=None, next_link=NEXT_LINK)
+        await cp.maybe_flush()
+        assert upserts == []  # 1 de 2 páginas
+
+        cp.start_page(NEXT_LINK)
+        cp.progress(3)
+        cp.end_page(delta_link=None, next_link=NEXT_LINK + "2")
+        await cp.maybe_flush()
+        assert len(upserts) == 1
+        assert upserts[0]["next_link"] == NEXT_LINK + "2"
+        assert upserts[0]["page_offset"] == 0
+
+        await cp.maybe_flush()
+        assert len(upserts) == 1
+
+    asyncio.run(scenario())
+
+
+def test_flush_writes_mid_page_offset_and_errors(upserts):
+    async def scenario():
+        cp = _checkpoint(next_link=NEXT_LINK)
+        await cp.flush()
+        assert upserts == []  # limpio y sin error
+
+        cp.start_page(NEXT_LINK, offset=2)
+        cp.progress(6)
+        await cp.flush()
+        assert upserts[-1]["page_offset"] == 6
+        assert upserts[-1]["next_link"] == NEXT_LINK
+
+        # un error se registra aunque el estado no haya cambiado
+        await cp.flush(status_code=500, error="boom")
+        assert len(upserts) == 2
+        assert (upserts[-1]["last_status_code"], upserts[-1]["last_error"]) == (500, "boom")
+
+    asyncio.run(scenario())
+
+
+def test_discard_stops_every_later_flush(upserts):
+    async def scenario():
+        cp = _checkpoint(next_link=NEXT_LINK)
+        cp.start_page(NEXT_LINK, offset=1)
+        cp.discard()  # 410 + reset en DB: el estado en memoria ya no vale
+
+        await cp.flush()
+        await cp.flush(status_code=410, error="gone")
+        cp.end_page(delta_link="D2", next_link=None)
+        await cp.maybe_flush()
+        assert upserts == []
+
+    asyncio.run(scenario())
+
+
+def test_flush_skipped_once_lease_is_lost(upserts, monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(settings, "WORK_LEASES_ENABLED", 1)
+        monkeypatch.setattr(work_leases, "_held", {delta_lease(1, 10)})
+        monkeypatch.setattr(work_leases, "_renewed_at", time.monotonic())
+
+        cp = _checkpoint(next_link=NEXT_LINK)
+        cp.start_page(NEXT_LINK, offset=1)
+        await cp.flush()
+        assert len(upserts) == 1 and not cp.lease_lost
+
+        # otra instancia tomó la carpeta (rebalanceo / lease vencido): no se pisa su estado
+        work_leases._held.discard(delta_lease(1, 10))
+        cp.progress(4)
+        assert cp.lease_lost
+        await cp.flush()
+        await cp.flush(status_code=500, error="boom")
+        assert len(upserts) == 1
+
+    asyncio.run(scenario())
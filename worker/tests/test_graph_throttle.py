@@ -0,0 +1,110 @@
+"""
+MailboxThrottle: pausa compartida por Retry-After, AIMD ante 429 y carril bajo del backfill.
+Sin red: solo el coordinador en memoria, con tiempos cortos.
+
+    cd worker && python -m pytest -q tests
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+
+from app.concurrency import low_priority
+from app.graph_throttle import MailboxThrottle, mailbox_key, parse_retry_after
+
+
+def _throttle(**overrides) -> MailboxThrottle:
+    # rate alto: el bucket no es lo que se prueba salvo que se diga
+    params = dict(rate=1000.0, burst=8, initial=8, min_limit=1, max_limit=16, decrease=0.5)
+    params.update(overrides)
+    return MailboxThrottle("buzon@icbf.gov.co", **params)
+
+
+# ============================
+# helpers
+# ============================
+
+def test_mailbox_key_and_retry_after():
+    assert mailbox_key("https://graph.microsoft.com/v1.0/users/Buzon@ICBF.gov.co/messages") == "buzon@icbf.gov.co"
+    assert mailbox_key("https://graph.microsoft.com/v1.0/subscriptions") == "_tenant"
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after("mañana") is None
+    assert parse_retry_after(None) is None
+
+
+# ============================
+# pausa global (Retry-After)
+# ============================
+
+def test_pause_blocks_every_caller_until_it_expires():
+    async def scenario():
+        mt = _throttle()
+        mt.observe(429, "0.3")
+        started = time.monotonic()
+
+        async def call() -> float:
+            async with mt.slot():
+                return time.monotonic() - started
+
+        waited = await asyncio.gather(call(), call(), call())
+        assert all(0.28 <= w < 1.5 for w in waited)
+        assert mt.snapshot()["paused_seconds"] == 0
+
+    asyncio.run(scenario())
+
+
+# ============================
+# AIMD
+# ============================
+
+def test_observe_429_halves_limit_once_per_window():
+    async def scenario():
+        mt = _throttle()
+        assert mt.limit == 8
+
+        # el mismo evento llega en varias respuestas a la vez: un solo decrease
+        for _ in range(3):
+            mt.observe(429, "0")
+        assert mt.limit == 4
+        assert mt.throttled == 3
+
+        # pasada la ventana (>= 1 s), un nuevo 429 vuelve a bajar
+        mt._last_decrease -= 1.5
+        mt.observe(503, "0")
+        assert mt.limit == 2
+
+        # additive increase: ~+1 cada `limit` respuestas OK, sin pasar el máximo
+        for _ in range(3):  # 2 -> 2.5 -> 2.9 -> 3.24
+            mt.observe(200)
+        assert mt.limit == 3
+        for _ in range(200):
+            mt.observe(200)
+        assert mt.limit == 16
+
+    asyncio.run(scenario())
+
+
+# ============================
+# carril bajo (backfill)
+# ============================
+
+def test_low_priority_waits_while_high_priority_is_queued():
+    async def scenario():
+        mt = _throttle()
+        mt.observe(429, "0.2")  # ambos llegan en pausa y quedan en cola
+        order: list[str] = []
+
+        async def call(name: str, low: bool) -> None:
+            low_priority.set(low)
+            async with mt.slot():
+                order.append(name)
+
+        low_task = asyncio.create_task(call("backfill", True))
+        await asyncio.sleep(0)
+        high_task = asyncio.create_task(call("webhook", False))
+        await asyncio.gather(low_task, high_task)
+
+        # el backfill llegó primero, pero pasa después del tráfico en vivo
+        assert order == ["webhook", "backfill"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,190 @@
+"""
+Rich notifications: descifrado de encryptedContent y validación de validationTokens.
+Sin red ni Graph: clave RSA + certificado autofirmado generados al vuelo y JWKS precargado.
+
+    cd worker && python -m pytest -q tests
+"""
+from __future__ import annotations
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import jwt
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, padding as sym_padding, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.x509.oid import NameOID
+
+from app.settings import settings
+from app.rich_notifications import GRAPH_NOTIFICATIONS_APP_ID, RichNotifications
+
+TENANT_ID = "11111111-2222-3333-4444-555555555555"
+CLIENT_ID = "66666666-7777-8888-9999-000000000000"
+KID = "test-kid"
+
+
+def _self_signed(key: rsa.RSAPrivateKey) -> x509.Certificate:
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "icbf-mail-worker-test")])
+    now = datetime.now(timezone.utc)
+    return (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+
+
+def _encrypt(payload: dict, cert: x509.Certificate) -> dict:
+    """
+    Lo mismo que hace Graph: AES-256-CBC (IV = key[:16]) + HMAC-SHA256 + clave con RSA-OAEP.
+    """
+    key = os.urandom(32)
+    padder = sym_padding.PKCS7(128).padder()
+    plain = padder.update(json.dumps(payload).encode("utf-8")) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(key[:16])).encryptor()
+    data = encryptor.update(plain) + encryptor.finalize()
+    data_key = cert.public_key().encrypt(
+        key,
+        padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA1()), algorithm=hashes.SHA1(), label=None),
+    )
+    return {
+        "data": base64.b64encode(data).decode("ascii"),
+        "dataKey": base64.b64encode(data_key).decode("ascii"),
+        "dataSignature": base64.b64encode(hmac.new(key, data, hashlib.sha256).digest()).decode("ascii"),
+        "encryptionCertificateId": hashlib.sha1(cert.public_bytes(serialization.Encoding.DER)).hexdigest(),
+    }
+
+
+@pytest.fixture
+def cert_material(tmp_path, monkeypatch):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    cert = _self_signed(key)
+    key_path = tmp_path / "graph.key"
+    cert_path = tmp_path / "graph.crt"
+    key_path.write_bytes(key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ))
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+
+    monkeypatch.setattr(settings, "GRAPH_CERT_PRIVATE_KEY_PATH", str(key_path))
+    monkeypatch.setattr(settings, "GRAPH_CERT_PATH", str(cert_path))
+    monkeypatch.setattr(settings, "GRAPH_CERT_THUMBPRINT", "")
+    monkeypatch.setattr(settings, "GRAPH_TENANT_ID", TENANT_ID)
+    monkeypatch.setattr(settings, "GRAPH_CLIENT_ID", CLIENT_ID)
+    return cert
+
+
+@pytest.fixture
+def signing_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture
+def rich(cert_material, signing_key):
+    rn = RichNotifications()
+    # JWKS precargado y fresco: validate_tokens no sale a la red
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(signing_key.public_key()))
+    jwk.update({"kid": KID, "use": "sig", "alg": "RS256"})
+    rn._jwks = {KID: jwt.PyJWK(jwk)}
+    rn._jwks_at = time.monotonic()
+    return rn
+
+
+def _token(key: rsa.RSAPrivateKey, **overrides) -> str:
+    now = int(time.time())
+    claims = {
+        "aud": CLIENT_ID,
+        "iss": f"https://sts.windows.net/{TENANT_ID}/",
+        "azp": GRAPH_NOTIFICATIONS_APP_ID,
+        "iat": now,
+        "nbf": now,
+        "exp": now + 3600,
+    }
+    claims.update(overrides)
+    return jwt.encode(claims, key, algorithm="RS256", headers={"kid": KID})
+
+
+# ============================
+# decrypt
+# ============================
+
+def test_decrypt_round_trip(rich, cert_material):
+    msg = {"id": "AAMk-1", "subject": "Radicado 123", "body": {"contentType": "html", "content": "<p>hola</p>"}}
+    assert rich.decrypt(_encrypt(msg, cert_material)) == msg
+
+
+def test_decrypt_rejects_tampered_signature(rich, cert_material):
+    encrypted = _encrypt({"id": "AAMk-1"}, cert_material)
+    encrypted["dataSignature"] = base64.b64encode(b"\x00" * 32).decode("ascii")
+    with pytest.raises(RuntimeError, match="dataSignature"):
+        rich.decrypt(encrypted)
+
+
+def test_decrypt_rejects_unknown_certificate(rich, cert_material):
+    encrypted = _encrypt({"id": "AAMk-1"}, cert_material)
+    encrypted["encryptionCertificateId"] = "not-our-cert"
+    with pytest.raises(RuntimeError, match="encryptionCertificateId"):
+        rich.decrypt(encrypted)
+
+
+# ============================
+# validate_tokens
+# ============================
+
+def test_validate_tokens_accepts_graph_token(rich, signing_key):
+    assert asyncio.run(rich.validate_tokens([_token(signing_key)])) is True
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        {"aud": "otra-app"},
+        {"azp": "00000000-0000-0000-0000-000000000000"},
+        {"iss": "https://sts.windows.net/otro-tenant/"},
+        {"exp": int(time.time()) - 3600},
+    ],
+    ids=["wrong_aud", "wrong_azp", "wrong_iss", "expired"],
+)
+def test_validate_tokens_rejects_bad_claims(rich, signing_key, overrides):
+    assert asyncio.run(rich.validate_tokens([_token(signing_key, **overrides)])) is False
+
+
+def test_validate_tokens_rejects_foreign_signature(rich):
+    other = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    assert asyncio.run(rich.validate_tokens([_token(other)])) is False
+
+
+def test_validate_tokens_requires_every_token(rich, signing_key):
+    tokens = [_token(signing_key), _token(signing_key, aud="otra-app")]
+    assert asyncio.run(rich.validate_tokens(tokens)) is False
+    assert asyncio.run(rich.validate_tokens([])) is False
+
+
+# ============================
+# extract_messages
+# ============================
+
+def test_extract_messages(rich, cert_material, signing_key):
+    notifications = [
+        {"resourceData": {"id": "AAMk-1"}, "encryptedContent": _encrypt({"id": "AAMk-1", "subject": "a"}, cert_material)},
+        {"resourceData": {"id": "AAMk-2"}},  # sin contenido cifrado: va por GET
+    ]
+    out = asyncio.run(rich.extract_messages(notifications=notifications, validation_tokens=[_token(signing_key)]))
+    assert out == {"AAMk-1": {"id": "AAMk-1", "subject": "a"}}
+
+    rejected = asyncio.run(rich.extract_messages(
+        notifications=notifications, validation_tokens=[_token(signing_key, aud="otra-app")]
+    ))
+    assert rejected == {}
@@ -0,0 +1,72 @@
+"""
+WorkLeases.balance: parte justa por instancia sin soltar carpetas con corrida delta en curso.
+Sin DB: run_db se reemplaza por un fake de worker_leases en memoria.
+
+    cd worker && python -m pytest -q tests
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+
+import pytest
+
+from app import repos, work_leases as work_leases_module
+from app.settings import settings
+from app.work_leases import WorkLeases, delta_lease
+
+FOLDERS = [delta_lease(1, fid) for fid in (11, 12, 13, 14)]
+
+
+@pytest.fixture
+def leases(monkeypatch):
+    released: list[str] = []
+
+    async def fake_run_db(fn, **kwargs):
+        if fn is repos.release_worker_leases:
+            released.extend(kwargs["resources"])
+            return len(kwargs["resources"])
+        if fn is repos.list_worker_leases:
+            return {}
+        if fn is repos.try_acquire_lease:
+            return True
+        raise AssertionError(f"unexpected run_db({fn.__name__})")
+
+    monkeypatch.setattr(work_leases_module, "run_db", fake_run_db)
+    monkeypatch.setattr(settings, "WORK_LEASES_ENABLED", 1)
+
+    wl = WorkLeases()
+    wl._held = set(FOLDERS)
+    wl._renewed_at = time.monotonic()
+    wl.live_workers = 2  # entró otro nodo: la parte justa baja de 4 a 2
+    return wl, released
+
+
+def test_balance_releases_extra_leases(leases):
+    wl, released = leases
+    owned = asyncio.run(wl.balance(FOLDERS, prefix="delta:"))
+    assert len(owned) == 2
+    assert sorted(released) == sorted(set(FOLDERS) - owned)
+
+
+def test_balance_keeps_busy_folders(leases):
+    wl, released = leases
+    busy = {FOLDERS[2], FOLDERS[3]}
+    owned = asyncio.run(wl.balance(FOLDERS, prefix="delta:", busy=busy))
+    # se sueltan las libres, nunca las que tienen corrida en curso
+    assert owned == busy
+    assert sorted(released) == sorted(FOLDERS[:2])
+    assert all(wl.holds(r) for r in busy)
+
+
+def test_balance_keeps_busy_folder_that_is_no_longer_monitored(leases):
+    wl, released = leases
+    wl.live_workers = 1
+    owned = asyncio.run(wl.balance(FOLDERS[:3], prefix="delta:", busy={FOLDERS[3]}))
+    assert owned == set(FOLDERS[:3])
+    assert released == []
+    assert wl.holds(FOLDERS[3])
+
+    # terminada la corrida, el siguiente balance la suelta
+    asyncio.run(wl.balance(FOLDERS[:3], prefix="delta:"))
+    assert released == [FOLDERS[3]]